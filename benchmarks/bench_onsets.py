@@ -0,0 +1,49 @@
+"""
+Micro-benchmark of the onset file readers.
+
+Compares reading every condition file of a run with the python engine
+pd.read_csv path (read_onsets_pandas) against read_onsets_batch.
+
+    $ python benchmarks/bench_onsets.py [n_conditions] [n_events] [repeat]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+from openfmri2bids.readers import read_onsets_batch, read_onsets_pandas
+
+
+def make_run(folder, n_conditions, n_events):
+    rnd = random.Random(0)
+    fpaths = []
+    for c in range(n_conditions):
+        fpath = os.path.join(folder, "cond%03d.txt" % (c + 1))
+        with open(fpath, "w") as f:
+            for i in range(n_events):
+                f.write("%.3f\t%g \t%.2f\n" % (i * 2.5 + rnd.random(),
+                                               rnd.choice([0.5, 1, 2]),
+                                               rnd.random()))
+        fpaths.append(fpath)
+    return fpaths
+
+
+if __name__ == '__main__':
+    n_conditions, n_events, repeat = ([int(a) for a in sys.argv[1:4]] +
+                                      [8, 100, 20][len(sys.argv[1:4]):])
+    folder = tempfile.mkdtemp()
+    try:
+        fpaths = make_run(folder, n_conditions, n_events)
+        pandas_time = min(timeit.repeat(
+            lambda: [read_onsets_pandas(fpath) for fpath in fpaths],
+            number=1, repeat=repeat))
+        batch_time = min(timeit.repeat(lambda: read_onsets_batch(fpaths),
+                                       number=1, repeat=repeat))
+    finally:
+        shutil.rmtree(folder)
+    print("%d conditions x %d events per run" % (n_conditions, n_events))
+    print("read_onsets_pandas: %8.2f ms" % (pandas_time * 1000))
+    print("read_onsets_batch:  %8.2f ms" % (batch_time * 1000))
+    print("speedup:            %8.1fx" % (pandas_time / batch_time))
@@ -0,0 +1,155 @@
+"""
+Scaling benchmark of convert() on synthetic datasets.
+
+Scales one dimension of openfmri2bids.synthetic.make_dataset() at a time
+(subjects, runs, conditions or events per run) around a small base
+dataset and reports, per point, the wall time, the outputs written per
+second, the peak resident memory of the converting process and the time
+spent in the main stages (see openfmri2bids.profiling).
+
+Every point is converted in a fresh interpreter so that peak memory is not
+inherited from earlier points. With --save the results are written as
+JSON; with --baseline a previous --save is compared against and the exit
+status is 1 if any point got slower or bigger by more than --tolerance.
+
+    $ python benchmarks/bench_scaling.py [--dimension subjects] [--repeat 3]
+          [--save results.json] [--baseline results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from openfmri2bids.synthetic import make_dataset
+
+BASE = dict(n_subjects=4, n_tasks=2, n_runs=2, n_conditions=3, n_events=20)
+
+DIMENSIONS = {"subjects": ("n_subjects", [4, 16, 64]),
+              "runs": ("n_runs", [2, 8, 32]),
+              "conditions": ("n_conditions", [3, 12, 48]),
+              "events": ("n_events", [20, 200, 2000])}
+
+STAGES = ["scan", "events", "behav_merge", "func_images"]
+
+COLUMNS = (["dimension", "value", "outputs", "wall_seconds", "outputs_per_s",
+            "peak_rss_mb"] + ["%s_seconds"%stage for stage in STAGES])
+
+
+def convert_point(source, dest, nii_handling, results):
+    """Runs in a fresh process, see measure()."""
+    from openfmri2bids.converter import convert
+
+    start = time.time()
+    summary = convert(source, dest, nii_handling=nii_handling,
+                      warning=lambda message: None)
+    wall = time.time() - start
+    results.put({"wall_seconds": wall, "peak_rss_mb": summary["peak_rss_mb"],
+                 "profile": summary["profile"]})
+
+
+def measure(source, dest, nii_handling):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=convert_point,
+                              args=(source, dest, nii_handling, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if process.exitcode:
+        raise RuntimeError("conversion of %s failed"%source)
+    return result
+
+
+def run_dimension(dimension, repeat, nii_handling, folder):
+    param, values = DIMENSIONS[dimension]
+    rows = []
+    for value in values:
+        kwargs = dict(BASE)
+        kwargs[param] = value
+        source = make_dataset(os.path.join(folder, "ds"), **kwargs)
+        best = None
+        for _ in range(repeat):
+            dest = os.path.join(folder, "out")
+            result = measure(source, dest, nii_handling)
+            shutil.rmtree(dest)
+            if best is None or result["wall_seconds"] < best["wall_seconds"]:
+                best = result
+        shutil.rmtree(source)
+
+        counters = best["profile"]["counters"]
+        stages = best["profile"]["stages"]
+        outputs = counters.get("events_files", 0) + counters.get("image_files", 0)
+        row = {"dimension": dimension, "value": value, "outputs": outputs,
+               "wall_seconds": best["wall_seconds"],
+               "outputs_per_s": outputs/best["wall_seconds"],
+               "peak_rss_mb": best["peak_rss_mb"]}
+        for stage in STAGES:
+            row["%s_seconds"%stage] = stages.get(stage, {}).get("wall", 0.0)
+        print("\t".join(format_value(row[column]) for column in COLUMNS))
+        sys.stdout.flush()
+        rows.append(row)
+    return rows
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.3f"%value
+    return str(value)
+
+
+def regressions(rows, baseline, tolerance):
+    """Points whose wall time or peak memory exceed the baseline by more
+    than tolerance (a fraction)."""
+    previous = dict(((row["dimension"], row["value"]), row)
+                    for row in baseline)
+    found = []
+    for row in rows:
+        old = previous.get((row["dimension"], row["value"]))
+        if old is None:
+            continue
+        for column in ["wall_seconds", "peak_rss_mb"]:
+            if row[column] > old[column]*(1 + tolerance):
+                found.append("%s=%s: %s %.3f -> %.3f"%(
+                    row["dimension"], row["value"], column, old[column],
+                    row[column]))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--dimension", choices=sorted(DIMENSIONS),
+                        action="append",
+                        help="dimension to scale (repeatable, default all)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="conversions per point, the fastest is kept")
+    parser.add_argument("--nii_handling", default="copy")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown/growth over the baseline")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    rows = []
+    print("\t".join(COLUMNS))
+    try:
+        for dimension in args.dimension or sorted(DIMENSIONS):
+            rows += run_dimension(dimension, args.repeat, args.nii_handling,
+                                  folder)
+    finally:
+        shutil.rmtree(folder)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(rows, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(rows, json.load(f), args.tolerance)
+        for line in found:
+            print("regression: " + line)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of writing events files.
+
+Compares the DataFrame path (sort_values, column reordering and to_csv)
+with events_tsv() on the events tables of a synthetic run, checking that
+both give the same text.
+
+    $ python benchmarks/bench_tsv.py [n_conditions] [n_events] [repeat]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from openfmri2bids.events import build_events, events_tsv
+from openfmri2bids.readers import read_onsets_batch
+from openfmri2bids.synthetic import make_dataset
+
+
+def events_to_csv(events_df):
+    """The DataFrame path events_tsv() replaces."""
+    events_df = events_df.rename(columns={"RT": "response_time"})
+    events_df = events_df.sort_values(by=["onset"])
+    cols = events_df.columns.tolist()
+    cols.insert(0, cols.pop(cols.index("onset")))
+    cols.insert(1, cols.pop(cols.index("duration")))
+    if "trial_type" in cols:
+        cols.insert(2, cols.pop(cols.index("trial_type")))
+    return events_df[cols].to_csv(sep="\t", na_rep="n/a", index=False,
+                                  float_format="%.3f")
+
+
+def make_events(folder, n_conditions, n_events):
+    make_dataset(folder, n_subjects=1, n_tasks=1, n_runs=1,
+                 n_conditions=n_conditions, n_events=n_events)
+    onsets = os.path.join(folder, "sub001", "model", "model001", "onsets",
+                          "task001_run001")
+    fnames = sorted(os.listdir(onsets))
+    tables = read_onsets_batch([os.path.join(onsets, fname)
+                                for fname in fnames])
+    names = ["cond%d"%i for i in range(len(fnames) - 1)] + ["respRT"]
+    return build_events(list(zip(names, tables)), warning=lambda m: None)
+
+
+if __name__ == '__main__':
+    n_conditions, n_events, repeat = ([int(a) for a in sys.argv[1:4]] +
+                                      [3, 20, 200][len(sys.argv[1:4]):])
+    folder = tempfile.mkdtemp()
+    try:
+        events_df = make_events(os.path.join(folder, "ds"), n_conditions,
+                                n_events)
+    finally:
+        shutil.rmtree(folder)
+    assert events_to_csv(events_df) == events_tsv(events_df)
+    pandas_time = min(timeit.repeat(lambda: events_to_csv(events_df),
+                                    number=1, repeat=repeat))
+    tsv_time = min(timeit.repeat(lambda: events_tsv(events_df),
+                                 number=1, repeat=repeat))
+    print("%d conditions x %d events per run (%d rows)" % (
+        n_conditions, n_events, len(events_df)))
+    print("to_csv:     %8.3f ms" % (pandas_time * 1000))
+    print("events_tsv: %8.3f ms" % (tsv_time * 1000))
+    print("speedup:    %8.1fx" % (pandas_time / tsv_time))
@@ -0,0 +1,177 @@
+"""
+Writing a converted dataset straight into a (compressed) tar stream,
+without creating the output folder.
+"""
+import gzip
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from .transfer import CHUNK_SIZE
+
+COMPRESSIONS = ["none", "gz", "zstd"]
+
+_SUFFIXES = [(".tar.gz", "gz"), (".tgz", "gz"), (".tar.zst", "zstd"),
+             (".tar.zstd", "zstd")]
+
+
+def guess_compression(fpath):
+    """Compression implied by an archive file name ("none" if unknown)."""
+    for suffix, compression in _SUFFIXES:
+        if str(fpath).endswith(suffix):
+            return compression
+    return "none"
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package")
+    return zstandard
+
+
+def _compressor(fileobj, compression):
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor(level=3).stream_writer(
+            fileobj, closefd=False)
+    if compression in [None, "none"]:
+        return None
+    raise ValueError("Unrecognized compression: %s"%compression)
+
+
+class TarSink(object):
+    """Adds the outputs of a conversion to a tar stream instead of writing
+    them to dest_dir (see converter.DirectorySink).
+
+    target is a file name, "-" for stdout or a binary file object. Members
+    are named after their path relative to dest_dir, under a folder named
+    like dest_dir. Text outputs come from memory and images are streamed
+    from the source in CHUNK_SIZE blocks; nii_handling "empty" gives empty
+    members, every other option the image contents. The sink can be shared
+    by several conversions (e.g. sessions) and has to be closed.
+    """
+
+    local = False
+    incremental = False
+
+    def __init__(self, target, dest_dir, compression="none"):
+        self.root = os.path.normpath(dest_dir)
+        self.prefix = os.path.basename(os.path.abspath(self.root))
+        if compression not in COMPRESSIONS + [None]:
+            raise ValueError("Unrecognized compression: %s"%compression)
+        if compression == "zstd":
+            _zstandard()
+        if target == "-":
+            self._file = None
+            fileobj = sys.stdout.buffer
+        elif hasattr(target, "write"):
+            self._file = None
+            fileobj = target
+        else:
+            self._file = fileobj = open(target, "wb")
+        self.target = target
+        self._out = fileobj
+        self._compressor = _compressor(fileobj, compression)
+        self._tar = tarfile.open(fileobj=self._compressor or fileobj,
+                                 mode="w|", format=tarfile.PAX_FORMAT,
+                                 copybufsize=CHUNK_SIZE)
+        self._lock = threading.Lock()
+        self._dirs = set()
+
+    def _arcname(self, path):
+        relpath = os.path.relpath(os.path.normpath(path), self.root)
+        if relpath == os.curdir:
+            return self.prefix
+        return "/".join([self.prefix] + relpath.split(os.sep))
+
+    def _add(self, info, fileobj=None):
+        with self._lock:
+            self._tar.addfile(info, fileobj)
+
+    def mkdir(self, path):
+        parts = self._arcname(path).split("/")
+        for i in range(1, len(parts) + 1):
+            name = "/".join(parts[:i])
+            if name in self._dirs:
+                continue
+            self._dirs.add(name)
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = time.time()
+            self._add(info)
+
+    def write_text(self, path, text):
+        data = text.encode("utf-8")
+        info = tarfile.TarInfo(self._arcname(path))
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = time.time()
+        self._add(info, io.BytesIO(data))
+
+    def write_with(self, writer, path):
+        """Calls writer with a temporary file name and adds that file."""
+        tmp_dir = tempfile.mkdtemp()
+        tmp_path = os.path.join(tmp_dir, os.path.basename(path))
+        try:
+            writer(tmp_path)
+            if os.path.exists(tmp_path):
+                self.copy_file(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.rmdir(tmp_dir)
+
+    def copy_file(self, src, path):
+        with open(src, "rb") as f:
+            info = self._tar.gettarinfo(arcname=self._arcname(path),
+                                        fileobj=f)
+            try:
+                self._add(info, f)
+            except OSError as exc:
+                # part of the member may have been written, so this must
+                # not be retried like a failed copy
+                raise RuntimeError("Failed adding %s to the archive: %s"%(
+                    src, exc))
+
+    def transfer(self, nii_handling, src, dest):
+        if nii_handling == "empty":
+            info = tarfile.TarInfo(self._arcname(dest))
+            info.mode = 0o644
+            info.mtime = time.time()
+            self._add(info)
+            return "empty"
+        self.copy_file(src, dest)
+        return "tar"
+
+    def close(self):
+        self._tar.close()
+        if self._compressor is not None:
+            self._compressor.close()
+        if self._file is not None:
+            self._file.close()
+        else:
+            self._out.flush()
+
+    def abort(self):
+        """Closes the sink after a failure, removing a partial archive
+        file."""
+        if self._file is not None:
+            self._file.close()
+            os.remove(self.target)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
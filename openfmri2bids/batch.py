@@ -0,0 +1,155 @@
+"""
+Converting many datasets, each in its own worker process.
+
+A dataset list is JSON: a list of entries (or {"datasets": [...]}) where
+each entry is either the name of a dataset folder or a dict with
+
+    "name": output folder name (defaults to the source folder name, or the
+            common prefix of the session folders)
+    "source": source folder (defaults to name)
+    "sessions": {session label: source folder} for datasets split into
+                one folder per session (like ds006A/ds006B), in order
+    "changelog_converter": a name from CHANGELOG_CONVERTERS (e.g. "rev")
+                           or "module:function"
+
+Relative source folders are looked up in the input folder.
+"""
+from __future__ import print_function
+
+import csv
+import json
+import logging
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .archive import TarSink
+from .converter import CHANGELOG_CONVERTERS, SkeletonSink, convert_sessions
+from .plan import resolve_function
+from .validate import errors
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIXES = {"none": ".tar", "gz": ".tar.gz", "zstd": ".tar.zst"}
+
+SUMMARY_COLUMNS = ["dataset", "status", "wall_seconds", "files", "bytes",
+                   "validation_errors", "error"]
+
+
+def read_dataset_list(fpath, input_dir, output_dir):
+    """Reads a dataset list into one job dict per dataset with its "name",
+    "dest", "sessions" ([session label, source folder] pairs) and
+    "changelog_converter"."""
+    with open(fpath) as f:
+        entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries["datasets"]
+    return [dataset_job(entry, input_dir, output_dir) for entry in entries]
+
+
+def dataset_job(entry, input_dir, output_dir):
+    if not isinstance(entry, dict):
+        entry = {"name": entry}
+    if "sessions" in entry:
+        # in the order given, dataset level files come from the first session
+        sessions = list(entry["sessions"].items())
+        name = entry.get("name") or os.path.commonprefix(
+            [source for _, source in sessions]).rstrip("_-") or sessions[0][1]
+    else:
+        name = entry.get("name") or entry["source"]
+        sessions = [["", entry.get("source", name)]]
+    return {"name": name,
+            "dest": os.path.join(output_dir, name),
+            "sessions": [[label, os.path.join(input_dir, source)]
+                         for label, source in sessions],
+            "changelog_converter": entry.get("changelog_converter",
+                                             "default")}
+
+
+def changelog_converter(name):
+    if name in CHANGELOG_CONVERTERS:
+        return CHANGELOG_CONVERTERS[name]
+    return resolve_function(name)
+
+
+def convert_dataset(job, archive_dir=None, compression="none",
+                    skeleton_dir=None, **kwargs):
+    """Converts all sessions of a dataset job and returns a summary row.
+    Errors are reported in the row instead of being raised.
+
+    With archive_dir the dataset is written to a tar archive named after it
+    in archive_dir (see archive.TarSink) instead of its output folder. With
+    skeleton_dir an empty skeleton of it is written to a folder named after
+    it in skeleton_dir as well (see converter.SkeletonSink). With
+    validate=True in kwargs the row has the number of validation errors
+    (see validate.validate_plan()).
+    """
+    start = time.time()
+    row = OrderedDict([("dataset", job["name"]), ("status", "ok"),
+                       ("wall_seconds", None), ("files", 0), ("bytes", 0),
+                       ("validation_errors", ""), ("error", "")])
+    sink = None
+    try:
+        if archive_dir is not None:
+            sink = TarSink(os.path.join(archive_dir, job["name"] +
+                                        ARCHIVE_SUFFIXES[compression]),
+                           job["dest"], compression=compression)
+        if skeleton_dir is not None:
+            sink = SkeletonSink(job["dest"],
+                                os.path.join(skeleton_dir, job["name"]),
+                                sink=sink)
+        summary = convert_sessions(job["sessions"], job["dest"],
+                                   changelog_converter=changelog_converter(
+                                       job["changelog_converter"]),
+                                   sink=sink, **kwargs)
+        row["files"] = summary["throughput"]["files"]
+        row["bytes"] = summary["throughput"]["bytes"]
+        if "issues" in summary:
+            row["validation_errors"] = len(errors(summary["issues"]))
+        if sink is not None:
+            sink.close()
+    except Exception as exc:
+        traceback.print_exc()
+        if sink is not None:
+            sink.abort()
+        row["status"] = "failed"
+        row["error"] = "%s: %s"%(type(exc).__name__, exc)
+    row["wall_seconds"] = round(time.time() - start, 3)
+    return row
+
+
+def convert_batch(dataset_jobs, jobs=1, **kwargs):
+    """Converts datasets (see read_dataset_list()) in a pool of jobs worker
+    processes. A failing dataset does not stop the others. kwargs are
+    passed on to convert_sessions(). Returns one summary row per dataset,
+    in the order of dataset_jobs."""
+    rows = [None] * len(dataset_jobs)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = dict((executor.submit(convert_dataset, job, **kwargs), i)
+                       for i, job in enumerate(dataset_jobs))
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                rows[i] = future.result()
+            except Exception as exc:
+                # the worker process itself died
+                rows[i] = OrderedDict([("dataset", dataset_jobs[i]["name"]),
+                                       ("status", "failed"),
+                                       ("wall_seconds", None),
+                                       ("files", 0), ("bytes", 0),
+                                       ("validation_errors", ""),
+                                       ("error", "%s: %s"%(
+                                           type(exc).__name__, exc))])
+            logger.info("%s: %s", rows[i]["dataset"], rows[i]["status"])
+    return rows
+
+
+def write_summary(rows, f):
+    """Writes the summary rows of convert_batch() as a TSV table."""
+    writer = csv.DictWriter(f, SUMMARY_COLUMNS, delimiter="\t",
+                            lineterminator="\n")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
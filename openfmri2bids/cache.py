@@ -0,0 +1,226 @@
+"""
+Persistent cache of parsed input tables.
+
+A TableCache keeps the DataFrames parsed from onset and behavdata files in a
+folder, so that reconverting the same sources (e.g. while iterating on the
+output rules) skips parsing them. Each entry holds the tables parsed from
+a group of files in one way (its "kind", e.g. all onset files of a run) and
+is named after their paths and the kind. It is only used while the files
+have the sizes and mtimes they were parsed at and it was written with the
+same PARSER_VERSION, converter and pandas versions.
+
+Entries are columnar: a JSON header line (signatures, column names, dtypes
+and the values of string columns) followed by the raw bytes of the numeric
+columns, which are read back with numpy.frombuffer().
+
+The folder is kept under max_bytes by evicting the least recently used
+entries (a hit touches the entry's mtime). Tables that cannot be stored
+this way (e.g. columns of mixed Python objects) are parsed every time.
+"""
+import hashlib
+import json
+import os
+from collections import Counter
+
+from . import __version__
+
+# bump when a parser changes the tables it returns
+PARSER_VERSION = 1
+
+ENTRY_SUFFIX = ".tables"
+
+STAT_KEYS = ["hits", "misses", "stored", "uncacheable", "evicted"]
+
+
+def parser_version():
+    import pandas as pd
+
+    return "%d/%s/%s"%(PARSER_VERSION, __version__, pd.__version__)
+
+
+def cache_report(stats):
+    """Every STAT_KEYS count of stats (a Counter of TableCache.stats) and
+    the hit rate."""
+    report = dict((key, stats[key]) for key in STAT_KEYS)
+    lookups = report["hits"] + report["misses"]
+    report["hit_rate"] = report["hits"]/float(lookups) if lookups else None
+    return report
+
+
+def _missing(value):
+    return isinstance(value, float) and value != value
+
+
+def table_header(df, buffers, offset):
+    """Header of a DataFrame, appending the bytes of its numeric columns
+    (starting at offset) to buffers. None if it cannot be stored."""
+    import numpy as np
+    import pandas as pd
+
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or \
+            df.index.step != 1:
+        return None
+    header = {"rows": len(df), "columns_dtype": str(df.columns.dtype),
+              "columns": [], "dtypes": [], "data": []}
+    for name, series in df.items():
+        if not isinstance(name, str) and type(name) is not int:
+            return None
+        values = series.values
+        if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+            data = np.ascontiguousarray(values).tobytes()
+            buffers.append(data)
+            header["data"].append([values.dtype.str, offset])
+            offset += len(data)
+        elif str(series.dtype) in ["str", "object"]:
+            values = series.tolist()
+            if not all(isinstance(value, str) or _missing(value)
+                       for value in values):
+                return None
+            header["data"].append([None if _missing(value) else value
+                                   for value in values])
+        else:
+            return None
+        header["columns"].append(name)
+        header["dtypes"].append(str(series.dtype))
+    return header
+
+
+def table_from_header(header, data):
+    """DataFrame of a table_header() whose numeric columns are in data."""
+    import numpy as np
+    import pandas as pd
+
+    index = pd.RangeIndex(header["rows"])
+    columns = {}
+    for i, (dtype, values) in enumerate(zip(header["dtypes"],
+                                            header["data"])):
+        if dtype in ["str", "object"]:
+            columns[i] = pd.Series([np.nan if value is None else value
+                                    for value in values], index=index,
+                                   dtype=dtype)
+        else:
+            columns[i] = np.frombuffer(data, dtype=values[0],
+                                       count=header["rows"],
+                                       offset=values[1]).copy()
+    df = pd.DataFrame(columns, index=index)
+    df.columns = pd.Index(header["columns"], dtype=header["columns_dtype"])
+    return df
+
+
+class TableCache(object):
+    """Parsed tables in folder, at most max_bytes of them. get() and
+    get_many() return the cached tables of files or parse (and store) them.
+    stats counts the hits and misses (per file), the stored and evicted
+    entries and the tables that could not be stored ("uncacheable")."""
+
+    def __init__(self, folder, max_bytes=1024 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.version = parser_version()
+        self.stats = Counter()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """(mtime, size, path) of the entries."""
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(ENTRY_SUFFIX):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def entry_path(self, fpaths, kind):
+        key = "\0".join([kind] + [os.path.abspath(fpath) for fpath in fpaths])
+        return os.path.join(self.folder, hashlib.sha1(
+            key.encode("utf-8", "surrogateescape")).hexdigest() +
+            ENTRY_SUFFIX)
+
+    def signature(self, fpaths, kind):
+        signature = {"kind": kind, "version": self.version, "files": []}
+        for fpath in fpaths:
+            st = os.stat(fpath)
+            signature["files"].append([os.path.abspath(fpath), st.st_size,
+                                       st.st_mtime_ns])
+        return signature
+
+    def load(self, entry_path, signature):
+        """Tables of an entry, None if it is missing or stale."""
+        try:
+            with open(entry_path, "rb") as f:
+                content = f.read()
+            os.utime(entry_path)
+        except OSError:
+            # missing or evicted meanwhile
+            return None
+        end = content.find(b"\n")
+        try:
+            header = json.loads(content[:end].decode("utf-8"))
+        except ValueError:
+            return None
+        if header["signature"] != signature:
+            return None
+        data = memoryview(content)[end + 1:]
+        return [table_from_header(table, data) for table in header["tables"]]
+
+    def store(self, entry_path, signature, dfs):
+        buffers = []
+        offset = 0
+        tables = []
+        for df in dfs:
+            table = table_header(df, buffers, offset)
+            if table is None:
+                self.stats["uncacheable"] += 1
+                return
+            tables.append(table)
+            offset = sum(len(data) for data in buffers)
+        content = json.dumps({"signature": signature,
+                              "tables": tables}).encode("utf-8") + b"\n" + \
+            b"".join(buffers)
+        tmp_path = "%s.%d.tmp"%(entry_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, entry_path)
+        self.stats["stored"] += 1
+        self._size += len(content)
+        if self._size > self.max_bytes:
+            self.trim()
+
+    def get_many(self, fpaths, kind, parse_many):
+        """Tables of several files parsed by parse_many (a function of the
+        list of files returning a list of tables), cached together as
+        kind."""
+        entry_path = self.entry_path(fpaths, kind)
+        signature = self.signature(fpaths, kind)
+        dfs = self.load(entry_path, signature)
+        if dfs is not None:
+            self.stats["hits"] += len(fpaths)
+            return dfs
+        self.stats["misses"] += len(fpaths)
+        dfs = parse_many(fpaths)
+        self.store(entry_path, signature, dfs)
+        return dfs
+
+    def get(self, fpath, kind, parse):
+        """Table parsed from fpath by parse() (a function of no arguments),
+        cached as kind (one per way a file is parsed)."""
+        return self.get_many([fpath], kind, lambda fpaths: [parse()])[0]
+
+    def trim(self):
+        """Evicts the least recently used entries until the cache holds at
+        most max_bytes."""
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            self._size -= size
+            self.stats["evicted"] += 1
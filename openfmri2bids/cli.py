@@ -1,27 +1,420 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+
 import click
 
-from .converter import convert, NII_HANDLING_OPTS
+from .archive import COMPRESSIONS, TarSink, guess_compression
+from .batch import convert_batch, read_dataset_list, write_summary
+from .cache import TableCache
+from .converter import (convert_sessions, execute_plan, NII_HANDLING_OPTS,
+                        ONLY_OPTS, SkeletonSink, run_settings)
+from .nifti import audit_tr, report_message
+from .plan import dump_plans, load_plans, make_sessions_plan, split_plan
+from .transfer import CHECKSUM_ALGORITHMS
+from .validate import errors
+from .watch import Watcher
+
+
+# options shared by (some of) the convert, execute, batch and watch commands
+transfer_jobs_option = click.option(
+    '--transfer_jobs', type=click.IntRange(min=1), default=1,
+    help='Number of images copied/linked concurrently (per job).')
+io_jobs_option = click.option(
+    '--io_jobs', type=click.IntRange(min=1), default=1,
+    help='Number of folder listings and small file reads (onset and '
+         'behavdata files) issued concurrently (per job), for high latency '
+         'network filesystems.')
+incremental_option = click.option(
+    '--incremental', is_flag=True,
+    help='Only regenerate outputs whose inputs changed since the last run '
+         '(tracked in a manifest in the output folder of each dataset).')
+behav_tolerance_option = click.option(
+    '--behav_tolerance', type=float, default=0.1,
+    help='Maximum onset difference (in seconds) when matching '
+         'behavdata.txt rows to events.')
+only_option = click.option(
+    '--only', type=click.Choice(ONLY_OPTS),
+    help='Only rewrite the events files or the metadata (sidecars and '
+         'dataset files) of an earlier conversion, without touching the '
+         'images.')
+
+
+def cache_options(func):
+    """--cache_folder and --cache_size (see table_cache())."""
+    func = click.option(
+        '--cache_size', type=click.FloatRange(min=0), default=1024.0,
+        help='Size limit of --cache_folder in MB (least recently used '
+             'tables are evicted).')(func)
+    return click.option(
+        '--cache_folder', type=click.Path(file_okay=False),
+        help='Keep the tables parsed from onset and behavdata files in this '
+             'folder and reuse them while the files do not change (can be '
+             'shared by runs and datasets).')(func)
+
+
+def table_cache(cache_folder, cache_size):
+    if cache_folder is None:
+        return None
+    return TableCache(cache_folder, max_bytes=int(cache_size * 1024 * 1024))
+
 
-@click.command()
+def check_issues(summaries):
+    """Fails if the validation of any of the plans behind summaries found
+    errors."""
+    found = []
+    for summary in summaries:
+        found += errors(summary.get("issues", []))
+    for issue in found:
+        click.echo("%(path)s: %(code)s: %(message)s"%issue, err=True)
+    if found:
+        raise click.ClickException("%d validation errors"%len(found))
+
+
+class DefaultGroup(click.Group):
+    """Runs the convert command unless a subcommand is named, so that
+    `openfmri2bids SOURCE DEST` keeps working."""
+
+    def parse_args(self, ctx, args):
+        args = list(args)
+        group_options = [opt for param in self.params for opt in param.opts]
+        i = 0
+        while i < len(args) and args[i].split("=")[0] in group_options:
+            i += 1 if "=" in args[i] else 2
+        if i < len(args) and args[i] not in self.commands and \
+                args[i] != "--help":
+            args.insert(i, "convert")
+        return super(DefaultGroup, self).parse_args(ctx, args)
+
+
+LOG_LEVELS = ["debug", "info", "warning", "error"]
+
+
+@click.group(cls=DefaultGroup)
+@click.option('--log_level', type=click.Choice(LOG_LEVELS), default="info",
+              help='Verbosity of the progress messages (on stderr).')
+def main(log_level):
+    """Convert OpenfMRI dataset to BIDS."""
+    logging.basicConfig(level=getattr(logging, log_level.upper()),
+                        format="%(message)s", stream=sys.stderr)
+
+
+@main.command("convert")
 @click.argument('openfmri_dataset_path', required=True, type=click.Path(exists=True))
 @click.argument('output_folder', required=True, type=click.Path())
 @click.option('--first_session_label', type=(str))
 @click.option('--additional_session', type=(str, click.Path()), multiple=True)
 @click.option('--nii_handling', type=click.Choice(NII_HANDLING_OPTS), default=NII_HANDLING_OPTS[2])
-def main(openfmri_dataset_path, output_folder, first_session_label,
-         additional_session, nii_handling):
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of subjects to convert in parallel.')
+@transfer_jobs_option
+@io_jobs_option
+@cache_options
+@incremental_option
+@behav_tolerance_option
+@click.option('--dry-run', '--dry_run', 'dry_run', is_flag=True,
+              help='Print the conversion plan (JSON, see the execute '
+                   'command) instead of converting.')
+@click.option('--archive', type=click.Path(dir_okay=False, allow_dash=True),
+              help='Write a tar archive (\'-\' for stdout) of the dataset, '
+                   'with OUTPUT_FOLDER as its top folder, instead of the '
+                   'output folder.')
+@click.option('--compression', type=click.Choice(COMPRESSIONS),
+              help='Archive compression (by default guessed from the '
+                   'archive name, e.g. .tar.gz or .tar.zst).')
+@click.option('--skeleton_folder', type=click.Path(file_okay=False),
+              help='Also write an empty skeleton of the dataset (zero-byte '
+                   'images, real metadata and events) to this folder. For '
+                   'a skeleton only use --nii_handling empty instead.')
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help='Write wall/CPU seconds and counters per stage, subject '
+                   'and run, and the peak memory, to this JSON file.')
+@click.option('--cprofile', type=(str, click.Path(dir_okay=False)),
+              help='Convert subject SUBJECT under cProfile and write the '
+                   'stats (for pstats/snakeviz) to FILE.')
+@click.option('--checksums', type=click.Choice(CHECKSUM_ALGORITHMS),
+              help='Write a checksum manifest of the output folder '
+                   '(.openfmri2bids_checksums.ALGORITHM, sha256sum/b2sum '
+                   'format), hashing images while they are copied.')
+@click.option('--dedup', is_flag=True,
+              help='Hard link images whose contents are already in the '
+                   'output instead of copying them again (needs '
+                   '--checksums, not with --jobs).')
+@click.option('--validate', is_flag=True,
+              help='Check the outputs against the plan after converting '
+                   '(file names, TSV columns and n/a values, sidecars, '
+                   'participants) and write the issues to '
+                   '.openfmri2bids_validation.json in the output folder.')
+@only_option
+def convert_command(openfmri_dataset_path, output_folder, first_session_label,
+                    additional_session, nii_handling, jobs, transfer_jobs,
+                    io_jobs, cache_folder, cache_size, incremental, behav_tolerance, dry_run, archive,
+                    compression, skeleton_folder, profile, cprofile,
+                    checksums, dedup, validate, only):
     """Convert OpenfMRI dataset to BIDS."""
-    click.echo('{0}, {1}.'.format(openfmri_dataset_path, output_folder))
-
-    if additional_session:
-        convert(openfmri_dataset_path, output_folder,
-                ses=first_session_label, nii_handling=nii_handling)
-        for session in additional_session:
-            convert(session[1], output_folder, ses=session[0],
-                    nii_handling=nii_handling)
+    sessions = [(first_session_label if additional_session else "",
+                 openfmri_dataset_path)] + [(label, session_path) for
+                                            label, session_path in
+                                            additional_session]
+    if dry_run:
+        # keep stdout for the plan
+        with contextlib.redirect_stdout(sys.stderr):
+            plan = make_sessions_plan(sessions, output_folder,
+                                      nii_handling=nii_handling,
+                                      behav_tolerance=behav_tolerance,
+                                      warning=click.echo, io_jobs=io_jobs)
+        dump_plans(plan, sys.stdout)
+        return
+
+    settings = run_settings(jobs=jobs, transfer_jobs=transfer_jobs,
+                            incremental=incremental, cprofile=cprofile,
+                            checksums=checksums, dedup=dedup,
+                            validate=validate, only=only, io_jobs=io_jobs,
+                            cache=table_cache(cache_folder, cache_size))
+    if incremental and (archive or skeleton_folder):
+        raise click.UsageError("--incremental cannot be combined with "
+                               "--archive or --skeleton_folder")
+    if (checksums or validate) and archive:
+        raise click.UsageError("--checksums and --validate cannot be "
+                               "combined with --archive")
+    if only and (archive or skeleton_folder):
+        raise click.UsageError("--only cannot be combined with --archive or "
+                               "--skeleton_folder")
+    if dedup and (not checksums or nii_handling not in ["copy", "reflink"]):
+        raise click.UsageError("--dedup needs --checksums and --nii_handling "
+                               "copy or reflink")
+    if dedup and jobs > 1:
+        raise click.UsageError("--dedup cannot be combined with --jobs")
+    sink = None
+    if archive:
+        if jobs > 1:
+            raise click.UsageError("--archive cannot be combined with --jobs")
+        try:
+            sink = TarSink(archive, output_folder,
+                           compression=compression or
+                           guess_compression(archive))
+        except ImportError as exc:
+            raise click.ClickException(str(exc))
+    if skeleton_folder:
+        sink = SkeletonSink(output_folder, skeleton_folder, sink=sink)
+
+    if archive:
+        # keep stdout for the archive
+        with contextlib.redirect_stdout(sys.stderr), sink:
+            summary = convert_sessions(sessions, output_folder,
+                                       nii_handling=nii_handling,
+                                       behav_tolerance=behav_tolerance,
+                                       sink=sink, **settings)
     else:
-        convert(openfmri_dataset_path, output_folder,
-                nii_handling=nii_handling)
+        click.echo('{0}, {1}.'.format(openfmri_dataset_path, output_folder))
+        summary = convert_sessions(sessions, output_folder,
+                                   nii_handling=nii_handling,
+                                   behav_tolerance=behav_tolerance,
+                                   sink=sink, **settings)
+
+    if profile:
+        with open(profile, "w") as f:
+            json.dump(dict(summary["profile"],
+                           peak_rss_mb=summary["peak_rss_mb"],
+                           cache=summary.get("cache")),
+                      f, indent=2, sort_keys=True)
+    check_issues([summary])
+
+
+@main.command("execute")
+@click.argument('plan_file', type=click.File('r'))
+@click.option('--shard', type=(click.IntRange(min=0), click.IntRange(min=1)),
+              help='Only run shard INDEX (counting from 0) of the plan '
+                   'split into COUNT shards.')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of subjects to convert in parallel.')
+@transfer_jobs_option
+@io_jobs_option
+@cache_options
+@incremental_option
+@click.option('--validate', is_flag=True,
+              help='Check the outputs against the plan (see convert).')
+@only_option
+def execute_command(plan_file, shard, jobs, transfer_jobs, io_jobs,
+                    cache_folder, cache_size, incremental, validate, only):
+    """Run a plan written by `convert --dry-run` ('-' reads stdin)."""
+    summaries = []
+    settings = run_settings(jobs=jobs, transfer_jobs=transfer_jobs,
+                            incremental=incremental, validate=validate,
+                            only=only, io_jobs=io_jobs,
+                            cache=table_cache(cache_folder, cache_size))
+    for plan in load_plans(plan_file):
+        if shard:
+            if shard[0] >= shard[1]:
+                raise click.BadParameter("INDEX has to be smaller than COUNT",
+                                         param_hint="--shard")
+            plan = split_plan(plan, shard[1])[shard[0]]
+        summaries.append(execute_plan(plan, settings))
+    check_issues(summaries)
+
+
+@main.command("batch")
+@click.argument('dataset_list', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_folder', type=click.Path())
+@click.option('--input_folder', type=click.Path(exists=True, file_okay=False),
+              help='Folder the datasets in the list are in (defaults to '
+                   'the folder of the list).')
+@click.option('--nii_handling', type=click.Choice(NII_HANDLING_OPTS), default=NII_HANDLING_OPTS[2])
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of datasets to convert in parallel.')
+@transfer_jobs_option
+@io_jobs_option
+@cache_options
+@incremental_option
+@behav_tolerance_option
+@click.option('--summary', type=click.Path(dir_okay=False),
+              help='Where to write the summary table (TSV, defaults to '
+                   'batch_summary.tsv in the output folder).')
+@click.option('--archive', is_flag=True,
+              help='Write one tar archive per dataset to the output folder '
+                   'instead of dataset folders.')
+@click.option('--compression', type=click.Choice(COMPRESSIONS),
+              default="none", help='Archive compression.')
+@click.option('--skeleton_folder', type=click.Path(file_okay=False),
+              help='Also write empty skeletons of the datasets (zero-byte '
+                   'images, real metadata and events) to this folder. For '
+                   'skeletons only use --nii_handling empty instead.')
+@click.option('--validate', is_flag=True,
+              help='Check the outputs of every dataset against its plan '
+                   '(see convert), errors are counted in the summary.')
+@only_option
+def batch_command(dataset_list, output_folder, input_folder, nii_handling,
+                  jobs, transfer_jobs, io_jobs, cache_folder, cache_size,
+                  incremental, behav_tolerance, summary, archive,
+                  compression, skeleton_folder, validate, only):
+    """Convert every dataset in a JSON dataset list (see
+    openfmri2bids.batch), each in a worker process."""
+    if input_folder is None:
+        input_folder = os.path.dirname(os.path.abspath(dataset_list))
+    if incremental and (archive or skeleton_folder):
+        raise click.UsageError("--incremental cannot be combined with "
+                               "--archive or --skeleton_folder")
+    if validate and archive:
+        raise click.UsageError("--validate cannot be combined with --archive")
+    if only and (archive or skeleton_folder):
+        raise click.UsageError("--only cannot be combined with --archive or "
+                               "--skeleton_folder")
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    kwargs = {}
+    if archive:
+        kwargs = dict(archive_dir=output_folder, compression=compression)
+    if validate:
+        kwargs["validate"] = True
+    if only:
+        kwargs["only"] = only
+    if skeleton_folder:
+        kwargs["skeleton_dir"] = skeleton_folder
+    rows = convert_batch(read_dataset_list(dataset_list, input_folder,
+                                           output_folder),
+                         jobs=jobs, nii_handling=nii_handling,
+                         transfer_jobs=transfer_jobs, incremental=incremental,
+                         behav_tolerance=behav_tolerance, io_jobs=io_jobs,
+                         cache=table_cache(cache_folder, cache_size),
+                         **kwargs)
+    if summary is None:
+        summary = os.path.join(output_folder, "batch_summary.tsv")
+    with open(summary, "w") as f:
+        write_summary(rows, f)
+    write_summary(rows, sys.stdout)
+    failed = [row["dataset"] for row in rows if row["status"] != "ok" or
+              row["validation_errors"]]
+    if failed:
+        raise click.ClickException(
+            "%d of %d datasets failed (or did not validate): %s"%(
+                len(failed), len(rows), ", ".join(failed)))
+
+
+@main.command("watch")
+@click.argument('incoming_folder', type=click.Path(exists=True, file_okay=False))
+@click.argument('output_folder', type=click.Path())
+@click.option('--nii_handling', type=click.Choice(NII_HANDLING_OPTS), default=NII_HANDLING_OPTS[2])
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of datasets to convert in parallel.')
+@transfer_jobs_option
+@io_jobs_option
+@cache_options
+@incremental_option
+@behav_tolerance_option
+@click.option('--validate', is_flag=True,
+              help='Check the outputs of every dataset against its plan '
+                   '(see convert).')
+@click.option('--interval', type=click.FloatRange(min=0), default=10.0,
+              help='Seconds between two scans of the incoming folder.')
+@click.option('--quiet_period', type=click.FloatRange(min=0), default=60.0,
+              help='Seconds without changes after which a dataset is '
+                   'considered complete and converted.')
+@click.option('--once', is_flag=True,
+              help='Convert what is new or changed (without waiting for it '
+                   'to be quiet) and exit.')
+def watch_command(incoming_folder, output_folder, nii_handling, jobs,
+                  transfer_jobs, io_jobs, cache_folder, cache_size,
+                  incremental, behav_tolerance, validate, interval,
+                  quiet_period, once):
+    """Convert every dataset folder dropped into (or changed in) an
+    incoming folder to a folder of the same name in the output folder.
+    The queue, throughput and per dataset latencies are written to
+    .openfmri2bids_watch_status.json in the output folder."""
+    kwargs = {}
+    if validate:
+        kwargs["validate"] = True
+    watcher = Watcher(incoming_folder, output_folder, jobs=jobs,
+                      quiet_seconds=quiet_period, nii_handling=nii_handling,
+                      transfer_jobs=transfer_jobs, incremental=incremental,
+                      behav_tolerance=behav_tolerance, io_jobs=io_jobs,
+                      cache=table_cache(cache_folder, cache_size), **kwargs)
+    try:
+        if once:
+            watcher.poll(assume_quiet=True)
+            watcher.wait()
+        else:
+            watcher.run(interval=interval)
+    except KeyboardInterrupt:
+        # interrupted conversions are redone by the next watcher
+        watcher.save()
+    finally:
+        watcher.close()
+    failed = sorted(name for name, dataset in watcher.datasets.items()
+                    if dataset["status"] == "failed")
+    if once and failed:
+        raise click.ClickException("%d datasets failed: %s"%(
+            len(failed), ", ".join(failed)))
+
+
+@main.command("audit_tr")
+@click.argument('openfmri_dataset_paths', nargs=-1, required=True,
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--fix', is_flag=True,
+              help='Repair inconsistent headers (by default only report '
+                   'them).')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of images checked/repaired in parallel.')
+@click.option('--report', type=click.File('w'),
+              help='Write the per image results (JSON) to this file.')
+def audit_tr_command(openfmri_dataset_paths, fix, jobs, report):
+    """Check the TR in the BOLD image headers against scan_key.txt."""
+    reports = []
+    for dataset_path in openfmri_dataset_paths:
+        reports += audit_tr(dataset_path, fix=fix, jobs=jobs)
+    for message in filter(None, map(report_message, reports)):
+        click.echo(message)
+    if report:
+        json.dump(reports, report, indent=1)
+    counts = dict((status, len([r for r in reports if r["status"] == status]))
+                  for status in ["ok", "inconsistent", "fixed", "error"])
+    click.echo("%(ok)d ok, %(inconsistent)d inconsistent, %(fixed)d fixed, "
+               "%(error)d errors"%counts)
+    if counts["inconsistent"] or counts["error"]:
+        raise click.ClickException("%d images with an inconsistent TR or "
+                                   "errors"%(counts["inconsistent"] +
+                                             counts["error"]))
 
 
 if __name__ == '__main__':
@@ -1,30 +1,73 @@
 from __future__ import print_function
 
 import errno
+import logging
 import os
 import shutil
 import json
-import re
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from functools import partial
 from os import path
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import pandas as pd
-import numpy as np
-import datetime
-import dateutil
 import tokenize
+import time
 
-from functools import reduce
+# pandas, dateutil and the events modules (which need pandas and NumPy)
+# are imported by the functions using them, so that planning, image
+# transfers and the CLI start without loading them
 
-NII_HANDLING_OPTS = ['empty', 'move', 'copy', 'link']  # first entry is default
+from .cache import cache_report
+from .manifest import MANIFEST_NAME, Manifest, write_checksums
+from .validate import errors, report_path, validate_plan, write_report
+from .profiling import Profile, peak_rss_mb, run_profiled
+from .inventory import SourceIndex
+from .plan import (NII_HANDLING_OPTS, DESCRIPTION_FILES, check_plan,
+                   make_sessions_plan, resolve_function, session_labels)
+from .transfer import (ContentIndex, TransferQueue, clone_file, copy_hashed,
+                       hardlink_file, hash_file, throughput_report)
 
+logger = logging.getLogger(__name__)
+
+# outputs execute_plan() can regenerate on their own (the only setting)
+ONLY_OPTS = ['events', 'metadata']
+
+# settings of execute_plan() and their defaults, see run_settings()
+RUN_SETTINGS = OrderedDict([
+    # subjects converted concurrently by worker processes; sinks that are
+    # not local (like archive.TarSink) need 1
+    ("jobs", 1),
+    # threads transferring images (per worker process) while the events
+    # are processed
+    ("transfer_jobs", 1),
+    # threads reading the onset and behavdata files of a subject ahead
+    ("io_jobs", 1),
+    # cache.TableCache keeping the tables parsed from those files
+    ("cache", None),
+    # keep a manifest of the outputs and their inputs in the output folder
+    # and only regenerate missing or outdated outputs (resumes a run too)
+    ("incremental", False),
+    # algorithm of transfer.CHECKSUM_ALGORITHMS: write a checksum manifest
+    # of the output folder (see manifest.write_checksums())
+    ("checksums", None),
+    # hard link copied images whose contents are already in the dataset
+    # (needs checksums and 1 job, worker processes do not share them)
+    ("dedup", False),
+    # check the outputs against the plan and write the issues found (see
+    # validate.validate_plan())
+    ("validate", False),
+    # one of ONLY_OPTS: only rewrite those outputs of an earlier conversion
+    ("only", None),
+    # (subject, file name): write cProfile stats of that subject's
+    # conversion
+    ("cprofile", None),
+])
 
-def sanitize_label(label):
-    return re.sub("[^a-zA-Z0-9]*", "", label)
 
 def handle_nii(opt, src=None, dest=None):
-    """Moves / copies / links / creates a .nii.gz.
+    """Moves / copies / links / creates a .nii.gz and returns the mechanism
+    that was used ('hardlink' falls back to copying across filesystems,
+    'reflink' to copy_file_range, sendfile and a plain copy).
     Note: many options will raise an error if the dest exists.
     """
     if opt == 'empty':
@@ -35,10 +78,46 @@ def handle_nii(opt, src=None, dest=None):
         shutil.move(src, dest)
     elif opt == 'link':
         os.symlink(src, dest)
+    elif opt == 'hardlink':
+        return hardlink_file(src, dest)
+    elif opt == 'reflink':
+        return clone_file(src, dest)
     else:
         raise NotImplementedError('Unrecognized nii_handling value: %s' % opt)
+    return opt
+
+
+def handle_nii_hashed(opt, src, dest, index, tmp_path=None):
+    """handle_nii() that also returns the checksum of the image, as a
+    (mechanism, digest) pair, and adds it to index (a ContentIndex).
+
+    Copies are hashed while the data is streamed; other options hash the
+    source (or the empty image). With index.dedup images whose contents
+    are already in the dataset are hard linked to them ("dedup"). With
+    tmp_path the image is written there and then moved to dest.
+    """
+    path = dest if tmp_path is None else tmp_path
+    digest, original = index.find(src)
+    if original is not None:
+        hardlink_file(original, path)
+        mechanism = "dedup"
+    elif opt == 'copy' and digest is None:
+        digest = copy_hashed(src, path, index.algorithm)
+        mechanism = opt
+    else:
+        if digest is None and opt != 'empty':
+            digest = hash_file(src, index.algorithm)
+        mechanism = handle_nii(opt, src, path)
+        if opt == 'empty':
+            digest = hash_file(path, index.algorithm)
+    if tmp_path is not None:
+        replace_file(tmp_path, dest)
+    index.add(dest, digest)
+    return mechanism, digest
     
 def convert_changelog(in_file, out_file):
+    import dateutil.parser
+
     versions = {}
     date = None
     out_str = ""
@@ -50,7 +129,7 @@ def convert_changelog(in_file, out_file):
                 if out_str:
                     versions[date] = out_str
                 date_str = line.split(":")[0]
-                print(line)
+                logger.debug(line)
                 desc = line.split(":")[1]
                 date = dateutil.parser.parse(date_str)
                 out_str = date.strftime("%Y-%m-%d\n\n")
@@ -63,12 +142,43 @@ def convert_changelog(in_file, out_file):
         with open(out_file, "w") as f:
             f.write("\n\n".join(reversed(versions)))
 
-def convert_dataset_metadata(in_dir, out_dir):
+
+def convert_rev_changelog(in_file, out_file):
+    """For release histories with "revN (date): description" lines (e.g.
+    ds113b)."""
+    import dateutil.parser
+
+    out_str = ""
+    for line in open(in_file).readlines():
+        if line.startswith("rev"):
+            version = line.split("(")[0]
+            desc = line.split("(")[1].split(")")[1].replace(":","")
+            date = dateutil.parser.parse(line.split("(")[1].split(")")[0])
+            line = version + date.strftime("%Y-%m-%d") + desc
+        out_str += line
+    with open(out_file, "w") as f:
+        f.write(out_str)
+
+
+# changelog converters that can be named in batch dataset lists
+CHANGELOG_CONVERTERS = {"default": convert_changelog,
+                        "rev": convert_rev_changelog}
+
+
+def convert_dataset_metadata(in_dir, out_dir, sink=None, found=None):
+    """Writes dataset_description.json and README. found are the names of
+    the DESCRIPTION_FILES in in_dir (e.g. as planned by plan_dataset()),
+    by default they are looked up in a SourceIndex of in_dir."""
+    if sink is None:
+        sink = DirectorySink()
+    if found is None:
+        index = SourceIndex(in_dir)
+        found = [fname for fname in DESCRIPTION_FILES if index.exists(fname)]
     meta_dict = OrderedDict()
     meta_dict["BIDSVersion"] = "1.0.0"
     
-    study_key_file = os.path.join(in_dir, "study_key.txt")
-    if os.path.exists(study_key_file):
+    if "study_key.txt" in found:
+        study_key_file = os.path.join(in_dir, "study_key.txt")
         meta_dict["Name"] = tokenize.open(study_key_file).read().strip()
     else:
         if in_dir.endswith(os.sep):
@@ -76,412 +186,792 @@ def convert_dataset_metadata(in_dir, out_dir):
         else:
             meta_dict["Name"] = in_dir.split(os.sep)[-2]
         
-    ref_file = os.path.join(in_dir, "references.txt")
-    if os.path.exists(ref_file):
+    if "references.txt" in found:
+        ref_file = os.path.join(in_dir, "references.txt")
         meta_dict["ReferencesAndLinks"] = tokenize.open(ref_file).read().strip()
         
-    lic_file = os.path.join(in_dir, "license.txt")
-    if os.path.exists(lic_file):
+    if "license.txt" in found:
+        lic_file = os.path.join(in_dir, "license.txt")
         meta_dict["License"] = tokenize.open(lic_file).read().strip()
         
-    json.dump(meta_dict, open(os.path.join(out_dir,
-                                           "dataset_description.json"), "w"),
-                  sort_keys=True, indent=4, separators=(',', ': '))
+    sink.write_text(os.path.join(out_dir, "dataset_description.json"),
+                    json.dumps(meta_dict, sort_keys=True, indent=4,
+                               separators=(',', ': ')))
               
     readme = os.path.join(in_dir, "README")
-    if os.path.exists(readme):
-        shutil.copy(readme, os.path.join(out_dir,"README"))
-    elif os.path.exists(readme + ".txt"):
-        shutil.copy(readme + ".txt", os.path.join(out_dir,"README"))
-
-def convert(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0], warning=print, ses="", changelog_converter=convert_changelog):
-    if ses:
-        folder_ses = "ses-%s"%ses
-        filename_ses = "_%s"%folder_ses
-    else:
-        folder_ses = ""
-        filename_ses = ""
-
-    def mkdir(path):
-        try:
-            os.makedirs(path)
-        except OSError as exc: # Python >2.5
-            if exc.errno == errno.EEXIST and os.path.isdir(path):
-                pass
-            else: raise
-    
-    openfmri_subjects = sorted([s.split(os.sep)[-1] for s in glob(path.join(
-            source_dir, "sub*"))])
-    print("OpenfMRI subject IDs: " + str(openfmri_subjects))
-    n_digits = len(str(len(openfmri_subjects)))
-    subject_template = "sub-%0" + str(n_digits) + "d"
-    BIDS_subjects = [subject_template%int(s[-3:]) for s in openfmri_subjects]
-    print("BIDS subject IDs: " + str(BIDS_subjects))
-    
-    mkdir(dest_dir)
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        mkdir(path.join(dest_dir, BIDS_s))
-        
-    tasks = set([s[:7] for s in os.listdir(path.join(source_dir, openfmri_subjects[0], "BOLD")) if s.startswith("task")])
-    
-    tasks_dict = {}
-    for task in tasks:
-        print(os.listdir(path.join(source_dir, openfmri_subjects[0], "BOLD")))
-        print(openfmri_subjects[0])
-        runs_union = set()
-        for openfmri_s in openfmri_subjects:
-            runs_union = runs_union | set([s[8:] for s in os.listdir(path.join(source_dir, openfmri_s, "BOLD")) if s.startswith(task)])
-        tasks_dict[task] = {"runs": runs_union}
-    
-    with tokenize.open(os.path.join(source_dir, "models", "model001", "condition_key.txt")) as f:
-        for line in f:
-            if line.strip() == "":
-                break
-            items = line.split()
-            task = items[0]
-            condition = items[1]
-            condition_name = " ".join(items[2:])
-            if "conditions" not in tasks_dict[task]:
-                tasks_dict[task]["conditions"] = {}
-            tasks_dict[task]["conditions"][condition] = condition_name
-    
-    with tokenize.open(os.path.join(source_dir, "task_key.txt")) as f:
-        for line in f:
-            words = line.split()
-            if words[0] in tasks_dict.keys():
-                tasks_dict[words[0]]['name'] = " ".join(words[1:])
+    if "README" in found:
+        sink.copy_file(readme, os.path.join(out_dir,"README"))
+    elif "README.txt" in found:
+        sink.copy_file(readme + ".txt", os.path.join(out_dir,"README"))
 
-    print(tasks_dict)
-    
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        for task in tasks:
-            for run in tasks_dict[task]["runs"]:
-                if len(tasks_dict[task]["runs"]) == 1:
-                    trg_run = ""
-                else:
-                    trg_run = "_run-%s"%run[4:]
-                mkdir(path.join(dest_dir, BIDS_s, folder_ses, "func"))
-                dst = path.join(dest_dir, 
-                                BIDS_s,
-                                folder_ses, 
-                                "func",
-                                "%s%s%s%s_bold.nii.gz"%(BIDS_s, filename_ses, "_task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
-                src = path.join(source_dir, 
-                                openfmri_s, 
-                                "BOLD", 
-                                "%s_%s"%(task, run), 
-                                "bold.nii.gz")
-                if not os.path.exists(src):
-                    warning("%s does not exist"%src)
-                    continue
-
-                handle_nii(nii_handling, src=src, dest=dst)
-    
-    anatomy_mapping = {"highres": "T1w",
-                       "inplane": "inplaneT2"}
-
-    for anatomy_openfmri, anatomy_bids in anatomy_mapping.items():
-        runs_union = set()
-
-        for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-            subject_runs = [s.split(os.sep)[-1] for s in glob(path.join(source_dir,
-                                                      openfmri_s,
-                                                      "anatomy",
-                                                      "%s*.nii.gz"%anatomy_openfmri))
-                            if len(s.split(os.sep)[-1]) in [len("%s000.nii.gz"%anatomy_openfmri),
-                                                         len("%s.nii.gz" % anatomy_openfmri)]]
-            runs_union = runs_union | set(subject_runs)
-
-        runs_union = sorted(list(runs_union))
-        for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-            mkdir(path.join(dest_dir, BIDS_s, folder_ses, "anat"))
-
-            for run_idx, run in enumerate(runs_union):
-                src_run = run
-
-                if len(runs_union) == 1:
-                    trg_run = ""
-                else:
-                    trg_run = "_run-%02d"%(run_idx+1)
 
-                dst = path.join(dest_dir,
-                                BIDS_s,
-                                folder_ses,
-                                "anat",
-                                "%s%s%s_%s.nii.gz"%(BIDS_s, filename_ses, trg_run, anatomy_bids))
-                src = path.join(source_dir,
-                                openfmri_s,
-                                "anatomy",
-                                "%s"%src_run)
-                if os.path.exists(src):
-                    handle_nii(nii_handling, src=src, dest=dst)
-                else:
-                    print(src + " does not exists")
-    
-    scan_parameters_dict = OrderedDict()
-    with tokenize.open(os.path.join(source_dir, "scan_key.txt")) as f:
-        for line in f:
-            items = line.split()
-            if items[0] == "TR":
-                scan_parameters_dict["RepetitionTime"] = float(items[1])
-
-    for openfmri_s, BIDS_s in zip(openfmri_subjects, BIDS_subjects):
-        scans_dfs = []
-        for task in tasks_dict.keys():
-            for run in sorted(tasks_dict[task]["runs"]):
-                if len(tasks_dict[task]["runs"]) == 1:
-                    trg_run = ""
-                else:
-                    trg_run = "_run-%s"%run[4:]
-
-                dfs = []
-                parametric_columns = []
-                for condition_id, condition_name in tasks_dict[task]["conditions"].items():
-                    # TODO: check if onsets are in seconds
-                    fpath = os.path.join(source_dir, 
-                                       openfmri_s, 
-                                       "model", 
-                                       "model001", 
-                                       "onsets", 
-                                       "%s_%s"%(task, run), 
-                                       "%s.txt"%condition_id)
-                    if not os.path.exists(fpath):
-                        warning("%s does not exist"%fpath)
-                        continue
-                    if os.stat(fpath).st_size == 0:
-                        warning("%s is empty"%fpath)
-                        continue
-                    tmp_df = pd.read_csv(fpath,
-                                         delimiter=r"\s+",
-                                         names=["onset", "duration", "weight"], 
-                                         header=None,
-                                         engine="python",
-                                         index_col=False,
-                                         skip_blank_lines=True
-                                        )
-                    if tmp_df.duration.isnull().sum() > 0:
-                        tmp_df = pd.read_csv(fpath,
-                                         sep=" ",
-                                         names=["onset", "duration", "weight"], 
-                                         header=None,
-                                         engine="python",
-                                         index_col=False
-                                        )
-                    tmp_df["trial_type"] = condition_name
-                    if not (len(tmp_df["weight"].unique()) == 1 and \
-                                        tmp_df["weight"].unique()[0] == 1):
-                        tmp_df[condition_name] = tmp_df["weight"]
-                        parametric_columns.append(condition_name)
-                    tmp_df.drop('weight', axis=1, inplace=True)
-                    dfs.append(tmp_df)
-                if dfs:
-                    if len(set([len(df) for df in dfs])) == 1:
-                        events_df = reduce(lambda left, right: pd.merge(left,
-                                                                        right, on=['onset', 'duration', 'trial_type'],
-                                                                        how="outer"), dfs)
-                    else:
-                        events_df = pd.concat(dfs, ignore_index=True)
-                    while 'trial_type_x' in events_df.columns:
-                        events_df.drop('trial_type_x', axis=1, inplace=True)
-                        events_df.drop('trial_type_y', axis=1, inplace=True)
-                else:
-                    continue
-
-
-                # check for RT encoded as duration
-                pre_len = len(events_df["onset"].unique())
-
-                if "trial_type" in events_df.columns:
-                    trial_types = events_df.trial_type.unique()
-                    events_df["RT"] = np.nan
-                    for trial_type in trial_types:
-                        if trial_type.endswith("RT"):
-                            trials_df = events_df[
-                                events_df.trial_type == trial_type]
-                            for i, row in trials_df.iterrows():
-                                RT = row["duration"]
-                                if RT == 0:
-                                    RT = np.nan
-                                events_df.loc[
-                                    events_df["onset"] == row["onset"], "RT"] = RT
-                    events_df = events_df.dropna(axis=1, how='all')
-                    events_df = events_df[
-                        ~events_df.trial_type.str.endswith("RT")]
-                if (parametric_columns):
-                    events_df = events_df.sort_values(parametric_columns,
-                                                      na_position="first").drop_duplicates(
-                        ["onset", "duration"], keep='last')
-                # remove rows with zero duration:
-                if (events_df.duration == 0).sum() > 0:
-                    warning(str(events_df[events_df.duration == 0]))
-                    events_df = events_df[events_df.duration != 0]
-
-
-                # if len(events_df["onset"].unique()) != len(events_df["onset"]) and \
-                #         (np.array([(events_df["duration"] == val).sum() for val in set(events_df["duration"])]) >
-                #             len(events_df["duration"])/2.0).any() and len(set(
-                #     events_df["duration"])) > 1:
-                #     events_df["RT"] = "n/a"
-                #     for i, row in events_df.iterrows():
-                #         if row[[c for c in events_df.columns if c not in
-                #                 ["duration", "onset", "RT",
-                #                  "trial_type"]]].isnull().all():
-                #             RT = row["duration"]
-                #             events_df.loc[events_df["onset"] == row["onset"], "RT"] = RT
-                #             events_df.drop(i, axis=0, inplace=True)
-                assert(pre_len == len(events_df["onset"].unique()))
-
-                
-                beh_path = os.path.join(source_dir, 
-                                        openfmri_s, 
-                                        "behav",
-                                        "%s_%s"%(task, run),
-                                        "behavdata.txt")
-                if os.path.exists(beh_path):
-                    # There is a timing discrepancy between cond and behav - we need to use approximation to match them
-                    if os.stat(beh_path).st_size == 0:
-                        warning("%s is empty"%beh_path)
-                        all_df = events_df
-                    else:
-                        unlabeled_beh = False
-                        beh_df = pd.read_csv(beh_path,
-                                             sep=None,
-                                             #delimiter=r"\s+",
-                                             engine="python",
-                                             index_col=False
-                                             )
-                        if 'TrialOnset' in beh_df.columns:
-                            beh_df.rename(columns={'TrialOnset': 'Onset'}, inplace=True)
-                        if 'TR' in beh_df.columns:
-                            beh_df["TR"] = (beh_df["TR"]-1)*scan_parameters_dict["RepetitionTime"]
-                            beh_df["duration"] = beh_df['TR'].map(lambda x: scan_parameters_dict["RepetitionTime"])
-                            beh_df.rename(columns={'TR': 'onset'}, inplace=True)
-                            all_df = pd.concat([events_df, beh_df])
+def mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc: # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else: raise
+
+
+def is_current(manifest, output, inputs, options=None):
+    """True if incremental conversion can skip output."""
+    return manifest is not None and manifest.is_current(output, inputs,
+                                                        options)
+
+
+def record(records, manifest, output, inputs, options=None):
+    if manifest is not None:
+        records.update(manifest.entry(output, inputs, options))
+
+
+def replace_file(tmp_path, dest):
+    """os.replace(), also when both are hard links of the same file (which
+    rename() leaves in place)."""
+    os.replace(tmp_path, dest)
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+
+def remove_stale(output):
+    """Makes room for an output that is about to be regenerated."""
+    if os.path.lexists(output):
+        os.remove(output)
+
+
+class DirectorySink(object):
+    """Writes the outputs of a conversion to the filesystem. Other sinks
+    (e.g. archive.TarSink) provide the same methods; local sinks can be
+    written to by several worker processes at once and incremental ones
+    can skip outputs that are up to date.
+
+    Outputs (images too) are written to a temporary file next to them
+    first, so an existing output, e.g. of an earlier conversion, is
+    replaced atomically."""
+
+    local = True
+    incremental = True
+
+    def mkdir(self, path):
+        mkdir(path)
+
+    def write_text(self, path, text):
+        with open(path + ".tmp", "w", newline="") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def write_with(self, writer, path):
+        """Calls writer with a temporary file name (e.g. a changelog
+        converter) and moves what it wrote to path."""
+        writer(path + ".tmp")
+        if os.path.exists(path + ".tmp"):
+            os.replace(path + ".tmp", path)
+
+    def copy_file(self, src, path):
+        shutil.copy(src, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def transfer(self, nii_handling, src, dest, index=None):
+        tmp_path = dest + ".tmp"
+        remove_stale(tmp_path)
+        if index is not None:
+            return handle_nii_hashed(nii_handling, src, dest, index,
+                                     tmp_path=tmp_path)
+        mechanism = handle_nii(nii_handling, src, tmp_path)
+        replace_file(tmp_path, dest)
+        return mechanism
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class SkeletonSink(object):
+    """Writes the outputs to sink (by default a DirectorySink) and an empty
+    skeleton of them to skeleton_dir: the same metadata and events files
+    but zero-byte images, so both come out of a single conversion."""
+
+    incremental = False
+
+    def __init__(self, dest_dir, skeleton_dir, sink=None):
+        self.dest_dir = dest_dir
+        self.skeleton_dir = skeleton_dir
+        self.sink = DirectorySink() if sink is None else sink
+        self.local = self.sink.local
+        self._skeleton = DirectorySink()
+
+    def _skeleton_path(self, path):
+        return os.path.join(self.skeleton_dir,
+                            os.path.relpath(path, self.dest_dir))
+
+    def mkdir(self, path):
+        self.sink.mkdir(path)
+        self._skeleton.mkdir(self._skeleton_path(path))
+
+    def write_text(self, path, text):
+        self.sink.write_text(path, text)
+        self._skeleton.write_text(self._skeleton_path(path), text)
+
+    def write_with(self, writer, path):
+        self.sink.write_with(writer, path)
+        self._skeleton.write_with(writer, self._skeleton_path(path))
+
+    def copy_file(self, src, path):
+        self.sink.copy_file(src, path)
+        self._skeleton.copy_file(src, self._skeleton_path(path))
+
+    def transfer(self, nii_handling, src, dest, index=None):
+        self._skeleton.transfer("empty", src, self._skeleton_path(dest))
+        if index is not None:
+            return self.sink.transfer(nii_handling, src, dest, index=index)
+        return self.sink.transfer(nii_handling, src, dest)
+
+    def close(self):
+        self.sink.close()
+
+    def abort(self):
+        self.sink.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def image_transfer(sink, nii_handling, index=None):
+    """The transfer function of a TransferQueue writing images to sink,
+    checksumming them into index (a ContentIndex) if given."""
+    if index is None:
+        return partial(sink.transfer, nii_handling)
+    return partial(sink.transfer, nii_handling, index=index)
+
+
+def queue_images(subject, options, transfers, manifest=None):
+    """Queues the planned images of a subject on transfers (a
+    TransferQueue)."""
+    image_options = {"nii_handling": options["nii_handling"]}
+    for image in subject["images"]:
+        if is_current(manifest, image["dest"], [image["src"]], image_options):
+            continue
+        if manifest is not None:
+            remove_stale(image["dest"])
+        transfers.submit(image["src"], image["dest"])
+
+
+def run_label(dest):
+    """sub-X[_ses-Y]_task-Z[_run-N] part of a func output file name."""
+    return path.basename(dest).rsplit("_", 1)[0]
+
+
+def convert_events(subject, options, warning=print, manifest=None,
+                   sink=None, profile=None, io_jobs=1, cache=None):
+    """Writes the planned events files of a subject and returns their
+    manifest entries. Timings and counters go to a child of profile (the
+    subject's Profile) per run. With io_jobs > 1 the onset and behavdata files of all runs are read ahead
+    by that many threads (see readers.Prefetcher). With cache (a
+    cache.TableCache) their parsed tables are looked up there first."""
+    if sink is None:
+        sink = DirectorySink()
+    if profile is None:
+        profile = Profile()
+    behav_tolerance = options["behav_tolerance"]
+    stale = [events for events in subject["events"]
+             if not is_current(manifest, events["dest"], events["inputs"],
+                               {"behav_tolerance": behav_tolerance})]
+    if not stale:
+        return {}
+    if io_jobs <= 1:
+        return write_events(stale, subject, options, warning, manifest, sink,
+                            profile, cache=cache)
+
+    from .readers import Prefetcher
+
+    fpaths = []
+    for events in stale:
+        fpaths += [fpath for fpath, _ in events["conditions"]]
+        if events["behav"] is not None:
+            fpaths.append(events["behav"])
+    reader = Prefetcher(fpaths, workers=io_jobs)
+    try:
+        return write_events(stale, subject, options, warning, manifest,
+                            sink, profile, reader=reader, cache=cache)
+    finally:
+        reader.close()
+
+
+def write_events(stale, subject, options, warning, manifest, sink, profile,
+                 reader=None, cache=None):
+    """The events files of convert_events(), reading the inputs through
+    reader (a readers.Prefetcher) and cache (a cache.TableCache) if
+    given."""
+    import pandas as pd
+    from .events import align_behav, build_events, events_tsv
+    from .readers import read_bytes, read_onsets_batch
+
+    behav_tolerance = options["behav_tolerance"]
+    scan_parameters_dict = options["scan_parameters"]
+    records = {}
+    scans_dfs = []
+    read = read_bytes if reader is None else reader.read
+
+    def read_onsets(fpaths):
+        if cache is None:
+            return read_onsets_batch(fpaths, read=read)
+        return cache.get_many(fpaths, "onsets",
+                              lambda missing: read_onsets_batch(missing,
+                                                                read=read))
+
+    def read_behav(beh_path, kind, **kwargs):
+        """behavdata table read by pd.read_csv(**kwargs), cached as kind."""
+        def parse():
+            return pd.read_csv(beh_path if reader is None else
+                               reader.open(beh_path), engine="python",
+                               index_col=False, **kwargs)
+        if cache is None:
+            return parse()
+        return cache.get(beh_path, kind, parse)
+
+    for events in stale:
+        dest = events["dest"]
+        inputs = events["inputs"]
+        run = profile.child(run_label(dest))
+        stage = run.stage("events")
+        onset_dfs = read_onsets([fpath for fpath, _ in events["conditions"]])
+        run.count("onset_files", len(onset_dfs))
+        events_df = build_events([(condition_name, tmp_df) for
+                                  (fpath, condition_name), tmp_df in
+                                  zip(events["conditions"], onset_dfs)],
+                                 warning=warning)
+        del onset_dfs
+        stage.stop()
+        if events_df is None:
+            continue
+
+        beh_path = events["behav"]
+        if beh_path is not None:
+            stage = run.stage("behav_merge")
+            # There is a timing discrepancy between cond and behav - we need to use approximation to match them
+            unlabeled_beh = False
+            beh_df = read_behav(beh_path, "behav", sep=None)
+            run.count("pandas_reads")
+            if 'TrialOnset' in beh_df.columns:
+                beh_df.rename(columns={'TrialOnset': 'Onset'}, inplace=True)
+            if 'TR' in beh_df.columns:
+                beh_df["TR"] = (beh_df["TR"]-1)*scan_parameters_dict["RepetitionTime"]
+                beh_df["duration"] = beh_df['TR'].map(lambda x: scan_parameters_dict["RepetitionTime"])
+                beh_df.rename(columns={'TR': 'onset'}, inplace=True)
+                all_df = pd.concat([events_df, beh_df])
+                unlabeled_beh = True
+
+            if "Onset" not in beh_df.columns:
+                if "onset" not in beh_df.columns:
+                    if "Cue_Onset" not in beh_df.columns:
+                        beh_df_no_header = read_behav(beh_path, "behav_no_header", sep=None, header=None)
+                        run.count("pandas_reads")
+                        if len(beh_df_no_header.index) == len(events_df.index):
+                            events_df.sort_values(by=["onset"], inplace=True)
+                            events_df.index = range(len(events_df))
+                            all_df = pd.concat([events_df, beh_df_no_header], axis=1)
                             unlabeled_beh = True
-                            
-                        if "Onset" not in beh_df.columns:
-                            if "onset" not in beh_df.columns:
-                                if "Cue_Onset" not in beh_df.columns:
-                                    beh_df_no_header = pd.read_csv(beh_path, sep=None, engine="python", index_col=False, header=None)
-                                    if len(beh_df_no_header.index) == len(events_df.index):
-                                        events_df.sort_values(by=["onset"], inplace=True)
-                                        events_df.index = range(len(events_df))
-                                        all_df = pd.concat([events_df, beh_df_no_header], axis=1)
-                                        unlabeled_beh = True
-                                    elif len(beh_df.index) == len(events_df.index):
-                                        events_df.sort_values(by=["onset"], inplace=True)
-                                        events_df.index = range(len(events_df))
-                                        all_df = pd.concat([events_df, beh_df], axis=1)
-                                        unlabeled_beh = True
-                                    else:
-                                        # behdata are not events
-                                        try:
-                                            beh_df = pd.read_csv(beh_path,
-                                                     sep=" ",
-                                                     engine="python",
-                                                     index_col=False
-                                                     )
-                                        except:
-                                            beh_df = pd.read_csv(beh_path,
-                                                     sep=",",
-                                                     engine="python",
-                                                     index_col=False
-                                                     )
-                                        beh_df["filename"] = path.join("func",
-                                                                       "%s_%s%s_bold.nii.gz"%(BIDS_s, "task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
-                                        beh_df.set_index("filename", inplace=True)
-                                        scans_dfs.append(beh_df)
-                                        all_df = events_df
-                                else:
-                                    df1 = beh_df.rename(columns={'Cue_Onset': 'Onset'}).drop(["Stim_Onset"], axis=1)
-                                    df2 = beh_df.rename(columns={'Stim_Onset': 'Onset'}).drop(["Cue_Onset"], axis=1)
-                                    beh_df = pd.concat([df1, df2]).sort_values(by=["Onset"])
-                            else:
-                                beh_df.rename(columns={'onset': 'Onset'}, inplace=True)
-                    
-                        if not scans_dfs and not unlabeled_beh:
-                            events_df["approx_onset"] = events_df["onset"].round(1)
-                            beh_df["approx_onset"] = beh_df["Onset"].round(1)
-        
-                            all_df = pd.merge(left=events_df, right=beh_df, left_on="approx_onset", right_on="approx_onset", how="outer")
-        
-                            # Set onset to the average of onsets reported in cond and behav since we do not know which one is true
-                            all_df["onset"].fillna(all_df["Onset"], inplace=True)
-                            all_df["Onset"].fillna(all_df["onset"], inplace=True)
-                            all_df["onset"] = (all_df["onset"]+all_df["Onset"])/2.0
-                            all_df = all_df.drop(["Onset","approx_onset"], axis=1)
+                        elif len(beh_df.index) == len(events_df.index):
+                            events_df.sort_values(by=["onset"], inplace=True)
+                            events_df.index = range(len(events_df))
+                            all_df = pd.concat([events_df, beh_df], axis=1)
+                            unlabeled_beh = True
+                        else:
+                            # behdata are not events
+                            run.count("pandas_reads")
+                            try:
+                                beh_df = read_behav(beh_path, "behav_space",
+                                                    sep=" ")
+                            except:
+                                beh_df = read_behav(beh_path, "behav_comma",
+                                                    sep=",")
+                            beh_df["filename"] = path.join("func",
+                                                           path.basename(dest).replace("_events.tsv", "_bold.nii.gz"))
+                            beh_df.set_index("filename", inplace=True)
+                            scans_dfs.append(beh_df)
+                            all_df = events_df
+                    else:
+                        df1 = beh_df.rename(columns={'Cue_Onset': 'Onset'}).drop(["Stim_Onset"], axis=1)
+                        df2 = beh_df.rename(columns={'Stim_Onset': 'Onset'}).drop(["Cue_Onset"], axis=1)
+                        beh_df = pd.concat([df1, df2]).sort_values(by=["Onset"])
                 else:
-                    all_df = events_df
-
-                if 'RT' in all_df.columns:
-                    all_df.rename(columns={'RT': 'response_time'}, inplace=True)
-
-                all_df.sort_values(by=["onset"], inplace=True)
-                dest = path.join(dest_dir, 
-                                 BIDS_s,
-                                 folder_ses,
-                                 "func",
-                                 "%s%s%s%s_events.tsv"%(BIDS_s, filename_ses, "_task-%s"%sanitize_label(tasks_dict[task]['name']), trg_run))
-
-                # put onset, duration and trial_type in front
-                cols = all_df.columns.tolist()
-                cols.insert(0, cols.pop(cols.index("onset")))
-                cols.insert(1, cols.pop(cols.index("duration")))
-                if "trial_type" in cols:
-                    cols.insert(2, cols.pop(cols.index("trial_type")))
-                all_df = all_df[cols]
-                
-                all_df.to_csv(dest, sep="\t", na_rep="n/a", index=False,
-                              float_format="%.3f")
-                
-        if False: #scans_dfs: # broken for ds107
-            all_df = pd.concat(scans_dfs)
-            if filename_ses:
-                filename_ses_b = filename_ses[1:] + "_"
-            else:
-                filename_ses_b = ""
-            all_df.to_csv(path.join(dest_dir, 
-                                    BIDS_s,
-                                    folder_ses,
-                                    "%s%s_scans.tsv"%(filename_ses_b, BIDS_s)), sep="\t", na_rep="n/a", index=True,
-                          float_format="%.3f")
-            
-    dem_file = os.path.join(source_dir,"demographics.txt")
-    if not os.path.exists(dem_file):
-        warning("%s does not exist"%dem_file)
-    else:
-        id_dict = dict(zip(openfmri_subjects, BIDS_subjects))
-        participants = pd.read_csv(dem_file, delimiter=r"\s+", skip_blank_lines=True)
-        if "subject_id" in participants.columns:
-            participants["participant_id"] = participants["subject_id"].apply(lambda x: subject_template%int(x))
-            del participants["subject_id"]
+                    beh_df.rename(columns={'onset': 'Onset'}, inplace=True)
+
+            if not scans_dfs and not unlabeled_beh:
+                all_df, report = align_behav(events_df, beh_df,
+                                             tolerance=behav_tolerance)
+                if report["unmatched_events"] or report["unmatched_behav"]:
+                    warning("%s: %d events and %d behavdata rows could not be matched within %gs"%(
+                        beh_path, len(report["unmatched_events"]),
+                        len(report["unmatched_behav"]), behav_tolerance))
+            stage.stop()
         else:
-            participants = pd.read_csv(dem_file, delimiter=r"\s+", header=None, names=["dataset", "subject_id", "sex", "age", "handedness", "ethnicity"], skip_blank_lines=True).drop(["dataset"], axis=1)
-            if len(participants['subject_id'].unique()) == len(openfmri_subjects):
-                participants["participant_id"] = participants["subject_id"].apply(lambda x: id_dict[x])
-                del participants["subject_id"]
-            else:
-                participants = pd.read_csv(dem_file, delimiter=r"\t", skip_blank_lines=True)
-                participants["participant_id"] = participants[
-                    'MRI Sub Num'].apply(lambda x: subject_template % int(x))
-                del participants['MRI Sub Num']
-
-        participants = participants.dropna(axis=1,how='all')
-        cols = participants.columns.tolist()
-        cols.insert(0, cols.pop(cols.index("participant_id")))
-        participants = participants[cols]
-        participants.to_csv(os.path.join(dest_dir, "participants.tsv"), sep="\t", index=False, na_rep="n/a")
-    
-    for task in tasks:
-        scan_parameters_dict["TaskName"] = tasks_dict[task]['name']
+            all_df = events_df
+
+        stage = run.stage("events")
+        text = events_tsv(all_df)
+        sink.write_text(dest, text)
+        run.count("events_files")
+        run.count("events_bytes", len(text))
+        stage.stop()
+        record(records, manifest, dest, inputs,
+               {"behav_tolerance": behav_tolerance})
+
+    if False: #scans_dfs: # broken for ds107
+        folder_ses, filename_ses = session_labels(options["ses"])
+        all_df = pd.concat(scans_dfs)
         if filename_ses:
             filename_ses_b = filename_ses[1:] + "_"
         else:
             filename_ses_b = ""
-        json.dump(scan_parameters_dict, open(os.path.join(dest_dir, 
-                                                          "task-%s_bold.json"%(sanitize_label(tasks_dict[task]['name']))), "w"),
-                  sort_keys=True, indent=4, separators=(',', ': '))
-        
-    convert_dataset_metadata(source_dir, dest_dir)
-    if os.path.exists(os.path.join(source_dir, "release_history.txt")):
-        changelog_converter(os.path.join(source_dir, "release_history.txt"), os.path.join(dest_dir, "CHANGES"))
+        all_df.to_csv(path.join(subject["directories"][0],
+                                folder_ses,
+                                "%s%s_scans.tsv"%(filename_ses_b, subject["bids"])), sep="\t", na_rep="n/a", index=True,
+                      float_format="%.3f")
+    return records
+
+
+def convert_subject(subject, options, warning=print, manifest=None,
+                    transfers=None, sink=None, index=None, settings=None):
+    """Converts func images, anat images and events of a single planned
+    subject. Touches only files inside the subject's own output folder, so
+    several subjects can be converted concurrently.
+
+    Images are queued on transfers, or on a TransferQueue of transfer_jobs
+    threads (see run_settings()) owned by this call (checksumming them into index, a
+    ContentIndex, if given), and copied while the events are processed.
+    Returns a dict with the manifest entries of the outputs it (re)generated
+    ("records"), how many images each transfer mechanism handled
+    ("nii_handling"), the per file transfer results ("transfers", only
+    for a queue owned by this call) and a Profile.to_dict() of its events
+    ("profile", images are accounted for by execute_plan()).
+
+    The "options" of a subject (e.g. its session in a multi-session plan)
+    override the plan options. The io_jobs and cache settings apply to the
+    events (see convert_events(), the cache lookups are counted in
+    "cache"). With only="events" just the events are written, with
+    only="metadata" just the sidecars.
+    """
+    settings = run_settings(settings)
+    only, cache = settings["only"], settings["cache"]
+    options = dict(options, **subject.get("options", {}))
+    nii_handling = options["nii_handling"]
+    if sink is None:
+        sink = DirectorySink()
+    for directory in subject["directories"]:
+        sink.mkdir(directory)
+    own_transfers = transfers is None
+    if own_transfers:
+        transfers = TransferQueue(image_transfer(sink, nii_handling, index),
+                                  workers=settings["transfer_jobs"])
+    if only is None:
+        queue_images(subject, options, transfers, manifest=manifest)
+    profile = Profile()
+    records = {}
+    cache_stats = Counter(cache.stats) if cache is not None else None
+    if only != "metadata":
+        records = convert_events(subject, options, warning=warning,
+                                 manifest=manifest, sink=sink,
+                                 profile=profile,
+                                 io_jobs=settings["io_jobs"], cache=cache)
+    result = {"records": records,
+              "nii_handling": Counter(),
+              "transfers": [],
+              "profile": profile.to_dict()}
+    if cache is not None:
+        result["cache"] = cache.stats - cache_stats
+    if only != "events":
+        result["records"].update(write_sidecars(subject.get("sidecars", []),
+                                                manifest, sink))
+    if own_transfers:
+        add_transfer_results(result, transfers.wait(), manifest, nii_handling)
+    return result
+
+
+def add_transfer_results(result, transfer_results, manifest, nii_handling):
+    for transfer in transfer_results:
+        result["nii_handling"][transfer["mechanism"]] += 1
+        record(result["records"], manifest, transfer["dest"],
+               [transfer["src"]], {"nii_handling": nii_handling})
+        result["transfers"].append(transfer)
+
+
+def save_records(manifest, records):
+    if manifest is not None:
+        manifest.update(records)
+        manifest.save()
+
+
+def collect_subject_result(summary, manifest, result, profile=None,
+                           subject=None):
+    """Adds the result of convert_subject() to summary, and the subject's
+    profile to profile."""
+    save_records(manifest, result["records"])
+    if subject is not None:
+        profile.merge(subject["bids"], result["profile"])
+    summary["nii_handling"].update(result["nii_handling"])
+    if "cache" in result:
+        summary["cache"].update(result["cache"])
+    for transfer in result["transfers"]:
+        if transfer["digest"] is not None:
+            summary["digests"][transfer["dest"]] = transfer["digest"]
+    summary["transfers"].extend(result["transfers"])
+
+
+def add_image_profiles(profile, transfers):
+    """Accounts transfers (TransferQueue results) for to the func_images or
+    anat_images stage of their subject (and run)."""
+    for transfer in transfers:
+        func_dir, fname = path.split(transfer["dest"])
+        subject_dir = path.dirname(func_dir)
+        if path.basename(subject_dir).startswith("ses-"):
+            subject_dir = path.dirname(subject_dir)
+        target = profile.child(path.basename(subject_dir))
+        if path.basename(func_dir) == "func":
+            stage = "func_images"
+            target = target.child(run_label(fname))
+        else:
+            stage = "anat_images"
+        target.add_stage(stage, transfer["seconds"],
+                         transfer.get("cpu_seconds", 0.0))
+        target.count("image_files")
+        target.count("image_bytes", transfer["bytes"])
+
+
+def read_participants(dem_file, subject_template, subjects):
+    """Participants table of a demographics.txt, subjects being the
+    (OpenfMRI, BIDS) label pairs of its dataset. Returns the table and the
+    number of times the file was parsed."""
+    import pandas as pd
+
+    openfmri_subjects = [openfmri_s for openfmri_s, _ in subjects]
+    id_dict = dict(subjects)
+    participants = pd.read_csv(dem_file, delimiter=r"\s+", skip_blank_lines=True)
+    n_reads = 1
+    if "subject_id" in participants.columns:
+        participants["participant_id"] = participants["subject_id"].apply(lambda x: subject_template%int(x))
+        del participants["subject_id"]
+    else:
+        participants = pd.read_csv(dem_file, delimiter=r"\s+", header=None, names=["dataset", "subject_id", "sex", "age", "handedness", "ethnicity"], skip_blank_lines=True).drop(["dataset"], axis=1)
+        n_reads += 1
+        if len(participants['subject_id'].unique()) == len(openfmri_subjects):
+            participants["participant_id"] = participants["subject_id"].apply(lambda x: id_dict[x])
+            del participants["subject_id"]
+        else:
+            participants = pd.read_csv(dem_file, delimiter=r"\t", skip_blank_lines=True)
+            n_reads += 1
+            participants["participant_id"] = participants[
+                'MRI Sub Num'].apply(lambda x: subject_template % int(x))
+            del participants['MRI Sub Num']
+    return participants, n_reads
+
+
+def convert_participants(participants_plan, sink):
+    """Writes participants.tsv, merging the demographics of several
+    sessions (the last one wins for subjects in more than one). Returns
+    the number of times demographics files were parsed."""
+    import pandas as pd
+    from .tsv import frame_to_tsv
+
+    subjects_per_input = participants_plan.get(
+        "subjects_per_input", [participants_plan["subjects"]])
+    templates = participants_plan.get(
+        "subject_templates", [participants_plan["subject_template"]])
+    tables = []
+    n_reads = 0
+    for dem_file, subjects, template in zip(participants_plan["inputs"],
+                                            subjects_per_input, templates):
+        table, reads = read_participants(dem_file, template, subjects)
+        tables.append(table)
+        n_reads += reads
+    if len(tables) == 1:
+        participants = tables[0]
+    else:
+        # in order of first appearance, with the values of the last session
+        merged = pd.concat(tables, ignore_index=True)
+        order = merged["participant_id"].drop_duplicates()
+        participants = merged.drop_duplicates(
+            "participant_id", keep="last").set_index(
+                "participant_id").loc[order].reset_index()
+
+    participants = participants.dropna(axis=1,how='all')
+    sink.write_text(participants_plan["dest"],
+                    frame_to_tsv(participants, first=["participant_id"],
+                                 na_rep="n/a"))
+    return n_reads
+
+
+def write_sidecars(sidecars, manifest, sink):
+    """Writes planned JSON sidecars and returns their manifest entries."""
+    records = {}
+    for sidecar in sidecars:
+        if is_current(manifest, sidecar["dest"], sidecar["inputs"]):
+            continue
+        sink.write_text(sidecar["dest"],
+                        json.dumps(sidecar["content"], sort_keys=True,
+                                   indent=4, separators=(',', ': ')))
+        record(records, manifest, sidecar["dest"], sidecar["inputs"])
+    return records
+
+
+def convert_dataset_files(plan, changelog_converter=None, manifest=None,
+                          sink=None, profile=None):
+    """Writes the planned dataset level files and returns their manifest
+    entries."""
+    if sink is None:
+        sink = DirectorySink()
+    if profile is None:
+        profile = Profile()
+    dataset = plan["dataset"]
+    records = {}
+
+    participants = dataset["participants"]
+    if participants is not None and not is_current(
+            manifest, participants["dest"], participants["inputs"],
+            participants["options"]):
+        with profile.stage("participants"):
+            profile.count("pandas_reads",
+                          convert_participants(participants, sink))
+        record(records, manifest, participants["dest"],
+               participants["inputs"], participants["options"])
+
+    stage = profile.stage("metadata")
+    records.update(write_sidecars(dataset["sidecars"], manifest, sink))
+
+    description = dataset["description"]
+    if not is_current(manifest, description["dest"], description["inputs"]):
+        convert_dataset_metadata(plan["source_dir"], plan["dest_dir"],
+                                 sink=sink, found=description["found"])
+        record(records, manifest, description["dest"],
+               description["inputs"])
+
+    changes = dataset["changes"]
+    if changes is not None and not is_current(
+            manifest, changes["dest"], changes["inputs"], changes["options"]):
+        if changelog_converter is None:
+            changelog_converter = resolve_function(
+                plan["options"]["changelog_converter"])
+        sink.write_with(partial(changelog_converter, changes["inputs"][0]),
+                        changes["dest"])
+        record(records, manifest, changes["dest"], changes["inputs"],
+               changes["options"])
+    stage.stop()
+    return records
+
+
+def plan_manifest(plan):
+    """The manifest of a plan; shards of a split plan each keep their own
+    so that they can run at the same time."""
+    name = MANIFEST_NAME
+    if plan.get("shard"):
+        name = name.replace(".json", ".shard-%d-of-%d.json"%tuple(plan["shard"]))
+    return Manifest(plan["dest_dir"], name=name)
+
+
+def run_settings(settings=None, **kwargs):
+    """The settings of execute_plan(): RUN_SETTINGS updated with settings
+    (a dict) and kwargs. Raises a TypeError for unknown settings."""
+    settings = dict(settings or {}, **kwargs)
+    unknown = sorted(set(settings) - set(RUN_SETTINGS))
+    if unknown:
+        raise TypeError("Unknown settings: %s"%", ".join(unknown))
+    return dict(RUN_SETTINGS, **settings)
+
+
+def execute_plan(plan, settings=None, warning=print,
+                 changelog_converter=None, sink=None, profile=None):
+    """Carries out a plan made by make_plan() (or a shard of one) with
+    settings (a dict, see run_settings()), writing the outputs to sink (a
+    DirectorySink by default) and the stage timings and counters to profile.
+    Dataset level files are written once, by the calling process, after all
+    subjects. changelog_converter defaults to the function named in the
+    plan and warning has to be picklable (e.g. a module level function)
+    with jobs > 1.
+
+    Returns a summary dict with the number of filesystem calls used to
+    index the source ("stat_count"), the images each transfer mechanism
+    handled ("nii_handling"), the per file transfer results ("transfers")
+    and their "throughput", the "profile", the peak resident memory in MB
+    ("peak_rss_mb") and, if enabled, the "cache" lookups and the
+    validation "issues".
+    """
+    settings = run_settings(settings)
+    jobs = settings["jobs"]
+    incremental = settings["incremental"]
+    checksums, dedup = settings["checksums"], settings["dedup"]
+    only, cache = settings["only"], settings["cache"]
+    cprofile = settings["cprofile"]
+    check_plan(plan)
+    if sink is None:
+        sink = DirectorySink()
+    if (jobs > 1 and not sink.local) or (incremental and not sink.incremental):
+        raise ValueError("%s output cannot be written by several jobs or "
+                         "incrementally"%type(sink).__name__)
+    options = plan["options"]
+    nii_handling = options["nii_handling"]
+    if (checksums or dedup) and not sink.local:
+        raise ValueError("Checksums can only be written to a local folder")
+    if settings["validate"] and not sink.local:
+        raise ValueError("Only outputs in a local folder can be validated")
+    if only is not None and (only not in ONLY_OPTS or not sink.local):
+        raise ValueError("only has to be one of %s and needs a local sink"%
+                         ", ".join(ONLY_OPTS))
+    if dedup and (not checksums or nii_handling not in ['copy', 'reflink']):
+        raise ValueError("dedup needs checksums and nii_handling 'copy' or "
+                         "'reflink'")
+    if dedup and jobs > 1:
+        raise ValueError("dedup cannot be combined with jobs > 1")
+    manifest = plan_manifest(plan) if incremental else None
+    if profile is None:
+        profile = Profile()
+    summary = {"stat_count": plan["stat_count"], "nii_handling": Counter(),
+               "transfers": [], "digests": {}}
+    if cache is not None:
+        summary["cache"] = Counter()
+    index = None
+    if checksums:
+        index = ContentIndex(checksums, dedup=dedup)
+
+    def subject_call(subject):
+        """convert_subject, or run_profiled(convert_subject) for the
+        cprofile subject, and its positional arguments."""
+        if cprofile and cprofile[0] in [subject["bids"], subject["openfmri"]]:
+            return run_profiled, (cprofile[1], convert_subject, subject,
+                                  options)
+        return convert_subject, (subject, options)
+
+    sink.mkdir(plan["dest_dir"])
+    subjects = plan["subjects"]
+    if only is not None:
+        converted = [subject for subject in subjects
+                     if path.isdir(subject["directories"][0])]
+        if len(converted) < len(subjects):
+            warning("%s: not converted yet, skipped: %s"%(
+                plan["dest_dir"], ", ".join(subject["bids"] for subject in
+                                            subjects
+                                            if subject not in converted)))
+        subjects = converted
+    start = time.time()
+    if jobs > 1 and len(subjects) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(subjects))) as executor:
+            futures = {}
+            for subject in subjects:
+                func, args = subject_call(subject)
+                futures[executor.submit(func, *args, warning=warning,
+                                        manifest=manifest, sink=sink,
+                                        index=index,
+                                        settings=settings)] = subject
+            for future in as_completed(futures):
+                collect_subject_result(summary, manifest, future.result(),
+                                       profile, futures.pop(future))
+    else:
+        # one queue for all subjects so images keep being copied while the
+        # events of the next subjects are processed
+        transfers = TransferQueue(image_transfer(sink, nii_handling, index),
+                                  workers=settings["transfer_jobs"])
+        for subject in subjects:
+            func, args = subject_call(subject)
+            collect_subject_result(summary, manifest,
+                                   func(*args, warning=warning,
+                                        manifest=manifest,
+                                        transfers=transfers, sink=sink,
+                                        settings=settings),
+                                   profile, subject)
+        result = {"records": {}, "nii_handling": Counter(), "transfers": []}
+        add_transfer_results(result, transfers.wait(), manifest, nii_handling)
+        collect_subject_result(summary, manifest, result)
+    summary["throughput"] = throughput_report(
+        summary["transfers"], time.time() - start)
+    add_image_profiles(profile, summary["transfers"])
+    logger.info("Images handled (nii_handling=%s): %s", nii_handling,
+                ", ".join("%s: %d"%item for item in
+                          sorted(summary["nii_handling"].items())))
+    logger.info("Transferred %d images (%d bytes) in %.1fs (%.1f MB/s)",
+                summary["throughput"]["files"], summary["throughput"]["bytes"],
+                summary["throughput"]["wall_seconds"],
+                summary["throughput"]["mb_per_s"] or 0)
+
+    if cache is not None:
+        evicted = cache.stats["evicted"]
+        cache.trim()
+        summary["cache"]["evicted"] += cache.stats["evicted"] - evicted
+        summary["cache"] = cache_report(summary["cache"])
+        logger.info("Table cache: %d hits, %d misses, %d evicted",
+                    summary["cache"]["hits"], summary["cache"]["misses"],
+                    summary["cache"]["evicted"])
+
+    if plan["dataset"] is not None and only != "events":
+        save_records(manifest, convert_dataset_files(
+            plan, changelog_converter=changelog_converter,
+            manifest=manifest, sink=sink, profile=profile))
+    digests = summary.pop("digests")
+    if checksums:
+        with profile.stage("checksums"):
+            profile.count("checksum_files", write_checksums(
+                plan["dest_dir"], digests, checksums))
+    if settings["validate"]:
+        with profile.stage("validate"):
+            summary["issues"] = validate_plan(plan)
+        write_report(summary["issues"], report_path(plan))
+        logger.info("Validation: %d errors, %d warnings",
+                    len(errors(summary["issues"])),
+                    len(summary["issues"]) - len(errors(summary["issues"])))
+    summary["profile"] = profile.to_dict()
+    summary["peak_rss_mb"] = peak_rss_mb()
+    if summary["peak_rss_mb"] is not None:
+        logger.info("Peak memory: %.1f MB", summary["peak_rss_mb"])
+    return summary
+
+
+def convert(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0],
+            warning=print, ses="", changelog_converter=convert_changelog,
+            behav_tolerance=0.1, sink=None, **settings):
+    """Converts an OpenfMRI dataset to BIDS: make_plan() (the "scan"
+    stage) followed by execute_plan() with settings (see run_settings()).
+
+    behavdata.txt rows are matched to the events nearest in onset within
+    behav_tolerance seconds.
+    """
+    return convert_sessions([(ses, source_dir)], dest_dir,
+                            nii_handling=nii_handling, warning=warning,
+                            changelog_converter=changelog_converter,
+                            behav_tolerance=behav_tolerance, sink=sink,
+                            **settings)
+
+
+def convert_sessions(sessions, dest_dir, nii_handling=NII_HANDLING_OPTS[0],
+                     warning=print, changelog_converter=convert_changelog,
+                     behav_tolerance=0.1, sink=None, **settings):
+    """Converts a dataset whose sessions are separate OpenfMRI datasets,
+    given as (session label, source folder) pairs, in a single
+    execute_plan() of make_sessions_plan(): subjects of all sessions are
+    converted together (jobs at a time) and dataset level files are
+    written once. See convert() for the options.
+    """
+    settings = run_settings(**settings)
+    profile = Profile()
+    with profile.stage("scan"):
+        plan = make_sessions_plan(sessions, dest_dir,
+                                  nii_handling=nii_handling,
+                                  behav_tolerance=behav_tolerance,
+                                  changelog_converter=changelog_converter,
+                                  warning=warning,
+                                  io_jobs=settings["io_jobs"])
+    # the scan of each subject's folder is accounted for to the subject
+    subject_calls = 0
+    for subject in plan["subjects"]:
+        profile.child(subject["bids"]).count("fs_calls",
+                                             subject["stat_count"])
+        subject_calls += subject["stat_count"]
+    profile.count("fs_calls", plan["stat_count"] - subject_calls)
+    return execute_plan(plan, settings, warning=warning,
+                        changelog_converter=changelog_converter, sink=sink,
+                        profile=profile)
@@ -0,0 +1,188 @@
+"""
+Turning parsed OpenfMRI condition files into BIDS events tables.
+"""
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from .tsv import frame_to_tsv
+
+EVENT_KEYS = ["onset", "duration", "trial_type"]
+
+
+def label_conditions(condition_tables):
+    """Adds trial_type to onset/duration/weight tables and turns weights
+    into parametric columns (named after the condition) unless they are
+    all 1.
+
+    condition_tables is a list of (condition name, DataFrame) pairs.
+    Returns the labeled DataFrames and the names of the parametric columns.
+    """
+    dfs = []
+    parametric_columns = []
+    for condition_name, df in condition_tables:
+        df = df.copy()
+        df["trial_type"] = condition_name
+        weights = df["weight"].unique()
+        if not (len(weights) == 1 and weights[0] == 1):
+            df[condition_name] = df["weight"]
+            parametric_columns.append(condition_name)
+        dfs.append(df.drop("weight", axis=1))
+    return dfs, parametric_columns
+
+
+def merge_conditions(dfs):
+    """Stacks labeled condition tables into one table.
+
+    Tables of equal length are ordered by onset, duration and trial_type,
+    which is what successive outer merges on those keys produce when the
+    trial types differ, at the cost of a single sort. Tables sharing a
+    trial type still go through the merges since their rows can match.
+    """
+    if len(dfs) == 1:
+        return dfs[0]
+    if len(set(len(df) for df in dfs)) != 1:
+        return pd.concat(dfs, ignore_index=True)
+    trial_types = [df["trial_type"].iloc[0] for df in dfs if len(df)]
+    if len(set(trial_types)) != len(trial_types):
+        return reduce(lambda left, right: pd.merge(left, right, on=EVENT_KEYS,
+                                                   how="outer"), dfs)
+    events_df = pd.concat(dfs, ignore_index=True)
+    return events_df.sort_values(EVENT_KEYS,
+                                 kind="mergesort").reset_index(drop=True)
+
+
+def fold_response_times(events_df):
+    """Moves the durations of *RT trial types into an RT column of all
+    events with the same onset (a zero duration means no response) and
+    drops the *RT rows. Where several RT rows share an onset the last one
+    (in order of first appearance of the trial type) wins.
+    """
+    is_rt = events_df["trial_type"].str.endswith("RT")
+    rt_rows = events_df.loc[is_rt & events_df["onset"].notnull(),
+                            ["onset", "duration", "trial_type"]]
+    trial_type_order = dict((trial_type, i) for i, trial_type in
+                            enumerate(events_df["trial_type"].unique()))
+    rt_rows = rt_rows.assign(
+        order=rt_rows["trial_type"].map(trial_type_order)).sort_values(
+        "order", kind="mergesort").drop_duplicates("onset", keep="last")
+    response_times = rt_rows["duration"].where(rt_rows["duration"] != 0)
+    response_times.index = rt_rows["onset"]
+
+    events_df = events_df.copy()
+    events_df["RT"] = events_df["onset"].map(response_times).astype(
+        np.float64)
+    events_df = events_df.dropna(axis=1, how='all')
+    return events_df[~is_rt]
+
+
+def build_events(condition_tables, warning=print):
+    """Builds the events table of a run from its parsed condition files.
+
+    condition_tables is a list of (condition name, DataFrame with onset,
+    duration and weight columns) pairs, e.g. from read_onsets_batch().
+    Weights become parametric columns, *RT conditions are folded into an
+    RT column, duplicated parametric events are dropped (keeping the one
+    with a parametric value) and zero duration events are removed. Returns
+    None if there are no condition tables.
+    """
+    if not condition_tables:
+        return None
+    dfs, parametric_columns = label_conditions(condition_tables)
+    events_df = merge_conditions(dfs)
+
+    pre_len = len(events_df["onset"].unique())
+    events_df = fold_response_times(events_df)
+    if parametric_columns:
+        events_df = events_df.sort_values(parametric_columns,
+                                          na_position="first").drop_duplicates(
+            ["onset", "duration"], keep='last')
+    # remove rows with zero duration:
+    if (events_df.duration == 0).sum() > 0:
+        warning(str(events_df[events_df.duration == 0]))
+        events_df = events_df[events_df.duration != 0]
+    assert pre_len == len(events_df["onset"].unique())
+    return events_df
+
+
+def pair_onsets(onsets, other_onsets, tolerance):
+    """Pairs two sorted onset arrays one-to-one within tolerance seconds.
+
+    A single walk over both arrays pairs every onset with the first
+    unpaired onset of the other array in reach, which pairs as many onsets
+    as possible. Returns, for every onset, the position of its pair in
+    other_onsets (-1 if it has none).
+    """
+    pairs = np.full(len(onsets), -1, dtype=np.int64)
+    i = j = 0
+    while i < len(onsets) and j < len(other_onsets):
+        if other_onsets[j] < onsets[i] - tolerance:
+            j += 1
+        elif onsets[i] < other_onsets[j] - tolerance:
+            i += 1
+        else:
+            pairs[i] = j
+            i += 1
+            j += 1
+    return pairs
+
+
+def align_behav(events_df, beh_df, tolerance=0.1):
+    """Joins behavdata rows (with an Onset column) to the events within
+    tolerance seconds of their onset.
+
+    Events and behavdata rows are paired one-to-one in onset order (see
+    pair_onsets()), so the result has one row per event plus one row per
+    behavdata row no event was paired with. The onset of matched rows is
+    the average of the two onsets since we do not know which one is true.
+    Returns the joined table and a report with the onsets of the unmatched
+    events and behavdata rows.
+    """
+    left = events_df.reset_index(drop=True)
+    left = left.assign(onset=left["onset"].astype(np.float64))
+    right = beh_df.reset_index(drop=True)
+    right = right.assign(Onset=right["Onset"].astype(np.float64),
+                         behav_row=np.arange(len(right)))
+    left_suffixes = dict((c, c + "_x") for c in right.columns
+                         if c in left.columns)
+    right_suffixes = dict((c, c + "_y") for c in left.columns
+                          if c in right.columns)
+
+    left_keyed = left[left["onset"].notnull()].sort_values(
+        "onset", kind="mergesort").reset_index(drop=True)
+    right_keyed = right[right["Onset"].notnull()].sort_values(
+        "Onset", kind="mergesort").reset_index(drop=True)
+    pairs = pair_onsets(left_keyed["onset"].to_numpy(),
+                        right_keyed["Onset"].to_numpy(), float(tolerance))
+    # unpaired events get a row of missing values
+    matched = pd.concat([left_keyed.rename(columns=left_suffixes),
+                         right_keyed.rename(columns=right_suffixes).reindex(
+                             pairs).reset_index(drop=True)], axis=1)
+
+    unmatched_events = left[left["onset"].isnull()].rename(
+        columns=left_suffixes)
+    unmatched_behav = right[~right["behav_row"].isin(
+        matched["behav_row"])].rename(columns=right_suffixes)
+    report = {"unmatched_events": (
+                  matched.loc[matched["behav_row"].isnull(), "onset"].tolist() +
+                  unmatched_events["onset"].tolist()),
+              "unmatched_behav": unmatched_behav["Onset"].tolist()}
+
+    # empty frames would turn integer columns into floats
+    all_df = pd.concat([matched] + [df for df in (unmatched_events,
+                                                  unmatched_behav) if len(df)],
+                       ignore_index=True)
+    all_df["onset"] = all_df["onset"].fillna(all_df["Onset"])
+    all_df["Onset"] = all_df["Onset"].fillna(all_df["onset"])
+    all_df["onset"] = (all_df["onset"] + all_df["Onset"]) / 2.0
+    return all_df.drop(["Onset", "behav_row"], axis=1), report
+
+
+def events_tsv(events_df):
+    """Text of the events file of a run: RT renamed to response_time, rows
+    ordered by onset, onset, duration and trial_type first, missing values
+    as n/a and floats with 3 decimals."""
+    return frame_to_tsv(events_df, first=EVENT_KEYS, sort_by="onset",
+                        rename={"RT": "response_time"}, float_format="%.3f",
+                        na_rep="n/a")
@@ -0,0 +1,96 @@
+"""
+In-memory inventory of an OpenfMRI source tree.
+"""
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+
+class SourceIndex(object):
+    """Single pass inventory of the parts of an OpenfMRI dataset that the
+    converter looks at: the top level folder, sub*/BOLD, sub*/anatomy,
+    sub*/model/model001/onsets and sub*/behav.
+
+    All lookups are answered from memory. Sizes are only collected for the
+    onset and behavdata files (the converter skips empty ones). stat_count
+    is the number of filesystem calls (directory listings and stats) the
+    scan issued, subject_stat_counts has them per subject folder (and ""
+    for the top level folder).
+
+    With jobs > 1 the subject folders are scanned by that many threads, to
+    overlap the latency of the listings on network filesystems.
+    """
+
+    def __init__(self, source_dir, jobs=1):
+        self.source_dir = source_dir
+        self.stat_count = 0
+        self.subject_stat_counts = Counter()
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._scan(jobs)
+        del self._lock
+
+    def _scandir(self, reldir, with_sizes=False):
+        """Lists one directory into the index and returns its subfolders."""
+        n_calls = 1
+        try:
+            entries = list(os.scandir(os.path.join(self.source_dir, reldir)))
+        except OSError:
+            entries = None
+        listing = {}
+        subdirs = []
+        for entry in entries or []:
+            if entry.is_dir():
+                listing[entry.name] = None
+                subdirs.append(entry.name)
+            elif with_sizes:
+                n_calls += 1
+                listing[entry.name] = entry.stat().st_size
+            else:
+                listing[entry.name] = None
+        with self._lock:
+            self.stat_count += n_calls
+            self.subject_stat_counts[reldir.split(os.sep)[0]] += n_calls
+            if entries is not None:
+                self._dirs[reldir] = listing
+        return sorted(subdirs)
+
+    def _scan_subject(self, subject):
+        self._scandir(subject)
+        for run_dir in self._scandir(os.path.join(subject, "BOLD")):
+            self._scandir(os.path.join(subject, "BOLD", run_dir))
+        self._scandir(os.path.join(subject, "anatomy"))
+        onsets_dir = os.path.join(subject, "model", "model001", "onsets")
+        for run_dir in self._scandir(onsets_dir):
+            self._scandir(os.path.join(onsets_dir, run_dir), with_sizes=True)
+        for run_dir in self._scandir(os.path.join(subject, "behav")):
+            self._scandir(os.path.join(subject, "behav", run_dir),
+                          with_sizes=True)
+
+    def _scan(self, jobs):
+        subjects = [subject for subject in self._scandir("")
+                    if fnmatch(subject, "sub*")]
+        if jobs > 1 and len(subjects) > 1:
+            with ThreadPoolExecutor(max_workers=min(jobs, len(subjects))) \
+                    as executor:
+                list(executor.map(self._scan_subject, subjects))
+        else:
+            for subject in subjects:
+                self._scan_subject(subject)
+
+    def path(self, *parts):
+        return os.path.join(self.source_dir, *parts)
+
+    def listdir(self, *parts):
+        """Sorted names in an indexed folder (empty if it was not found)."""
+        return sorted(self._dirs.get(os.path.join("", *parts), {}))
+
+    def exists(self, *parts):
+        return parts[-1] in self._dirs.get(os.path.join("", *parts[:-1]), {})
+
+    def getsize(self, *parts):
+        """Size of an indexed file, None if it does not exist or its size
+        was not collected."""
+        return self._dirs.get(os.path.join("", *parts[:-1]), {}).get(parts[-1])
@@ -0,0 +1,170 @@
+"""
+Output manifest used for incremental (resumable) conversion and the
+checksum manifest of an output dataset.
+"""
+import hashlib
+import json
+import os
+
+from . import __version__
+from .transfer import hash_file
+
+MANIFEST_NAME = ".openfmri2bids_manifest.json"
+
+CHECKSUMS_NAME = ".openfmri2bids_checksums"
+
+# images are tracked by size and mtime only, other inputs are hashed too
+IMAGE_SUFFIXES = (".nii", ".nii.gz")
+
+
+def _sha1(fpath):
+    sha1 = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_signature(fpath, digest=_sha1):
+    """Size, mtime and (except for images) sha1 of a file, None if missing.
+    digest computes the sha1 of a file path."""
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    signature = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if not fpath.endswith(IMAGE_SUFFIXES):
+        signature["sha1"] = digest(fpath)
+    return signature
+
+
+def signature_matches(fpath, recorded, digest=_sha1):
+    """Checks a file against a recorded signature. A changed mtime alone
+    does not count as a change if the recorded hash still matches."""
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return recorded is None
+    if recorded is None or st.st_size != recorded["size"]:
+        return False
+    if st.st_mtime_ns == recorded["mtime_ns"]:
+        return True
+    return "sha1" in recorded and digest(fpath) == recorded["sha1"]
+
+
+class Manifest(object):
+    """Maps every output (relative to dest_dir) to the signatures of the
+    inputs it was made from, the options used and the converter version.
+
+    Workers only read from a Manifest and hand new entries back (see
+    entry()), the owning process merges them with update() and persists
+    them with save().
+
+    The hashes of inputs are kept for the lifetime of the Manifest (i.e. a
+    run), so key files many outputs depend on are only hashed once.
+    """
+
+    def __init__(self, dest_dir, name=MANIFEST_NAME):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, name)
+        self.entries = {}
+        self._digests = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def _digest(self, fpath):
+        """sha1 of fpath, computed once per size and mtime of the file."""
+        st = os.stat(fpath)
+        key = (fpath, st.st_size, st.st_mtime_ns)
+        if key not in self._digests:
+            self._digests[key] = _sha1(fpath)
+        return self._digests[key]
+
+    def _relpath(self, output):
+        return os.path.relpath(output, self.dest_dir)
+
+    def is_current(self, output, inputs, options=None):
+        """True if output exists and was made by this converter version,
+        with the same options, from unchanged inputs."""
+        entry = self.entries.get(self._relpath(output))
+        if entry is None or not os.path.lexists(output):
+            return False
+        if entry["version"] != __version__ or entry["options"] != options:
+            return False
+        if sorted(entry["inputs"]) != sorted(inputs):
+            return False
+        return all(signature_matches(fpath, entry["inputs"][fpath],
+                                     digest=self._digest)
+                   for fpath in inputs)
+
+    def entry(self, output, inputs, options=None):
+        """Returns a {relative output path: entry} dict for update()."""
+        return {self._relpath(output): {
+            "version": __version__,
+            "options": options,
+            "inputs": dict((fpath, file_signature(fpath, digest=self._digest))
+                           for fpath in inputs)
+        }}
+
+    def update(self, entries):
+        self.entries.update(entries)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, sort_keys=True, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def checksums_path(dest_dir, algorithm):
+    return os.path.join(dest_dir, "%s.%s"%(CHECKSUMS_NAME, algorithm))
+
+
+def read_checksums(dest_dir, algorithm):
+    """{relative path: digest} of a checksum manifest, empty if missing."""
+    checksums = {}
+    fpath = checksums_path(dest_dir, algorithm)
+    if os.path.exists(fpath):
+        with open(fpath) as f:
+            for line in f:
+                digest, relpath = line.rstrip("\n").split("  ", 1)
+                checksums[relpath] = digest
+    return checksums
+
+
+def write_checksums(dest_dir, digests, algorithm):
+    """Writes the checksum manifest of dest_dir (in the format of sha256sum
+    and b2sum, relative to dest_dir) and returns the number of files hashed
+    for it.
+
+    digests ({path: digest}) are the images transferred (and hashed) in this
+    run. Other images keep the digest of the previous manifest, if any, and
+    all remaining files (the metadata and events, which are small) are
+    hashed here. Hidden files in dest_dir are left out.
+    """
+    previous = read_checksums(dest_dir, algorithm)
+    digests = dict((os.path.relpath(fpath, dest_dir).replace(os.sep, "/"),
+                    digest) for fpath, digest in digests.items())
+    checksums = {}
+    n_hashed = 0
+    for root, dirs, files in os.walk(dest_dir):
+        if root == dest_dir:
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            files = [name for name in files if not name.startswith(".")]
+        for name in files:
+            fpath = os.path.join(root, name)
+            relpath = os.path.relpath(fpath, dest_dir).replace(os.sep, "/")
+            if relpath in digests:
+                checksums[relpath] = digests[relpath]
+            elif name.endswith(".nii.gz") and relpath in previous:
+                checksums[relpath] = previous[relpath]
+            else:
+                checksums[relpath] = hash_file(fpath, algorithm)
+                n_hashed += 1
+    tmp_path = checksums_path(dest_dir, algorithm) + ".tmp"
+    with open(tmp_path, "w") as f:
+        for relpath in sorted(checksums):
+            f.write("%s  %s\n"%(checksums[relpath], relpath))
+    os.replace(tmp_path, checksums_path(dest_dir, algorithm))
+    return n_hashed
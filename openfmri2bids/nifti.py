@@ -0,0 +1,174 @@
+"""
+Header-only checks and repairs of the repetition time of NIfTI-1 images.
+
+Only the 348 byte header is read (for .nii.gz only the compressed blocks
+it is in). A repair rewrites pixdim[4] and the time unit of xyzt_units:
+in place for .nii files, and by streaming the decompressed data through a
+new gzip stream for .nii.gz files, so the voxel data is never held in
+memory. The new stream is compressed at the level the original one was
+(as far as its header tells, see gzip_compresslevel()).
+"""
+import gzip
+import os
+import shutil
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+
+from .inventory import SourceIndex
+from .plan import read_scan_parameters
+from .transfer import CHUNK_SIZE
+
+HEADER_SIZE = 348
+DIM_OFFSET = 40
+PIXDIM_OFFSET = 76
+XYZT_UNITS_OFFSET = 123
+
+SPATIAL_UNITS_MASK = 0x07
+TIME_UNITS = {0: "unknown", 8: "sec", 16: "msec", 24: "usec"}
+TIME_UNIT_SECONDS = {"sec": 1.0, "msec": 1e-3, "usec": 1e-6}
+SEC = 8
+
+GZIP_XFL_OFFSET = 8
+# compression levels of the XFL byte of gzip headers, any other level of
+# zlib leaves it 0
+XFL_COMPRESSLEVELS = {2: 9, 4: 1}
+DEFAULT_COMPRESSLEVEL = 6
+
+# float32 TRs read back from a header differ from scan_key.txt by this much
+TR_TOLERANCE = 1e-5
+
+
+def _open(fpath, mode="rb"):
+    if fpath.endswith(".gz"):
+        return gzip.open(fpath, mode)
+    return open(fpath, mode)
+
+
+def read_header(fpath):
+    """The raw NIfTI-1 header of fpath and its byte order ("<" or ">")."""
+    with _open(fpath) as f:
+        header = f.read(HEADER_SIZE)
+    for endian in "<>":
+        if len(header) == HEADER_SIZE and \
+                struct.unpack(endian + "i", header[:4])[0] == HEADER_SIZE:
+            return header, endian
+    raise ValueError("%s is not a NIfTI-1 file"%fpath)
+
+
+def header_tr(header, endian):
+    """(number of dimensions, pixdim[4], time unit) of a raw header."""
+    ndim = struct.unpack(endian + "h", header[DIM_OFFSET:DIM_OFFSET + 2])[0]
+    tr = struct.unpack(endian + "f", header[PIXDIM_OFFSET + 16:
+                                            PIXDIM_OFFSET + 20])[0]
+    time_unit = TIME_UNITS.get(header[XYZT_UNITS_OFFSET] & 0x38, "other")
+    return ndim, tr, time_unit
+
+
+def set_header_tr(header, endian, tr):
+    """Returns header with pixdim[4] set to tr and the time unit to
+    seconds."""
+    units = (header[XYZT_UNITS_OFFSET] & SPATIAL_UNITS_MASK) | SEC
+    return (header[:PIXDIM_OFFSET + 16] + struct.pack(endian + "f", tr) +
+            header[PIXDIM_OFFSET + 20:XYZT_UNITS_OFFSET] +
+            bytes(bytearray([units])) + header[XYZT_UNITS_OFFSET + 1:])
+
+
+def gzip_compresslevel(fpath):
+    """Compression level of a gzip file according to the XFL byte of its
+    header: 9 (slowest), 1 (fastest) or DEFAULT_COMPRESSLEVEL otherwise."""
+    with open(fpath, "rb") as f:
+        gzip_header = f.read(GZIP_XFL_OFFSET + 1)
+    if len(gzip_header) <= GZIP_XFL_OFFSET:
+        return DEFAULT_COMPRESSLEVEL
+    return XFL_COMPRESSLEVELS.get(bytearray(gzip_header)[GZIP_XFL_OFFSET],
+                                  DEFAULT_COMPRESSLEVEL)
+
+
+def write_header(fpath, header, compresslevel=None):
+    """Replaces the header of fpath (a symlink is followed). A .nii.gz is
+    compressed again at compresslevel, by default the level it had (see
+    gzip_compresslevel())."""
+    fpath = os.path.realpath(fpath)
+    if not fpath.endswith(".gz"):
+        with open(fpath, "r+b") as f:
+            f.write(header)
+        return
+    if compresslevel is None:
+        compresslevel = gzip_compresslevel(fpath)
+    tmp_path = fpath + ".tmp"
+    try:
+        with gzip.open(fpath, "rb") as src, open(tmp_path, "wb") as raw:
+            src.read(len(header))
+            with gzip.GzipFile(filename=os.path.basename(fpath), mode="wb",
+                               fileobj=raw, compresslevel=compresslevel,
+                               mtime=src.mtime) as dst:
+                dst.write(header)
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        shutil.copymode(fpath, tmp_path)
+        os.replace(tmp_path, fpath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def check_tr(fpath, expected_tr, fix=False, compresslevel=None):
+    """Compares the TR in the header of fpath with expected_tr (in
+    seconds) and, with fix=True, repairs it. Returns a report dict with
+    file, tr, unit, expected_tr and status ("ok", "inconsistent", "fixed"
+    or "error", with an error message)."""
+    report = {"file": fpath, "tr": None, "unit": None,
+              "expected_tr": expected_tr, "status": "ok"}
+    try:
+        header, endian = read_header(fpath)
+        ndim, tr, time_unit = header_tr(header, endian)
+        report["tr"], report["unit"] = tr, time_unit
+        if ndim < 4:
+            raise ValueError("%s has %d dimensions"%(fpath, ndim))
+        if time_unit == "sec" and abs(tr - expected_tr) <= TR_TOLERANCE:
+            return report
+        report["status"] = "inconsistent"
+        if fix:
+            write_header(fpath, set_header_tr(header, endian, expected_tr),
+                         compresslevel=compresslevel)
+            report["status"] = "fixed"
+    except (OSError, ValueError) as exc:
+        report["status"] = "error"
+        report["error"] = str(exc)
+    return report
+
+
+def bold_files(source_dir, index=None):
+    """The sub*/BOLD/task*/bold.nii.gz files of an OpenfMRI dataset."""
+    if index is None:
+        index = SourceIndex(source_dir)
+    return [index.path(s, "BOLD", run, "bold.nii.gz")
+            for s in index.listdir() if fnmatch(s, "sub*")
+            for run in index.listdir(s, "BOLD") if run.startswith("task")
+            if index.exists(s, "BOLD", run, "bold.nii.gz")]
+
+
+def report_message(report):
+    """What to tell about a check_tr() report, None if its TR is ok."""
+    if report["status"] in ["inconsistent", "fixed"]:
+        return "%s TR; nifti file: %g %s, scan_key: %g sec, for %s"%(
+            report["status"], report["tr"], report["unit"],
+            report["expected_tr"], report["file"])
+    elif report["status"] == "error":
+        return "could not check %s: %s"%(report["file"], report["error"])
+    return None
+
+
+def audit_tr(source_dir, fix=False, jobs=1, compresslevel=None):
+    """Checks (and with fix=True repairs) the TR of every BOLD image of an
+    OpenfMRI dataset against scan_key.txt, jobs files at a time. Returns
+    the check_tr() reports of all files (see report_message())."""
+    expected_tr = read_scan_parameters(source_dir)["RepetitionTime"]
+    fpaths = bold_files(source_dir)
+    kwargs = dict(fix=fix, compresslevel=compresslevel)
+    if jobs > 1 and len(fpaths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(check_tr, fpath, expected_tr, **kwargs)
+                       for fpath in fpaths]
+            return [future.result() for future in futures]
+    return [check_tr(fpath, expected_tr, **kwargs) for fpath in fpaths]
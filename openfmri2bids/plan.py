@@ -0,0 +1,523 @@
+"""
+Planning stage of a conversion.
+
+make_plan() decides every output of a conversion (and the inputs each one
+is made from) by looking at the source index only, without touching the
+output folder. The plan is plain JSON so it can be printed (--dry-run),
+saved, split into shards with split_plan() and run by execute_plan() in
+converter.py, possibly on another machine.
+"""
+from __future__ import print_function
+
+import importlib
+import json
+import logging
+import os
+import re
+import tokenize
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from fnmatch import fnmatch
+
+from . import __version__
+from .inventory import SourceIndex
+
+logger = logging.getLogger(__name__)
+
+PLAN_FORMAT = 1
+
+NII_HANDLING_OPTS = ['empty', 'move', 'copy', 'link', 'hardlink', 'reflink']  # first entry is default
+
+DEFAULT_CHANGELOG_CONVERTER = "openfmri2bids.converter:convert_changelog"
+
+ANATOMY_MAPPING = OrderedDict([("highres", "T1w"),
+                               ("inplane", "inplaneT2")])
+
+# dataset level text files every events and sidecar output depends on
+KEY_FILES = [("scan_key.txt",),
+             ("task_key.txt",),
+             ("models", "model001", "condition_key.txt")]
+
+# top level files dataset_description.json and README are made from
+DESCRIPTION_FILES = ["study_key.txt", "references.txt", "license.txt",
+                     "README", "README.txt"]
+
+
+def sanitize_label(label):
+    return re.sub("[^a-zA-Z0-9]*", "", label)
+
+
+def session_labels(ses):
+    """Returns the (folder, filename) session fragments for a session label."""
+    if ses:
+        folder_ses = "ses-%s"%ses
+        filename_ses = "_%s"%folder_ses
+    else:
+        folder_ses = ""
+        filename_ses = ""
+    return folder_ses, filename_ses
+
+
+def function_name(func):
+    """"module:name" of a module level function, see resolve_function()."""
+    if not callable(func):
+        return func
+    return "%s:%s"%(func.__module__, func.__name__)
+
+
+def resolve_function(name):
+    module, attr = name.split(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def read_tasks(source_dir, index, openfmri_subjects):
+    """Runs, conditions and names of the tasks, from the BOLD folders of
+    all subjects, condition_key.txt and task_key.txt."""
+    tasks = set([s[:7] for s in index.listdir(openfmri_subjects[0], "BOLD") if s.startswith("task")])
+
+    tasks_dict = {}
+    for task in tasks:
+        runs_union = set()
+        for openfmri_s in openfmri_subjects:
+            runs_union = runs_union | set([s[8:] for s in index.listdir(openfmri_s, "BOLD") if s.startswith(task)])
+        tasks_dict[task] = {"runs": runs_union}
+
+    with tokenize.open(os.path.join(source_dir, "models", "model001", "condition_key.txt")) as f:
+        for line in f:
+            if line.strip() == "":
+                break
+            items = line.split()
+            task = items[0]
+            condition = items[1]
+            condition_name = " ".join(items[2:])
+            if "conditions" not in tasks_dict[task]:
+                tasks_dict[task]["conditions"] = {}
+            tasks_dict[task]["conditions"][condition] = condition_name
+
+    with tokenize.open(os.path.join(source_dir, "task_key.txt")) as f:
+        for line in f:
+            words = line.split()
+            if words[0] in tasks_dict.keys():
+                tasks_dict[words[0]]['name'] = " ".join(words[1:])
+    return tasks_dict
+
+
+def read_anatomy_runs(index, openfmri_subjects):
+    """Union of the anatomy file names (per ANATOMY_MAPPING type) of all
+    subjects."""
+    anatomy_runs = {}
+    for anatomy_openfmri in ANATOMY_MAPPING.keys():
+        runs_union = set()
+
+        for openfmri_s in openfmri_subjects:
+            subject_runs = [s for s in index.listdir(openfmri_s, "anatomy")
+                            if fnmatch(s, "%s*.nii.gz"%anatomy_openfmri) and
+                            len(s) in [len("%s000.nii.gz"%anatomy_openfmri),
+                                       len("%s.nii.gz"%anatomy_openfmri)]]
+            runs_union = runs_union | set(subject_runs)
+
+        anatomy_runs[anatomy_openfmri] = sorted(list(runs_union))
+    return anatomy_runs
+
+
+def read_scan_parameters(source_dir):
+    scan_parameters_dict = OrderedDict()
+    with tokenize.open(os.path.join(source_dir, "scan_key.txt")) as f:
+        for line in f:
+            items = line.split()
+            if items[0] == "TR":
+                scan_parameters_dict["RepetitionTime"] = float(items[1])
+    return scan_parameters_dict
+
+
+def plan_subject(index, dest_dir, openfmri_s, BIDS_s, tasks_dict,
+                 anatomy_runs, ses="", warning=print):
+    """Directories, images and events of a single subject.
+
+    Images are {"src", "dest"} pairs. Events are {"dest", "inputs",
+    "conditions", "behav"} where conditions are the (onset file, condition
+    name) pairs to read, behav the behavdata.txt to merge (if any) and
+    inputs every file the events depend on, present or not. "stat_count"
+    is the number of filesystem calls used to index the subject's folder.
+    """
+    folder_ses, filename_ses = session_labels(ses)
+    key_files = [index.path(*parts) for parts in KEY_FILES]
+    subject = {"openfmri": openfmri_s, "bids": BIDS_s,
+               "directories": [path.join(dest_dir, BIDS_s)],
+               "images": [], "events": [],
+               "stat_count": index.subject_stat_counts[openfmri_s]}
+    func_dir = path.join(dest_dir, BIDS_s, folder_ses, "func")
+    anat_dir = path.join(dest_dir, BIDS_s, folder_ses, "anat")
+
+    for task in sorted(tasks_dict.keys()):
+        runs = tasks_dict[task]["runs"]
+        for run in sorted(runs):
+            if func_dir not in subject["directories"]:
+                subject["directories"].append(func_dir)
+            if len(runs) == 1:
+                trg_run = ""
+            else:
+                trg_run = "_run-%s"%run[4:]
+            prefix = path.join(func_dir, "%s%s_task-%s%s"%(
+                BIDS_s, filename_ses, sanitize_label(tasks_dict[task]['name']),
+                trg_run))
+            src_parts = (openfmri_s, "BOLD", "%s_%s"%(task, run), "bold.nii.gz")
+            src = index.path(*src_parts)
+            if not index.exists(*src_parts):
+                warning("%s does not exist"%src)
+            else:
+                subject["images"].append({"src": src,
+                                          "dest": prefix + "_bold.nii.gz"})
+
+            events = {"dest": prefix + "_events.tsv", "inputs": list(key_files),
+                      "conditions": [], "behav": None}
+            for condition_id, condition_name in tasks_dict[task]["conditions"].items():
+                # TODO: check if onsets are in seconds
+                fpath_parts = (openfmri_s,
+                               "model",
+                               "model001",
+                               "onsets",
+                               "%s_%s"%(task, run),
+                               "%s.txt"%condition_id)
+                fpath = index.path(*fpath_parts)
+                events["inputs"].append(fpath)
+                fsize = index.getsize(*fpath_parts)
+                if fsize is None:
+                    warning("%s does not exist"%fpath)
+                elif fsize == 0:
+                    warning("%s is empty"%fpath)
+                else:
+                    events["conditions"].append([fpath, condition_name])
+
+            beh_parts = (openfmri_s,
+                         "behav",
+                         "%s_%s"%(task, run),
+                         "behavdata.txt")
+            beh_path = index.path(*beh_parts)
+            events["inputs"].append(beh_path)
+            beh_size = index.getsize(*beh_parts)
+            if beh_size == 0:
+                warning("%s is empty"%beh_path)
+            elif beh_size is not None:
+                events["behav"] = beh_path
+            subject["events"].append(events)
+
+    subject["directories"].append(anat_dir)
+    for anatomy_openfmri, anatomy_bids in ANATOMY_MAPPING.items():
+        runs_union = anatomy_runs[anatomy_openfmri]
+
+        for run_idx, run in enumerate(runs_union):
+            if len(runs_union) == 1:
+                trg_run = ""
+            else:
+                trg_run = "_run-%02d"%(run_idx+1)
+
+            dst = path.join(anat_dir,
+                            "%s%s%s_%s.nii.gz"%(BIDS_s, filename_ses, trg_run, anatomy_bids))
+            src = index.path(openfmri_s, "anatomy", "%s"%run)
+            if index.exists(openfmri_s, "anatomy", run):
+                subject["images"].append({"src": src, "dest": dst})
+            else:
+                warning("%s does not exist"%src)
+    return subject
+
+
+def plan_dataset(index, source_dir, dest_dir, openfmri_subjects,
+                 BIDS_subjects, subject_template, tasks_dict,
+                 scan_parameters_dict, changelog_converter, warning=print):
+    """Dataset level outputs: participants.tsv, task sidecars,
+    dataset_description.json (and README) and CHANGES."""
+    key_files = [index.path(*parts) for parts in KEY_FILES]
+    dataset = {"participants": None, "sidecars": [], "description": None,
+               "changes": None}
+
+    dem_file = os.path.join(source_dir, "demographics.txt")
+    if not index.exists("demographics.txt"):
+        warning("%s does not exist"%dem_file)
+    else:
+        dataset["participants"] = {
+            "dest": os.path.join(dest_dir, "participants.tsv"),
+            "inputs": [dem_file],
+            "options": {"subjects": openfmri_subjects},
+            "subject_template": subject_template,
+            "subjects": [[openfmri_s, BIDS_s] for openfmri_s, BIDS_s in
+                         zip(openfmri_subjects, BIDS_subjects)]}
+
+    for task in sorted(tasks_dict.keys()):
+        content = OrderedDict(scan_parameters_dict)
+        content["TaskName"] = tasks_dict[task]['name']
+        dataset["sidecars"].append({
+            "dest": os.path.join(dest_dir,
+                                 "task-%s_bold.json"%(sanitize_label(tasks_dict[task]['name']))),
+            "inputs": key_files,
+            "content": content})
+
+    dataset["description"] = {
+        "dest": os.path.join(dest_dir, "dataset_description.json"),
+        "inputs": [os.path.join(source_dir, fname) for fname in
+                   DESCRIPTION_FILES],
+        "found": [fname for fname in DESCRIPTION_FILES
+                  if index.exists(fname)]}
+
+    if index.exists("release_history.txt"):
+        dataset["changes"] = {
+            "dest": os.path.join(dest_dir, "CHANGES"),
+            "inputs": [os.path.join(source_dir, "release_history.txt")],
+            "options": {
+                "changelog_converter": changelog_converter.split(":")[-1]}}
+    return dataset
+
+
+def scan_source(source_dir, io_jobs=1):
+    """Indexes an OpenfMRI dataset (io_jobs subject folders at a time, see
+    SourceIndex) and reads its subjects, tasks, anatomy runs and scan
+    parameters."""
+    index = SourceIndex(source_dir, jobs=io_jobs)
+    logger.info("Indexed %s with %d filesystem calls", source_dir,
+                index.stat_count)
+
+    openfmri_subjects = [s for s in index.listdir() if fnmatch(s, "sub*")]
+    logger.debug("OpenfMRI subject IDs: %s", openfmri_subjects)
+    tasks_dict = read_tasks(source_dir, index, openfmri_subjects)
+    logger.debug("Tasks: %s", tasks_dict)
+    return {"index": index,
+            "subjects": openfmri_subjects,
+            "tasks": tasks_dict,
+            "anatomy_runs": read_anatomy_runs(index, openfmri_subjects),
+            "scan_parameters": read_scan_parameters(source_dir)}
+
+
+def subject_template(openfmri_subjects):
+    """BIDS subject label template, zero padded to the number of
+    subjects."""
+    n_digits = len(str(len(openfmri_subjects)))
+    return "sub-%0" + str(n_digits) + "d"
+
+
+def plan_header(source_dir, dest_dir, stat_count, options):
+    return {"format": PLAN_FORMAT,
+            "version": __version__,
+            "source_dir": source_dir,
+            "dest_dir": dest_dir,
+            "stat_count": stat_count,
+            "options": options}
+
+
+def make_plan(source_dir, dest_dir, nii_handling=NII_HANDLING_OPTS[0],
+              ses="", behav_tolerance=0.1,
+              changelog_converter=DEFAULT_CHANGELOG_CONVERTER,
+              warning=print, io_jobs=1):
+    """Plans the conversion of an OpenfMRI dataset to BIDS.
+
+    Only source_dir is read (io_jobs subject folders at a time).
+    changelog_converter is a module level function or its "module:name".
+    Returns a JSON serializable dict, see plan_subject() and plan_dataset()
+    for its "subjects" and "dataset".
+    """
+    scan = scan_source(source_dir, io_jobs=io_jobs)
+    index = scan["index"]
+    openfmri_subjects = scan["subjects"]
+    template = subject_template(openfmri_subjects)
+    BIDS_subjects = [template%int(s[-3:]) for s in openfmri_subjects]
+    logger.debug("BIDS subject IDs: %s", BIDS_subjects)
+    changelog_converter = function_name(changelog_converter)
+
+    plan = plan_header(source_dir, dest_dir, index.stat_count,
+                       {"nii_handling": nii_handling,
+                        "ses": ses,
+                        "behav_tolerance": behav_tolerance,
+                        "scan_parameters": scan["scan_parameters"],
+                        "changelog_converter": changelog_converter})
+    plan["subjects"] = [plan_subject(index, dest_dir, openfmri_s, BIDS_s,
+                                     scan["tasks"], scan["anatomy_runs"],
+                                     ses=ses, warning=warning)
+                        for openfmri_s, BIDS_s in zip(openfmri_subjects,
+                                                      BIDS_subjects)]
+    plan["dataset"] = plan_dataset(index, source_dir, dest_dir,
+                                   openfmri_subjects, BIDS_subjects,
+                                   template, scan["tasks"],
+                                   scan["scan_parameters"],
+                                   changelog_converter, warning=warning)
+    return plan
+
+
+def merge_participants(participants_plans):
+    """One participants.tsv from the demographics of several sessions."""
+    if not participants_plans:
+        return None
+    subjects = OrderedDict()
+    for participants in participants_plans:
+        subjects.update(participants["subjects"])
+    openfmri_subjects = sorted(subjects)
+    return {"dest": participants_plans[0]["dest"],
+            "inputs": [participants["inputs"][0] for participants in
+                       participants_plans],
+            "options": {"subjects": openfmri_subjects},
+            "subject_template": participants_plans[0]["subject_template"],
+            "subject_templates": [participants["subject_template"] for
+                                  participants in participants_plans],
+            "subjects": [[openfmri_s, subjects[openfmri_s]] for openfmri_s in
+                         openfmri_subjects],
+            "subjects_per_input": [participants["subjects"] for participants
+                                   in participants_plans]}
+
+
+def merge_sidecars(session_sidecars, session_subjects):
+    """Task sidecars of several sessions.
+
+    session_sidecars holds the sidecars planned for each session and
+    session_subjects the planned subjects of each session. Values all
+    sessions agree on go to the dataset level task-<name>_bold.json. Those
+    that differ (e.g. RepetitionTime) are added to the "sidecars" of the
+    subjects, as sub-<label>_ses-<label>_task-<name>_bold.json in their
+    func folders, which BIDS inheritance applies to every run of the task
+    in that session.
+    """
+    by_dest = OrderedDict()
+    for i, sidecars in enumerate(session_sidecars):
+        for sidecar in sidecars:
+            by_dest.setdefault(sidecar["dest"], []).append((i, sidecar))
+
+    merged = []
+    for dest, sidecars in by_dest.items():
+        contents = [sidecar["content"] for _, sidecar in sidecars]
+        common = OrderedDict((key, value) for key, value in contents[0].items()
+                             if all(key in content and content[key] == value
+                                    for content in contents))
+        inputs = []
+        for _, sidecar in sidecars:
+            inputs += [fpath for fpath in sidecar["inputs"]
+                       if fpath not in inputs]
+        merged.append({"dest": dest, "inputs": inputs, "content": common})
+        if all(dict(content) == dict(common) for content in contents):
+            continue
+        task_label = path.basename(dest)[:-len("_bold.json")]
+        for i, sidecar in sidecars:
+            content = OrderedDict((key, value) for key, value in
+                                  sidecar["content"].items()
+                                  if key not in common)
+            if not content:
+                continue
+            for subject in session_subjects[i]:
+                folder_ses, filename_ses = session_labels(
+                    subject["options"]["ses"])
+                subject.setdefault("sidecars", []).append({
+                    "dest": path.join(path.dirname(dest), subject["bids"],
+                                      folder_ses, "func", "%s%s_%s_bold.json"%(
+                                          subject["bids"], filename_ses,
+                                          task_label)),
+                    "inputs": sidecar["inputs"],
+                    "content": content})
+    return merged
+
+
+def make_sessions_plan(sessions, dest_dir, nii_handling=NII_HANDLING_OPTS[0],
+                       behav_tolerance=0.1,
+                       changelog_converter=DEFAULT_CHANGELOG_CONVERTER,
+                       warning=print, io_jobs=1):
+    """Plans the conversion of a dataset whose sessions are separate
+    OpenfMRI datasets, given as (session label, source folder) pairs.
+
+    The sources are indexed concurrently and planned into one plan, so that
+    execute_plan() converts the subjects of all sessions together and
+    writes the dataset level files once: participants.tsv merges the
+    demographics of all sessions (the last session wins for a subject in
+    several), task sidecars hold what the sessions agree on (see
+    merge_sidecars()), dataset_description.json comes from the first
+    session and CHANGES from the first session with a release history. Each
+    subject gets the "options" of its session (ses and scan_parameters).
+    Subject labels are zero padded per session, as when the sessions are
+    converted one by one (so a session of 12 subjects has sub-01 where one
+    of 9 has sub-1). A single session gives the same plan as make_plan().
+    """
+    if len(sessions) == 1:
+        ses, source_dir = sessions[0]
+        return make_plan(source_dir, dest_dir, nii_handling=nii_handling,
+                         ses=ses, behav_tolerance=behav_tolerance,
+                         changelog_converter=changelog_converter,
+                         warning=warning, io_jobs=io_jobs)
+    with ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+        scans = list(executor.map(scan_source, [source_dir for _, source_dir
+                                                in sessions],
+                                  [io_jobs] * len(sessions)))
+    changelog_converter = function_name(changelog_converter)
+
+    plan = plan_header(sessions[0][1], dest_dir,
+                       sum(scan["index"].stat_count for scan in scans),
+                       {"nii_handling": nii_handling,
+                        "ses": sessions[0][0],
+                        "behav_tolerance": behav_tolerance,
+                        "scan_parameters": scans[0]["scan_parameters"],
+                        "changelog_converter": changelog_converter})
+    plan["sessions"] = [[ses, source_dir] for ses, source_dir in sessions]
+    plan["subjects"] = []
+    datasets = []
+    session_subjects = []
+    created = set()
+    for (ses, source_dir), scan in zip(sessions, scans):
+        # padded per session, like converting the sessions one by one
+        template = subject_template(scan["subjects"])
+        BIDS_subjects = [template%int(s[-3:]) for s in scan["subjects"]]
+        subjects = []
+        for openfmri_s, BIDS_s in zip(scan["subjects"], BIDS_subjects):
+            subject = plan_subject(scan["index"], dest_dir, openfmri_s,
+                                   BIDS_s, scan["tasks"],
+                                   scan["anatomy_runs"], ses=ses,
+                                   warning=warning)
+            subject["options"] = {"ses": ses,
+                                  "scan_parameters": scan["scan_parameters"]}
+            # subject folders are created by their first session only
+            subject["directories"] = [directory for directory in
+                                      subject["directories"]
+                                      if directory not in created]
+            created.update(subject["directories"])
+            subjects.append(subject)
+        session_subjects.append(subjects)
+        plan["subjects"] += subjects
+        datasets.append(plan_dataset(scan["index"], source_dir, dest_dir,
+                                     scan["subjects"], BIDS_subjects,
+                                     template, scan["tasks"],
+                                     scan["scan_parameters"],
+                                     changelog_converter, warning=warning))
+
+    plan["dataset"] = {
+        "participants": merge_participants(
+            [dataset["participants"] for dataset in datasets
+             if dataset["participants"] is not None]),
+        "sidecars": merge_sidecars([dataset["sidecars"] for dataset in
+                                    datasets], session_subjects),
+        "description": datasets[0]["description"],
+        "changes": next((dataset["changes"] for dataset in datasets
+                         if dataset["changes"] is not None), None)}
+    return plan
+
+
+def split_plan(plan, n_shards):
+    """Splits a plan into n_shards plans with every n_shards-th subject.
+    The dataset level outputs go to the first shard."""
+    return [dict(plan, subjects=plan["subjects"][i::n_shards],
+                 dataset=plan["dataset"] if i == 0 else None,
+                 shard=[i, n_shards])
+            for i in range(n_shards)]
+
+
+def check_plan(plan):
+    if plan.get("format") != PLAN_FORMAT:
+        raise ValueError("Unsupported plan format: %s"%plan.get("format"))
+
+
+def dump_plans(plans, f):
+    """Writes one plan (or a list of plans) as JSON."""
+    json.dump(plans, f, indent=2)
+    f.write("\n")
+
+
+def load_plans(f):
+    """Reads plans written by dump_plans(), always returning a list."""
+    plans = json.load(f)
+    if isinstance(plans, dict):
+        plans = [plans]
+    for plan in plans:
+        check_plan(plan)
+    return plans
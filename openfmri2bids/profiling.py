@@ -0,0 +1,124 @@
+"""
+Per stage timing and counters of a conversion.
+"""
+import cProfile
+import sys
+import time
+from collections import Counter
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ["scan", "func_images", "anat_images", "events", "behav_merge",
+          "participants", "metadata", "checksums", "validate"]
+
+
+class _Stage(object):
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.wall = time.time()
+        self.cpu = time.thread_time()
+
+    def stop(self):
+        self.profile.add_stage(self.name, time.time() - self.wall,
+                               time.thread_time() - self.cpu)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class Profile(object):
+    """Wall and CPU (of the calling thread) seconds spent in each stage
+    (see STAGES) and counters, for a conversion and per subject and run.
+
+    Everything recorded on a child (e.g. a run of a subject) is added to
+    the totals of its parents as well. to_dict() gives a JSON serializable
+    {"stages", "counters", "children"} tree.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.stages = {}
+        self.counters = Counter()
+        self.children = {}
+
+    def stage(self, name):
+        """Starts timing a stage; stop() the result or use it in a with
+        statement."""
+        return _Stage(self, name)
+
+    def add_stage(self, name, wall, cpu, calls=1):
+        stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0,
+                                              "calls": 0})
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        stage["calls"] += calls
+        if self.parent is not None:
+            self.parent.add_stage(name, wall, cpu, calls)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+        if self.parent is not None:
+            self.parent.count(name, n)
+
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Profile(parent=self)
+        return self.children[name]
+
+    def merge(self, name, profile_dict):
+        """Adds the to_dict() of a profile recorded elsewhere (e.g. in a
+        worker process) as child name."""
+        child = self.child(name)
+        for stage_name, stage in profile_dict["stages"].items():
+            child.add_stage(stage_name, stage["wall"], stage["cpu"],
+                            stage["calls"])
+        for counter, n in profile_dict["counters"].items():
+            child.count(counter, n)
+        for grandchild, grandchild_dict in profile_dict["children"].items():
+            child.children[grandchild] = Profile.from_dict(grandchild_dict,
+                                                           parent=child)
+
+    @classmethod
+    def from_dict(cls, profile_dict, parent=None):
+        profile = cls(parent=parent)
+        profile.stages = dict((name, dict(stage)) for name, stage in
+                              profile_dict["stages"].items())
+        profile.counters = Counter(profile_dict["counters"])
+        for name, child_dict in profile_dict["children"].items():
+            profile.children[name] = cls.from_dict(child_dict, parent=profile)
+        return profile
+
+    def to_dict(self):
+        return {"stages": self.stages,
+                "counters": dict(self.counters),
+                "children": dict((name, child.to_dict()) for name, child in
+                                 sorted(self.children.items()))}
+
+
+def peak_rss_mb():
+    """Peak resident memory (in MB) of this process or, if bigger, of its
+    largest finished child process (e.g. a worker), None if unknown."""
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return rss/(1024.0*1024 if sys.platform == "darwin" else 1024.0)
+
+
+def run_profiled(fpath, func, *args, **kwargs):
+    """Calls func under cProfile and dumps the stats (for pstats) to
+    fpath."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(fpath)
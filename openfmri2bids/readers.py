@@ -0,0 +1,178 @@
+"""
+Parsers for the OpenfMRI text inputs.
+"""
+import io
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+ONSET_COLUMNS = ["onset", "duration", "weight"]
+
+
+def read_onsets_pandas(fpath):
+    """Reference onset reader (two passes of the python engine parser)."""
+    df = pd.read_csv(fpath,
+                     delimiter=r"\s+",
+                     names=ONSET_COLUMNS,
+                     header=None,
+                     engine="python",
+                     index_col=False,
+                     skip_blank_lines=True
+                     )
+    if df.duration.isnull().sum() > 0:
+        df = pd.read_csv(fpath,
+                         sep=" ",
+                         names=ONSET_COLUMNS,
+                         header=None,
+                         engine="python",
+                         index_col=False
+                         )
+    return df
+
+
+_INTEGER_CHARS = str.maketrans("", "", "+-0123456789")
+
+
+def read_bytes(fpath):
+    with open(fpath, "rb") as f:
+        return f.read()
+
+
+def _decode(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+class Prefetcher(object):
+    """Reads small files ahead, workers at a time, so that the latency of
+    opening and reading them (e.g. on network filesystems) overlaps.
+
+    read() returns the contents of a file, waiting for its prefetch (errors
+    are raised then) or reading it right away if it was not prefetched.
+    Contents are kept until close(), so a file can be read several times.
+    """
+
+    def __init__(self, fpaths, workers=8):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = {}
+        for fpath in fpaths:
+            if fpath not in self._futures:
+                self._futures[fpath] = self._executor.submit(read_bytes,
+                                                             fpath)
+
+    def read(self, fpath):
+        if fpath in self._futures:
+            return self._futures[fpath].result()
+        return read_bytes(fpath)
+
+    def open(self, fpath):
+        """Binary file object of the contents of fpath (e.g. for
+        pandas.read_csv())."""
+        return io.BytesIO(self.read(fpath))
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown()
+        self._futures = {}
+
+
+def _loadtxt(text):
+    """Parses whitespace separated numbers with NumPy's C reader. Raises
+    ValueError unless every non blank line has the same number (up to
+    three) of numeric columns."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # "input contained no data"
+        values = np.loadtxt(io.StringIO(text), ndmin=2, comments=None)
+    if not values.size or values.shape[1] > len(ONSET_COLUMNS):
+        raise ValueError("not an onset table")
+    return values
+
+
+def _to_frame(values, column_tokens):
+    """Builds the onset DataFrame with the dtypes pandas would infer:
+    missing columns are NaN and complete columns written as integers are
+    int64."""
+    columns = OrderedDict()
+    for i, name in enumerate(ONSET_COLUMNS):
+        if i >= values.shape[1]:
+            columns[name] = np.full(len(values), np.nan)
+            continue
+        column = values[:, i]
+        if np.all(np.floor(column) == column) and \
+                not "".join(column_tokens[i]).translate(_INTEGER_CHARS):
+            column = column.astype(np.int64)
+        columns[name] = column
+    return pd.DataFrame(columns)
+
+
+def _read_table(text):
+    """Onset DataFrame of one file's text, None if it is not numeric."""
+    try:
+        values = _loadtxt(text)
+    except ValueError:
+        pass
+    else:
+        tokens = text.split()
+        n_columns = values.shape[1]
+        return _to_frame(values, [tokens[i::n_columns]
+                                  for i in range(n_columns)])
+    # rows with missing trailing columns
+    rows = [row for row in (line.split() for line in text.splitlines())
+            if row]
+    if not rows or max(len(row) for row in rows) > len(ONSET_COLUMNS):
+        return None
+    try:
+        values = np.array([[float(token) for token in row] +
+                           [np.nan] * (len(ONSET_COLUMNS) - len(row))
+                           for row in rows])
+    except ValueError:
+        return None
+    return _to_frame(values, [[row[i] for row in rows if len(row) > i]
+                              for i in range(len(ONSET_COLUMNS))])
+
+
+def read_onsets_batch(fpaths, read=read_bytes):
+    """Reads several onset files (e.g. all conditions of a run) into a list
+    of onset/duration/weight DataFrames.
+
+    The files are concatenated and parsed by NumPy in one go (falling back
+    to one file at a time if their layouts differ). Any whitespace (tabs,
+    repeated or trailing spaces, CRLF) separates columns, blank lines are
+    skipped and missing trailing columns become NaN. Files that are not
+    plain numeric tables are read with read_onsets_pandas().
+
+    read returns the contents of a file, e.g. Prefetcher.read().
+    """
+    texts = [_decode(read(fpath)) for fpath in fpaths]
+    dfs = [None] * len(fpaths)
+    batch = [i for i, text in enumerate(texts) if text is not None]
+    try:
+        values = _loadtxt("\n".join(texts[i] for i in batch))
+    except ValueError:
+        values = None
+    if values is not None:
+        n_columns = values.shape[1]
+        start = 0
+        for i in batch:
+            tokens = texts[i].split()
+            stop = start + len(tokens) // n_columns
+            dfs[i] = _to_frame(values[start:stop],
+                               [tokens[j::n_columns]
+                                for j in range(n_columns)])
+            start = stop
+    else:
+        for i in batch:
+            dfs[i] = _read_table(texts[i])
+    return [read_onsets_pandas(fpath) if df is None else df
+            for fpath, df in zip(fpaths, dfs)]
+
+
+def read_onsets(fpath):
+    """Reads a single onset file, see read_onsets_batch()."""
+    return read_onsets_batch([fpath])[0]
@@ -0,0 +1,128 @@
+"""
+Synthetic OpenfMRI datasets for tests and benchmarks.
+
+make_dataset() writes the layout convert() reads: sub*/BOLD/task*_run*,
+sub*/anatomy, sub*/model/model001/onsets (with a parametric and a *RT
+condition), sub*/behav, condition_key.txt, task_key.txt, scan_key.txt,
+demographics.txt and the dataset description files. Images are tiny
+placeholders (or empty), so datasets of thousands of runs fit in a temp
+folder.
+
+    $ python -m openfmri2bids.synthetic OUTPUT [n_subjects [n_tasks [n_runs
+          [n_conditions [n_events]]]]]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+
+BEHAV_FORMATS = ["header", "no_header", "none"]
+
+
+def _write(fpath, content, mode="w"):
+    folder = os.path.dirname(fpath)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(fpath, mode) as f:
+        f.write(content)
+
+
+def make_dataset(root, n_subjects=4, n_tasks=2, n_runs=2, n_conditions=3,
+                 n_events=20, parametric=True, rt=True, behav="header",
+                 image_size=200, seed=0):
+    """Writes a synthetic OpenfMRI dataset to root and returns root.
+
+    Each run has n_events onsets spread over the conditions. With
+    parametric=True the second condition has varying weights and with
+    rt=True the last condition is a respRT condition on every other event
+    (its durations being the reaction times, some 0). behav is the
+    behavdata.txt format (see BEHAV_FORMATS): with a header row, without
+    one, or no behavdata at all. BOLD images are image_size bytes (T1w and
+    inplane images half and a quarter of that), 0 gives empty files.
+    """
+    rnd = random.Random(seed)
+    if behav not in BEHAV_FORMATS:
+        raise ValueError("behav has to be one of %s"%", ".join(BEHAV_FORMATS))
+    n_conditions = max(n_conditions, 1)
+    tasks = ["task%03d"%t for t in range(1, n_tasks + 1)]
+    conditions = ["cond%03d"%c for c in range(1, n_conditions + 1)]
+
+    _write(os.path.join(root, "task_key.txt"),
+           "".join("%s some task %d\n"%(task, t + 1)
+                   for t, task in enumerate(tasks)))
+    _write(os.path.join(root, "scan_key.txt"), "TR 2.0\n")
+    condition_key = ""
+    for task in tasks:
+        for c, condition in enumerate(conditions):
+            if rt and c == n_conditions - 1 and n_conditions > 1:
+                name = "respRT"
+            else:
+                name = "cond %d"%(c + 1)
+            condition_key += "%s %s %s\n"%(task, condition, name)
+    _write(os.path.join(root, "models", "model001", "condition_key.txt"),
+           condition_key)
+    _write(os.path.join(root, "demographics.txt"),
+           "subject_id\tsex\tage\n" +
+           "".join("%d\t%s\t%d\n"%(s, rnd.choice("MF"), rnd.randint(18, 60))
+                   for s in range(1, n_subjects + 1)))
+    _write(os.path.join(root, "study_key.txt"), "Synthetic\n")
+    _write(os.path.join(root, "README"), "readme\n")
+    _write(os.path.join(root, "release_history.txt"),
+           "2015-01-01: first\n\n2015-06-01: second\n")
+
+    for s in range(1, n_subjects + 1):
+        sub = os.path.join(root, "sub%03d"%s)
+        _write(os.path.join(sub, "anatomy", "highres001.nii.gz"),
+               b"x"*(image_size//2), "wb")
+        _write(os.path.join(sub, "anatomy", "inplane001.nii.gz"),
+               b"y"*(image_size//4), "wb")
+        for task in tasks:
+            for r in range(1, n_runs + 1):
+                task_run = "%s_run%03d"%(task, r)
+                _write(os.path.join(sub, "BOLD", task_run, "bold.nii.gz"),
+                       b"b"*image_size, "wb")
+                onsets = sorted(rnd.sample(range(0, n_events*10), n_events))
+                _write_onsets(os.path.join(sub, "model", "model001", "onsets",
+                                           task_run),
+                              onsets, n_conditions, parametric,
+                              rt and n_conditions > 1, rnd)
+                if behav != "none":
+                    _write(os.path.join(sub, "behav", task_run,
+                                        "behavdata.txt"),
+                           _behavdata(onsets, behav == "header", rnd))
+    return root
+
+
+def _write_onsets(folder, onsets, n_conditions, parametric, rt, rnd):
+    """Writes the condition files of one run, the formatting (separators,
+    trailing spaces, integer onsets) varies like in the OpenfMRI
+    datasets."""
+    n_regular = n_conditions - 1 if rt else n_conditions
+    for c in range(1, n_conditions + 1):
+        lines = []
+        for i, onset in enumerate(onsets):
+            if c > n_regular:
+                if i%2 or i%n_conditions == n_conditions - 1:
+                    continue
+                lines.append("%g\t%g\t1\n"%(onset,
+                                            rnd.choice([0, 0.5, 0.75])))
+            elif i%n_conditions != c - 1:
+                continue
+            elif c == 2 and parametric:
+                lines.append("%g %g %g \n"%(onset, 2.5, rnd.random()))
+            else:
+                lines.append("%d\t%d\t1\n"%(onset, 3))
+        _write(os.path.join(folder, "cond%03d.txt"%c), "".join(lines))
+
+
+def _behavdata(onsets, header, rnd):
+    lines = ["Onset\tAcc\tRT2\n"] if header else []
+    for onset in onsets[::2]:
+        lines.append("%g\t%d\t%.3f\n"%(onset + 0.02, rnd.randint(0, 1),
+                                       rnd.random()))
+    return "".join(lines)
+
+
+if __name__ == '__main__':
+    make_dataset(sys.argv[1], *[int(a) for a in sys.argv[2:]])
@@ -0,0 +1,264 @@
+"""
+Low level file transfer helpers for images.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 1024 * 1024
+
+CHECKSUM_ALGORITHMS = ["sha256", "blake2b"]
+
+# errors worth retrying a transfer for (e.g. network filesystem hiccups)
+TRANSIENT_ERRORS = set([errno.EIO, errno.EAGAIN, errno.EBUSY, errno.EINTR,
+                        errno.ETIMEDOUT, errno.ESTALE, errno.ECONNRESET,
+                        errno.ECONNABORTED])
+
+# errors meaning "this mechanism is not available here", try the next one
+_UNSUPPORTED = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                    errno.ENOTTY, errno.EPERM,
+                    getattr(errno, "EOPNOTSUPP", errno.EINVAL),
+                    getattr(errno, "ENOTSUP", errno.EINVAL)])
+
+
+def _clonefile_darwin(src, dest):
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.clonefile(os.fsencode(src), os.fsencode(dest), 0) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), dest)
+
+
+def _copy_file_range(src_fd, dest_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dest_fd, size - copied, copied, copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def _sendfile(src_fd, dest_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dest_fd, src_fd, copied, size - copied)
+        if n == 0:
+            break
+        copied += n
+
+
+def clone_file(src, dest):
+    """Copies src to dest with the cheapest mechanism available and returns
+    its name: "reflink" (copy-on-write clone), "copy_file_range",
+    "sendfile" (both copy in the kernel) or "copy".
+    """
+    if sys.platform == "darwin":
+        try:
+            _clonefile_darwin(src, dest)
+            return "reflink"
+        except OSError as exc:
+            if exc.errno not in _UNSUPPORTED:
+                raise
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        src_fd, dest_fd = fsrc.fileno(), fdst.fileno()
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, src_fd)
+                mechanism = "reflink"
+            except OSError as exc:
+                if exc.errno not in _UNSUPPORTED:
+                    raise
+                mechanism = None
+        else:
+            mechanism = None
+        size = os.fstat(src_fd).st_size
+        for name, copy in [("copy_file_range", _copy_file_range),
+                           ("sendfile", _sendfile)]:
+            if mechanism is not None or not hasattr(os, name):
+                continue
+            try:
+                copy(src_fd, dest_fd, size)
+                mechanism = name
+            except OSError as exc:
+                if exc.errno not in _UNSUPPORTED:
+                    raise
+                os.ftruncate(dest_fd, 0)
+                os.lseek(dest_fd, 0, os.SEEK_SET)
+        if mechanism is None:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+            mechanism = "copy"
+    shutil.copymode(src, dest)
+    return mechanism
+
+
+def hardlink_file(src, dest):
+    """Hard links src to dest, falling back to clone_file() across
+    filesystems. Returns the mechanism used."""
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as exc:
+        if exc.errno not in _UNSUPPORTED:
+            raise
+    return clone_file(src, dest)
+
+
+def _chunks(f):
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+
+def hash_file(fpath, algorithm="sha256"):
+    """Hex digest of the contents of fpath."""
+    digest = hashlib.new(algorithm)
+    with open(fpath, "rb") as f:
+        for chunk in _chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_hashed(src, dest, algorithm="sha256"):
+    """Copies src to dest in CHUNK_SIZE blocks, hashing them on the way, and
+    returns the hex digest, so the data is read only once."""
+    digest = hashlib.new(algorithm)
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        for chunk in _chunks(fsrc):
+            digest.update(chunk)
+            fdst.write(chunk)
+    shutil.copymode(src, dest)
+    return digest.hexdigest()
+
+
+class ContentIndex(object):
+    """Checksums of the files transferred into a dataset, indexed by size
+    and content, shared by the transfer threads of a process.
+
+    With dedup=True find() looks up whether a file with the same contents
+    is already in the dataset (hashing the source only if one of the same
+    size is), so it can be hard linked instead of written again. Copies
+    sent to worker processes start from the state at the time they are
+    made.
+    """
+
+    def __init__(self, algorithm="sha256", dedup=False):
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError("Unsupported checksum algorithm: %s"%algorithm)
+        self.algorithm = algorithm
+        self.dedup = dedup
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def find(self, src):
+        """(digest, path of a file with the same contents) for src, either
+        being None if unknown."""
+        if not self.dedup:
+            return None, None
+        size = os.stat(src).st_size
+        with self._lock:
+            if size not in self._sizes:
+                return None, None
+        digest = hash_file(src, self.algorithm)
+        with self._lock:
+            return digest, self._sizes[size].get(digest)
+
+    def add(self, fpath, digest):
+        size = os.stat(fpath).st_size
+        with self._lock:
+            self._sizes.setdefault(size, {}).setdefault(digest, fpath)
+
+
+class TransferQueue(object):
+    """Runs file transfers (e.g. handle_nii) in a bounded pool of threads.
+
+    submit() returns immediately unless max_pending transfers are already
+    queued, so the caller can keep doing CPU bound work (like the events)
+    while images are copied. Transfers failing with a transient OSError are
+    retried with exponential backoff. transfer(src, dest) returns the
+    mechanism used, or a (mechanism, checksum) pair. wait() returns one dict
+    per file with src, dest, bytes, seconds, cpu_seconds (of the
+    transferring thread), mb_per_s, mechanism, digest (the checksum or None)
+    and attempts.
+    """
+
+    def __init__(self, transfer, workers=1, max_pending=None, retries=3,
+                 retry_delay=0.5):
+        self.transfer = transfer
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._futures = []
+
+    def submit(self, src, dest):
+        self._slots.acquire()
+        future = self._executor.submit(self._run, src, dest)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+
+    def _run(self, src, dest):
+        size = os.stat(src).st_size
+        start = time.time()
+        start_cpu = time.thread_time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                mechanism = self.transfer(src, dest)
+                break
+            except OSError as exc:
+                if exc.errno not in TRANSIENT_ERRORS or attempt > self.retries:
+                    raise
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+        seconds = time.time() - start
+        digest = None
+        if isinstance(mechanism, tuple):
+            mechanism, digest = mechanism
+        return {"src": src, "dest": dest, "bytes": size, "seconds": seconds,
+                "cpu_seconds": time.thread_time() - start_cpu,
+                "mb_per_s": size / 1e6 / seconds if seconds else None,
+                "mechanism": mechanism, "digest": digest, "attempts": attempt}
+
+    def wait(self):
+        """Waits for all submitted transfers and returns their results.
+        Raises the first failure once every transfer has finished."""
+        wait(self._futures)
+        self._executor.shutdown()
+        return [future.result() for future in self._futures]
+
+
+def throughput_report(results, wall_seconds):
+    """Aggregate of TransferQueue results over wall_seconds."""
+    n_bytes = sum(result["bytes"] for result in results)
+    return {"files": len(results),
+            "bytes": n_bytes,
+            "wall_seconds": wall_seconds,
+            "mb_per_s": n_bytes / 1e6 / wall_seconds if wall_seconds else None}
@@ -0,0 +1,263 @@
+"""
+Structural checks of a converted dataset.
+
+validate_plan() checks what a conversion wrote against what its plan says
+it wrote, instead of walking the output folder again like bids-validator:
+file name patterns and folders of every planned output, that the outputs
+exist, the columns and n/a encoding of the events.tsv and participants.tsv
+files, the fields of the task-*_bold.json sidecars (after inheritance) and
+that every participant has images. Only the small text outputs are read.
+
+Issues are dicts with a "severity" ("error" or "warning"), a "code", the
+"path" of the file concerned and a "message".
+"""
+import csv
+import json
+import re
+from os import path
+
+VALIDATION_NAME = ".openfmri2bids_validation.json"
+
+LABEL = "[a-zA-Z0-9]+"
+
+FUNC_PATTERN = re.compile(
+    r"^(?P<sub>sub-%s)(_(?P<ses>ses-%s))?_task-(?P<task>%s)(_run-[0-9]+)?"
+    r"_(bold\.nii\.gz|events\.tsv|bold\.json)$"%(LABEL, LABEL, LABEL))
+ANAT_PATTERN = re.compile(
+    r"^(?P<sub>sub-%s)(_(?P<ses>ses-%s))?(_run-[0-9]+)?"
+    r"_(T1w|inplaneT2)\.nii\.gz$"%(LABEL, LABEL))
+TASK_SIDECAR_PATTERN = re.compile(r"^task-(?P<task>%s)_bold\.json$"%LABEL)
+
+# cell values that mean the missing value was not written as n/a
+MISSING_VALUES = set(["", "nan", "NaN", "NA", "None", "null"])
+
+REQUIRED_SIDECAR_FIELDS = ["RepetitionTime", "TaskName"]
+REQUIRED_DESCRIPTION_FIELDS = ["Name", "BIDSVersion"]
+
+
+def _issue(issues, severity, code, fpath, message):
+    issues.append({"severity": severity, "code": code, "path": fpath,
+                   "message": message})
+
+
+def _is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def read_tsv(fpath):
+    """Header and rows of a TSV file."""
+    with open(fpath, newline="") as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    if not rows:
+        return [], []
+    return rows[0], rows[1:]
+
+
+def check_tsv_cells(issues, fpath, header, rows):
+    for i, row in enumerate(rows):
+        if len(row) != len(header):
+            _issue(issues, "error", "TSV_ROW_LENGTH", fpath,
+                   "row %d has %d columns, the header %d"%(
+                       i + 1, len(row), len(header)))
+        for column, value in zip(header, row):
+            if value in MISSING_VALUES:
+                _issue(issues, "error", "TSV_MISSING_VALUE", fpath,
+                       "row %d: %s is %r instead of n/a"%(i + 1, column,
+                                                          value))
+
+
+def check_events(issues, fpath):
+    header, rows = read_tsv(fpath)
+    if header[:2] != ["onset", "duration"]:
+        _issue(issues, "error", "EVENTS_COLUMNS", fpath,
+               "the first columns have to be onset and duration, not %s"%(
+                   ", ".join(header[:2]) or "nothing"))
+        return
+    check_tsv_cells(issues, fpath, header, rows)
+    for i, row in enumerate(rows):
+        if len(row) < 2:
+            continue
+        if not _is_number(row[0]):
+            _issue(issues, "error", "EVENTS_ONSET", fpath,
+                   "row %d: onset %r is not a number"%(i + 1, row[0]))
+        if row[1] != "n/a" and not (_is_number(row[1]) and
+                                    float(row[1]) >= 0):
+            _issue(issues, "error", "EVENTS_DURATION", fpath,
+                   "row %d: duration %r is not a non-negative number or "
+                   "n/a"%(i + 1, row[1]))
+
+
+def check_participants(issues, participants):
+    fpath = participants["dest"]
+    header, rows = read_tsv(fpath)
+    if header[:1] != ["participant_id"]:
+        _issue(issues, "error", "PARTICIPANTS_COLUMNS", fpath,
+               "the first column has to be participant_id")
+        return
+    check_tsv_cells(issues, fpath, header, rows)
+    listed = [row[0] for row in rows if row]
+    for participant in listed:
+        if not re.match("^sub-%s$"%LABEL, participant):
+            _issue(issues, "error", "PARTICIPANT_ID", fpath,
+                   "%r is not a sub-<label> participant_id"%participant)
+    for participant in sorted(set(listed)):
+        if listed.count(participant) > 1:
+            _issue(issues, "error", "PARTICIPANT_DUPLICATE", fpath,
+                   "%s is listed %d times"%(participant,
+                                            listed.count(participant)))
+    # all planned subjects, also those of other shards
+    expected = set(bids for _, bids in participants["subjects"])
+    for participant in sorted(expected - set(listed)):
+        _issue(issues, "error", "PARTICIPANT_MISSING", fpath,
+               "%s has data but is not listed"%participant)
+
+
+def check_name(issues, fpath, subject):
+    """Checks the name and folder of an output of subject, returns the
+    name's match (None if it does not match)."""
+    folder = path.basename(path.dirname(fpath))
+    pattern = ANAT_PATTERN if folder == "anat" else FUNC_PATTERN
+    match = pattern.match(path.basename(fpath))
+    if folder not in ["anat", "func"] or match is None:
+        _issue(issues, "error", "FILENAME", fpath,
+               "not a BIDS %s file name"%folder)
+        return None
+    parents = path.dirname(path.dirname(fpath))
+    ses_folder = ""
+    if path.basename(parents).startswith("ses-"):
+        ses_folder = path.basename(parents)
+        parents = path.dirname(parents)
+    if match.group("sub") != subject["bids"] or \
+            path.basename(parents) != subject["bids"] or \
+            (match.group("ses") or "") != ses_folder:
+        _issue(issues, "error", "FILENAME_FOLDER", fpath,
+               "the sub-/ses- labels do not match the folders")
+    return match
+
+
+def _missing(issues, fpath):
+    if not path.lexists(fpath):
+        _issue(issues, "error", "MISSING_FILE", fpath,
+               "planned output was not written")
+        return True
+    return False
+
+
+def validate_plan(plan):
+    """Checks the outputs of an executed plan (or shard of one) and returns
+    the issues found."""
+    issues = []
+    dataset = plan["dataset"]
+    task_sidecars = {}
+    if dataset is not None:
+        for sidecar in dataset["sidecars"]:
+            match = TASK_SIDECAR_PATTERN.match(path.basename(sidecar["dest"]))
+            if match is None:
+                _issue(issues, "error", "FILENAME", sidecar["dest"],
+                       "not a task-<label>_bold.json file name")
+                continue
+            if not _missing(issues, sidecar["dest"]):
+                task_sidecars[match.group("task")] = sidecar["content"]
+
+    for subject in plan["subjects"]:
+        subject_sidecars = {}
+        for sidecar in subject.get("sidecars", []):
+            match = check_name(issues, sidecar["dest"], subject)
+            if match is not None and not _missing(issues, sidecar["dest"]):
+                subject_sidecars[(match.group("ses"),
+                                  match.group("task"))] = sidecar["content"]
+
+        bolds = set()
+        n_anat = 0
+        for image in subject["images"]:
+            match = check_name(issues, image["dest"], subject)
+            if _missing(issues, image["dest"]) or match is None:
+                continue
+            if path.basename(path.dirname(image["dest"])) == "anat":
+                n_anat += 1
+                continue
+            bolds.add(path.basename(image["dest"])[:-len("_bold.nii.gz")])
+            sidecar = dict(task_sidecars.get(match.group("task"), {}))
+            sidecar.update(subject_sidecars.get((match.group("ses"),
+                                                 match.group("task")), {}))
+            check_sidecar(issues, image["dest"], sidecar,
+                          plan_knows_task=dataset is not None)
+        if not bolds:
+            _issue(issues, "error", "NO_FUNC", subject["directories"][0],
+                   "%s has no BOLD images"%subject["bids"])
+        if not n_anat:
+            _issue(issues, "warning", "NO_ANAT", subject["directories"][0],
+                   "%s has no anatomical images"%subject["bids"])
+
+        for events in subject["events"]:
+            if check_name(issues, events["dest"], subject) is None or \
+                    _missing(issues, events["dest"]):
+                continue
+            if path.basename(events["dest"])[:-len("_events.tsv")] \
+                    not in bolds:
+                _issue(issues, "error", "EVENTS_WITHOUT_BOLD",
+                       events["dest"], "there is no matching BOLD image")
+            check_events(issues, events["dest"])
+
+    if dataset is not None:
+        check_dataset(issues, plan)
+    return issues
+
+
+def check_sidecar(issues, bold, sidecar, plan_knows_task=True):
+    """Checks the sidecar fields (dataset and subject level merged) that
+    apply to a BOLD image. Shards without the dataset level files only
+    check the subject level ones."""
+    for field in REQUIRED_SIDECAR_FIELDS:
+        if field not in sidecar:
+            if plan_knows_task:
+                _issue(issues, "error", "SIDECAR_FIELD", bold,
+                       "no %s in its task-*_bold.json"%field)
+        elif field == "RepetitionTime" and not (
+                isinstance(sidecar[field], (int, float)) and
+                sidecar[field] > 0):
+            _issue(issues, "error", "SIDECAR_FIELD", bold,
+                   "RepetitionTime %r is not a positive number"%(
+                       sidecar[field],))
+
+
+def check_dataset(issues, plan):
+    dataset = plan["dataset"]
+    description = dataset["description"]["dest"]
+    if not _missing(issues, description):
+        with open(description) as f:
+            content = json.load(f)
+        for field in REQUIRED_DESCRIPTION_FIELDS:
+            if not content.get(field):
+                _issue(issues, "error", "DESCRIPTION_FIELD", description,
+                       "no %s"%field)
+    participants = dataset["participants"]
+    if participants is None:
+        _issue(issues, "warning", "NO_PARTICIPANTS", plan["dest_dir"],
+               "there is no participants.tsv")
+    elif not _missing(issues, participants["dest"]):
+        check_participants(issues, participants)
+
+
+def errors(issues):
+    return [issue for issue in issues if issue["severity"] == "error"]
+
+
+def report_path(plan):
+    """Where the validation report of a plan goes: VALIDATION_NAME in the
+    output folder, with the shard index for shards of a plan."""
+    name = VALIDATION_NAME
+    if plan.get("shard"):
+        name = name.replace(".json", "-%d.json"%plan["shard"][0])
+    return path.join(plan["dest_dir"], name)
+
+
+def write_report(issues, fpath):
+    """Writes issues as JSON."""
+    with open(fpath, "w") as f:
+        json.dump(issues, f, indent=1)
+        f.write("\n")
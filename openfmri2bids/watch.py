@@ -0,0 +1,224 @@
+"""
+Continuous conversion of the datasets dropped into a folder.
+
+A Watcher polls an incoming folder in which every (non hidden) sub folder
+is an OpenfMRI dataset. Datasets are recognised as new or updated by a
+stat snapshot of their files (no OS specific notification API is used)
+and queued for conversion to a folder of the same name in the outgoing
+folder once they are quiescent: their snapshot did not change since the
+previous poll and no file was modified for quiet_seconds. Conversions run
+in a pool of worker processes (see batch.convert_dataset()).
+
+The state of every dataset (including the snapshot it was last converted
+from) is kept in STATE_NAME in the outgoing folder, so a restarted watcher
+only converts what changed since. STATUS_NAME is rewritten after every
+poll with the queue depth, the conversions running, the throughput and
+the latency (from detection to the end of the conversion) of every
+dataset.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .batch import convert_dataset, dataset_job
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = ".openfmri2bids_watch_state.json"
+STATUS_NAME = ".openfmri2bids_watch_status.json"
+
+
+def snapshot(folder):
+    """Stat snapshot of the files under folder: a digest of their paths,
+    sizes and mtimes, their number and the newest mtime (in seconds)."""
+    digest = hashlib.sha1()
+    n_files = 0
+    newest = 0
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        for entry in sorted(os.scandir(current), key=lambda e: e.name):
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+                continue
+            st = entry.stat(follow_symlinks=False)
+            digest.update(("%s\0%d\0%d\n"%(
+                os.path.relpath(entry.path, folder), st.st_size,
+                st.st_mtime_ns)).encode("utf-8", "surrogateescape"))
+            n_files += 1
+            newest = max(newest, st.st_mtime)
+    return {"digest": digest.hexdigest(), "files": n_files, "newest": newest}
+
+
+def _write_json(fpath, content):
+    with open(fpath + ".tmp", "w") as f:
+        json.dump(content, f, indent=1, sort_keys=True)
+    os.replace(fpath + ".tmp", fpath)
+
+
+class Watcher(object):
+    """Converts the datasets in incoming to outgoing as they arrive or
+    change, jobs at a time. kwargs are passed on to
+    batch.convert_dataset() (e.g. nii_handling or incremental). Datasets
+    that changed after they were converted are always converted again
+    incrementally (unless they are written to archives or skeletons).
+
+    Call poll() periodically (run() does) and wait() to finish the queued
+    conversions.
+    """
+
+    def __init__(self, incoming, outgoing, jobs=1, quiet_seconds=60.0,
+                 **kwargs):
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.jobs = jobs
+        self.quiet_seconds = quiet_seconds
+        self.kwargs = kwargs
+        if not os.path.isdir(outgoing):
+            os.makedirs(outgoing)
+        self.state_path = os.path.join(outgoing, STATE_NAME)
+        self.status_path = os.path.join(outgoing, STATUS_NAME)
+        self.datasets = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.datasets = json.load(f)
+        for dataset in self.datasets.values():
+            # interrupted conversions are redone
+            if dataset["status"] in ["queued", "converting"]:
+                dataset["status"] = "waiting"
+        self.queue = deque()
+        self.running = {}
+        self.started = time.time()
+        self._executor = None
+
+    def _dataset_names(self):
+        return sorted(entry.name for entry in os.scandir(self.incoming)
+                      if entry.is_dir() and not entry.name.startswith("."))
+
+    def scan(self, assume_quiet=False):
+        """Snapshots every dataset and queues those that changed since their
+        last conversion and are quiescent (or all changed ones with
+        assume_quiet=True)."""
+        now = time.time()
+        for name in self._dataset_names():
+            current = snapshot(os.path.join(self.incoming, name))
+            dataset = self.datasets.setdefault(name, {
+                "status": "waiting", "converted": None, "snapshot": None})
+            if current["digest"] == dataset["converted"] or \
+                    dataset["status"] in ["queued", "converting"]:
+                dataset["snapshot"] = current["digest"]
+                continue
+            if dataset["status"] != "waiting":
+                # changed since it was converted
+                dataset["status"] = "waiting"
+            if dataset.get("detected") is None:
+                dataset["detected"] = now
+            stable = current["digest"] == dataset["snapshot"]
+            dataset["snapshot"] = current["digest"]
+            if assume_quiet or (stable and now - current["newest"] >=
+                                self.quiet_seconds):
+                dataset["status"] = "queued"
+                self.queue.append(name)
+                logger.info("%s: queued", name)
+
+    def _collect(self):
+        for future in [future for future in self.running if future.done()]:
+            name, digest = self.running.pop(future)
+            dataset = self.datasets[name]
+            try:
+                row = future.result()
+            except Exception as exc:
+                # the worker process itself died
+                row = {"status": "failed", "wall_seconds": None, "files": 0,
+                       "bytes": 0, "error": "%s: %s"%(type(exc).__name__,
+                                                      exc)}
+            now = time.time()
+            dataset.update(status=row["status"], converted=digest,
+                           finished=now,
+                           latency_seconds=now - dataset["detected"],
+                           wall_seconds=row["wall_seconds"],
+                           files=row["files"], bytes=row["bytes"],
+                           error=row["error"])
+            dataset["detected"] = None
+            logger.info("%s: %s", name, row["status"])
+
+    def _submit(self):
+        while self.queue and len(self.running) < self.jobs:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+            name = self.queue.popleft()
+            dataset = self.datasets[name]
+            dataset["status"] = "converting"
+            job = dataset_job(name, self.incoming, self.outgoing)
+            kwargs = dict(self.kwargs)
+            if dataset["converted"] is not None and not \
+                    set(kwargs) & {"archive_dir", "skeleton_dir"}:
+                # the output folder exists, only what changed is redone
+                kwargs["incremental"] = True
+            future = self._executor.submit(convert_dataset, job, **kwargs)
+            self.running[future] = (name, dataset["snapshot"])
+
+    def poll(self, assume_quiet=False):
+        """Collects finished conversions, scans the incoming folder, starts
+        queued conversions and saves the state and status."""
+        self._collect()
+        self.scan(assume_quiet=assume_quiet)
+        self._submit()
+        self.save()
+
+    def status(self):
+        """Queue depth, running conversions, throughput (of the conversions
+        finished since this watcher started) and per dataset results."""
+        finished = [dataset for dataset in self.datasets.values()
+                    if dataset["status"] in ["ok", "failed"] and
+                    dataset["finished"] >= self.started]
+        n_bytes = sum(dataset["bytes"] for dataset in finished)
+        seconds = sum(dataset["wall_seconds"] or 0 for dataset in finished)
+        now = time.time()
+        uptime = now - self.started
+        return {"updated": now,
+                "queue_depth": len(self.queue),
+                "running": sorted(name for name, _ in self.running.values()),
+                "throughput": {
+                    "datasets": len(finished),
+                    "datasets_per_hour": (len(finished)*3600.0/uptime
+                                          if uptime else None),
+                    "mb_per_s": n_bytes/1e6/seconds if seconds else None},
+                "datasets": dict(
+                    (name, dict((key, dataset.get(key)) for key in
+                                ["status", "latency_seconds", "wall_seconds",
+                                 "files", "bytes", "error"]))
+                    for name, dataset in sorted(self.datasets.items()))}
+
+    def save(self):
+        _write_json(self.state_path, self.datasets)
+        _write_json(self.status_path, self.status())
+
+    def wait(self):
+        """Waits for the queued and running conversions (without scanning
+        for new ones)."""
+        while True:
+            self._collect()
+            self._submit()
+            if not self.running:
+                break
+            wait(list(self.running), return_when=FIRST_COMPLETED)
+        self.save()
+
+    def run(self, interval=10.0, polls=None):
+        """Polls every interval seconds, forever or polls times."""
+        n = 0
+        while polls is None or n < polls:
+            self.poll()
+            n += 1
+            if polls is None or n < polls:
+                time.sleep(interval)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
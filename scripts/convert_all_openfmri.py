@@ -1,20 +1,20 @@
-import subprocess
-
-from openfmri2bids.converter import convert
-import shutil
-import dateutil
 import os
+import sys
+
+from openfmri2bids.batch import convert_batch, dataset_job, write_summary
+from openfmri2bids.validate import VALIDATION_NAME
+
 datasets = [
              'ds001_R1.1.0',
              'ds002',
              'ds003_R1.1.0',
              'ds005_R1.1.0',
-              {"pre":'ds006A_R1.1.0_raw', "post":'ds006B'},
+              {"name": "ds006", "sessions": {"pre":'ds006A_R1.1.0_raw', "post":'ds006B'}},
               'ds007_R1.1.0',
               'ds008_R1.1.1_raw',
               'ds009_R1.1.0_raw',
               'ds011',
-              #{"test":"ds017A", "retest":"ds017B"},
+              #{"name": "ds017", "sessions": {"test":"ds017A", "retest":"ds017B"}},
               'ds051',
               'ds052',
               'ds101',
@@ -24,64 +24,27 @@ datasets = [
               'ds108',
               'ds109',
               'ds110',
-              'ds113b',
+              {"name": "ds113b", "changelog_converter": "rev"},
              # 'ds114',
              #'ds115' missing models
               'ds116'
             ]
 
-def ds113b_converter(in_file, out_file):
-    out_str = ""
-    for line in open(in_file).readlines():
-        if line.startswith("rev"):
-            version = line.split("(")[0]
-            desc = line.split("(")[1].split(")")[1].replace(":","")
-            date = dateutil.parser.parse(line.split("(")[1].split(")")[0])
-            line = version + date.strftime("%Y-%m-%d") + desc
-        out_str += line
-    with open(out_file, "w") as f:
-        f.write(out_str)
-
-custom_chngelog_converters = {"ds113b": ds113b_converter}
-
-input_data_dir = "/Users/filo/data/openfmri/"
-#input_data_dir = "D:\OpenfMRI"
-output_data_dir = "/Users/filo/data/openfmri_BIDS/"
-#output_data_dir = "D:\OpenfMRI_BIDS"
-
 
 if __name__ == '__main__':
-
-    for dataset in datasets:
-        if isinstance(dataset, dict):
-            output_ds_dir = output_data_dir + "symlinked/%s/" % \
-                                              list(dataset.values())[0][
-                                              :-1]
-            try:
-                shutil.rmtree(output_ds_dir)
-            except:
-                pass
-            for ses_label, ds in dataset.items():
-                args = {}
-                if ds in custom_chngelog_converters:
-                    args["changelog_converter"] = custom_chngelog_converters[ds]
-                convert(input_data_dir+"%s/"%ds,
-                        output_ds_dir,
-                ses=ses_label,
-                nii_handling='link', **args)
-        else:
-            output_ds_dir = os.path.join(output_data_dir,
-                                         "symlinked/%s/" % dataset)
-            try:
-                shutil.rmtree(output_ds_dir)
-            except:
-                pass
-            args = {}
-            if dataset in custom_chngelog_converters:
-                args["changelog_converter"] = custom_chngelog_converters[dataset]
-            convert(os.path.join(input_data_dir, "%s/"%dataset),
-                    output_ds_dir,
-                    nii_handling='link',
-                    **args)
-
-        subprocess.check_call('bids-validator %s --ignoreNiftiHeaders' % output_ds_dir, shell=True)
\ No newline at end of file
+    if len(sys.argv) not in [3, 4]:
+        sys.exit("usage: %s INPUT_DATA_DIR OUTPUT_DATA_DIR [JOBS]" % sys.argv[0])
+    input_data_dir, output_data_dir = sys.argv[1:3]
+    jobs = int(sys.argv[3]) if len(sys.argv) == 4 else 1
+
+    rows = convert_batch([dataset_job(dataset, input_data_dir, output_data_dir)
+                          for dataset in datasets],
+                         jobs=jobs, nii_handling='link', incremental=True,
+                         validate=True)
+    write_summary(rows, sys.stdout)
+
+    for row in rows:
+        if row["validation_errors"]:
+            print("%s: %d validation errors, see %s" % (
+                row["dataset"], row["validation_errors"],
+                os.path.join(output_data_dir, row["dataset"], VALIDATION_NAME)))
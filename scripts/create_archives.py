@@ -3,11 +3,24 @@ Created on 17 Sep 2015
 
 @author: filo
 '''
-import subprocess, os
-from convert_all_openfmri import output_data_dir
-directory = output_data_dir + "symlinked/"
-for ds in os.listdir(directory):
-    print("tarring %s"%ds)
-    subprocess.call('tar cL --exclude="*Icon*" -f %sarchives/%s.tar -C '
-                    '%ssymlinked/ %s'%(
-        output_data_dir, ds, output_data_dir, ds), shell=True)
\ No newline at end of file
+import os
+import sys
+
+from openfmri2bids.batch import convert_batch, dataset_job, write_summary
+from convert_all_openfmri import datasets
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        sys.exit("usage: %s INPUT_DATA_DIR OUTPUT_DATA_DIR [JOBS]" % sys.argv[0])
+    input_data_dir, output_data_dir = sys.argv[1:3]
+    jobs = int(sys.argv[3]) if len(sys.argv) == 4 else 1
+    archive_dir = os.path.join(output_data_dir, "archives")
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+
+    # straight from the OpenfMRI sources, no symlinked/ tree or tar cL pass
+    rows = convert_batch([dataset_job(dataset, input_data_dir, output_data_dir)
+                          for dataset in datasets],
+                         jobs=jobs, nii_handling='copy',
+                         archive_dir=archive_dir)
+    write_summary(rows, sys.stdout)
@@ -1,21 +1,21 @@
-from convert_all_openfmri import output_data_dir
+import os
+import sys
 
-source_folder = output_data_dir+"symlinked"
-target_folder = output_data_dir+"empty"
+from openfmri2bids.batch import convert_batch, dataset_job, write_summary
+from convert_all_openfmri import datasets
 
-import shutil, os
-from glob import glob
-try:
-    shutil.rmtree(target_folder)
-except:
-    pass
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        sys.exit("usage: %s INPUT_DATA_DIR OUTPUT_DATA_DIR [JOBS]" % sys.argv[0])
+    input_data_dir, output_data_dir = sys.argv[1:3]
+    jobs = int(sys.argv[3]) if len(sys.argv) == 4 else 1
 
-import subprocess
-
-subprocess.call("cp -R %s %s"%(source_folder, target_folder), shell=True)
-
-for nii in glob(target_folder+"/*/*/*/*.*.gz") + glob(target_folder+"/*/*/*/*/*.*.gz"):
-    os.remove(nii)
-    open(nii, "w").close()
-    
-subprocess.call("dot_clean %s"%target_folder, shell=True)
\ No newline at end of file
+    # zero-byte images with the real metadata and events, straight from the
+    # sources without copying or reading any image data (to get them
+    # together with the full conversion pass skeleton_dir to convert_batch
+    # in convert_all_openfmri.py instead)
+    target_folder = os.path.join(output_data_dir, "empty")
+    rows = convert_batch([dataset_job(dataset, input_data_dir, target_folder)
+                          for dataset in datasets],
+                         jobs=jobs, nii_handling='empty')
+    write_summary(rows, sys.stdout)
@@ -0,0 +1,59 @@
+import gzip
+import os
+import struct
+
+import pytest
+
+from openfmri2bids import synthetic
+
+
+@pytest.fixture
+def make_dataset():
+    """synthetic.make_dataset(), the datasets of all tests."""
+    return synthetic.make_dataset
+
+
+def _listing(root):
+    return sorted(os.path.relpath(os.path.join(dirpath, fname), root)
+                  for dirpath, _, fnames in os.walk(root) for fname in fnames)
+
+
+@pytest.fixture
+def listing():
+    """Sorted paths (relative to root) of the files under root."""
+    return _listing
+
+
+@pytest.fixture
+def assert_same_files():
+    """Checks that two folders have the same files with the same
+    contents."""
+    def assert_same_files(out, expected):
+        assert _listing(out) == _listing(expected)
+        for fname in _listing(expected):
+            with open(os.path.join(out, fname), "rb") as f, \
+                    open(os.path.join(expected, fname), "rb") as g:
+                assert f.read() == g.read()
+    return assert_same_files
+
+
+@pytest.fixture
+def make_nifti():
+    """Writes a NIfTI-1 file (gzipped for .gz) with the given TR and
+    returns its uncompressed content."""
+    def make_nifti(fpath, tr, xyzt_units=2 | 8, ndim=4, endian="<",
+                   data=b"\x01\x02" * 50000):
+        header = bytearray(348)
+        struct.pack_into(endian + "i", header, 0, 348)
+        struct.pack_into(endian + "8h", header, 40, ndim, 2, 2, 2, 3, 1, 1, 1)
+        struct.pack_into(endian + "8f", header, 76, 1, 3, 3, 3, tr, 0, 0, 0)
+        struct.pack_into(endian + "f", header, 108, 352)
+        header[123] = xyzt_units
+        header[344:348] = b"n+1\x00"
+        content = bytes(header) + b"\x00" * 4 + data
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with (gzip.open if fpath.endswith(".gz") else open)(fpath, "wb") as f:
+            f.write(content)
+        return content
+    return make_nifti
@@ -0,0 +1,46 @@
+import io
+import tarfile
+
+import pytest
+
+from openfmri2bids.archive import TarSink, guess_compression
+from openfmri2bids.converter import convert
+
+
+def test_guess_compression():
+    assert guess_compression("ds001.tar.gz") == "gz"
+    assert guess_compression("ds001.tar.zst") == "zstd"
+    assert guess_compression("ds001.tar") == "none"
+
+
+@pytest.mark.parametrize("compression", ["none", "gz"])
+def test_archive_matches_folder(tmpdir, make_dataset, listing, compression):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    convert(source, str(tmpdir.join("out", "ds001")), nii_handling="copy")
+
+    f = io.BytesIO()
+    with TarSink(f, str(tmpdir.join("ds001")), compression=compression) as sink:
+        convert(source, str(tmpdir.join("ds001")), nii_handling="copy",
+                sink=sink, transfer_jobs=2)
+    assert not tmpdir.join("ds001").check()
+
+    f.seek(0)
+    with tarfile.open(fileobj=f, mode="r:*") as tar:
+        tar.extractall(str(tmpdir.join("extracted")))
+    expected = listing(str(tmpdir.join("out")))
+    assert listing(str(tmpdir.join("extracted"))) == expected
+    for fname in expected:
+        assert tmpdir.join("extracted", fname).read() == \
+            tmpdir.join("out", fname).read()
+
+
+def test_archive_empty_images(tmpdir, make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=1)
+    f = io.BytesIO()
+    with TarSink(f, "ds001") as sink:
+        convert(source, "ds001", nii_handling="empty", sink=sink)
+    f.seek(0)
+    with tarfile.open(fileobj=f) as tar:
+        sizes = dict((member.name, member.size) for member in tar)
+    assert sizes["ds001/sub-1/anat/sub-1_T1w.nii.gz"] == 0
+    assert sizes["ds001/sub-1/func/sub-1_task-sometask1_run-01_events.tsv"] > 0
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from openfmri2bids.batch import convert_batch, dataset_job, read_dataset_list
+from openfmri2bids.converter import convert_rev_changelog
+
+
+def test_dataset_job():
+    assert dataset_job("ds001", "in", "out") == {
+        "name": "ds001", "dest": os.path.join("out", "ds001"),
+        "sessions": [["", os.path.join("in", "ds001")]],
+        "changelog_converter": "default"}
+    job = dataset_job({"sessions": {"pre": "ds006A_R1.1.0_raw",
+                                    "post": "ds006B"},
+                       "changelog_converter": "rev"}, "in", "out")
+    assert job["name"] == "ds006"
+    assert job["sessions"] == [["pre", os.path.join("in",
+                                                    "ds006A_R1.1.0_raw")],
+                               ["post", os.path.join("in", "ds006B")]]
+    assert job["changelog_converter"] == "rev"
+
+
+def test_convert_batch_isolates_failures(tmpdir, make_dataset):
+    make_dataset(str(tmpdir.join("in", "ds001")), n_subjects=2, n_tasks=1,
+                 image_size=4)
+    tmpdir.join("in", "ds002").ensure(dir=True)
+    tmpdir.join("list.json").write('["ds001", "ds002"]')
+    jobs = read_dataset_list(str(tmpdir.join("list.json")),
+                             str(tmpdir.join("in")), str(tmpdir.join("out")))
+    rows = convert_batch(jobs, jobs=2, nii_handling="copy")
+    assert [(row["dataset"], row["status"]) for row in rows] == \
+        [("ds001", "ok"), ("ds002", "failed")]
+    # 2 BOLD, a T1w and an inplane image per subject
+    assert rows[0]["files"] == 8
+    assert rows[0]["bytes"] == 2*(2*4 + 2 + 1)
+    assert rows[1]["error"]
+    assert tmpdir.join("out", "ds001", "dataset_description.json").check()
+
+
+@pytest.mark.parametrize("nii_handling", ["link", "hardlink", "copy"])
+def test_convert_batch_rerun(tmpdir, make_dataset, nii_handling):
+    make_dataset(str(tmpdir.join("in", "ds001")), n_subjects=2)
+    jobs = [dataset_job("ds001", str(tmpdir.join("in")),
+                        str(tmpdir.join("out")))]
+    convert_batch(jobs, nii_handling=nii_handling)
+    tmpdir.join("in", "ds001", "sub001", "anatomy",
+                "highres001.nii.gz").write("new T1w")
+    rows = convert_batch(jobs, nii_handling=nii_handling)
+
+    assert [row["status"] for row in rows] == ["ok"]
+    assert tmpdir.join("out", "ds001", "sub-1", "anat",
+                       "sub-1_T1w.nii.gz").read() == "new T1w"
+    assert not [fpath for fpath in tmpdir.join("out").visit()
+                if fpath.ext == ".tmp"]
+
+
+def test_convert_rev_changelog(tmpdir):
+    tmpdir.join("release_history.txt").write(
+        "rev1.0.1 (Jan 5 2012): fixed onsets\nrev1.0.0 (2011-12-01): first\n")
+    convert_rev_changelog(str(tmpdir.join("release_history.txt")),
+                          str(tmpdir.join("CHANGES")))
+    assert tmpdir.join("CHANGES").read() == \
+        "rev1.0.1 2012-01-05 fixed onsets\nrev1.0.0 2011-12-01 first\n"
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from openfmri2bids.cache import TableCache, table_from_header, table_header
+from openfmri2bids.converter import convert
+from openfmri2bids.readers import read_onsets_batch
+
+
+def test_table_round_trip():
+    df = pd.DataFrame({"onset": [1.5, np.nan, 3.0], "n": [1, 2, 3],
+                       "trial_type": ["a", np.nan, "b"]})
+    no_header = pd.DataFrame({0: pd.Series(["x", "y"], dtype=object),
+                              1: [True, False]})
+    for table in [df, no_header, df.iloc[:0].reset_index(drop=True)]:
+        buffers = []
+        header = table_header(table, buffers, 0)
+        pd.testing.assert_frame_equal(
+            table_from_header(header, b"".join(buffers)), table)
+    assert table_header(pd.DataFrame({"a": [1, "b"]}), [], 0) is None
+    assert table_header(df.set_index("n"), [], 0) is None
+
+
+def test_table_cache(tmpdir):
+    fpaths = []
+    for name in ["cond001", "cond002"]:
+        tmpdir.join(name + ".txt").write("0 1 1\n10 1 1\n")
+        fpaths.append(str(tmpdir.join(name + ".txt")))
+    cache = TableCache(str(tmpdir.join("cache")))
+    expected = read_onsets_batch(fpaths)
+    for _ in range(2):
+        for df, reference in zip(cache.get_many(fpaths, "onsets",
+                                                read_onsets_batch),
+                                 expected):
+            pd.testing.assert_frame_equal(df, reference)
+    assert (cache.stats["misses"], cache.stats["hits"]) == (2, 2)
+
+    # a changed file invalidates the entry
+    tmpdir.join("cond002.txt").write("5 2 1\n")
+    df = cache.get_many(fpaths, "onsets", read_onsets_batch)[1]
+    assert df["onset"].tolist() == [5]
+    assert cache.stats["misses"] == 4
+    assert len(os.listdir(str(tmpdir.join("cache")))) == 1
+
+    # least recently used entries are evicted
+    os.utime(cache.entry_path(fpaths, "onsets"), (0, 0))
+    cache.get(fpaths[0], "onsets", lambda: read_onsets_batch(fpaths[:1])[0])
+    cache.max_bytes = os.path.getsize(cache.entry_path(fpaths[:1],
+                                                       "onsets"))
+    cache.trim()
+    assert os.listdir(str(tmpdir.join("cache"))) == \
+        [os.path.basename(cache.entry_path(fpaths[:1], "onsets"))]
+    assert cache.stats["evicted"] == 1
+
+
+def test_convert_with_cache(tmpdir, make_dataset, assert_same_files):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=2)
+    out = str(tmpdir.join("out"))
+    convert(source, out, nii_handling="copy", warning=lambda message: None)
+    summaries = []
+    for name in ["cold", "warm"]:
+        summaries.append(convert(source, str(tmpdir.join(name)),
+                                 nii_handling="copy",
+                                 warning=lambda message: None,
+                                 cache=TableCache(str(tmpdir.join("cache")))))
+        assert_same_files(str(tmpdir.join(name)), out)
+    cold, warm = [summary["cache"] for summary in summaries]
+    assert cold["hits"] == 0 and cold["misses"] == warm["hits"] > 0
+    assert warm["misses"] == 0 and warm["hit_rate"] == 1.0
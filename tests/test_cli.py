@@ -1,3 +1,7 @@
+import json
+import os
+import tarfile
+
 import pytest
 from click.testing import CliRunner
 from openfmri2bids import cli
@@ -8,22 +12,76 @@ def runner():
     return CliRunner()
 
 
-def test_cli(runner):
-    result = runner.invoke(cli.main)
+@pytest.fixture
+def dataset(tmpdir, make_dataset):
+    return make_dataset(str(tmpdir.join("ds")), n_subjects=2, n_events=8)
+
+
+def test_cli_convert(runner, dataset, tmpdir, listing):
+    out = str(tmpdir.join("out"))
+    result = runner.invoke(cli.main, [dataset, out])
     assert result.exit_code == 0
     assert not result.exception
-    assert result.output.strip() == 'Hello, world.'
+    fnames = listing(out)
+    assert "participants.tsv" in fnames
+    assert os.path.join("sub-1", "func",
+                        "sub-1_task-sometask1_run-01_events.tsv") in fnames
+    assert len([fname for fname in fnames
+                if fname.endswith("_bold.nii.gz")]) == 8
 
 
-def test_cli_with_option(runner):
-    result = runner.invoke(cli.main, ['--as-cowboy'])
-    assert not result.exception
+def test_cli_dry_run(runner, dataset, tmpdir):
+    out = str(tmpdir.join("out"))
+    result = runner.invoke(cli.main, ["convert", dataset, out, "--dry-run"])
+    assert result.exit_code == 0
+    plan = json.loads(result.stdout)
+    assert [subject["bids"] for subject in plan["subjects"]] == ["sub-1",
+                                                                 "sub-2"]
+    assert not os.path.exists(out)
+
+
+def test_cli_profile(runner, dataset, tmpdir):
+    profile = str(tmpdir.join("profile.json"))
+    result = runner.invoke(cli.main, ["--log_level", "warning", dataset,
+                                      str(tmpdir.join("out")),
+                                      "--profile", profile])
     assert result.exit_code == 0
-    assert result.output.strip() == 'Howdy, world.'
+    with open(profile) as f:
+        report = json.load(f)
+    assert report["counters"]["events_files"] == 8
+    assert sorted(report["children"]) == ["sub-1", "sub-2"]
 
 
-def test_cli_with_arg(runner):
-    result = runner.invoke(cli.main, ['Chris'])
+def test_cli_archive_and_skeleton(runner, dataset, tmpdir, listing):
+    archive = str(tmpdir.join("ds001.tar"))
+    skeleton = str(tmpdir.join("skeleton"))
+    result = runner.invoke(cli.main, ["convert", dataset, "ds001",
+                                      "--archive", archive,
+                                      "--skeleton_folder", skeleton])
     assert result.exit_code == 0
     assert not result.exception
-    assert result.output.strip() == 'Hello, Chris.'
+    with tarfile.open(archive) as tar:
+        names = tar.getnames()
+    assert "ds001/participants.tsv" in names
+    images = [fname for fname in listing(skeleton)
+              if fname.endswith("_bold.nii.gz")]
+    assert len(images) == 8
+    assert "ds001/" + images[0].replace(os.sep, "/") in names
+    assert os.path.getsize(os.path.join(skeleton, images[0])) == 0
+
+
+def test_cli_audit_tr(runner, tmpdir, make_nifti):
+    tmpdir.join("ds", "scan_key.txt").write("TR 2.2\n", ensure=True)
+    bold = str(tmpdir.join("ds", "sub001", "BOLD", "task001_run001",
+                           "bold.nii.gz"))
+    make_nifti(bold, 2.0)
+    result = runner.invoke(cli.main, ["audit_tr", str(tmpdir.join("ds"))])
+    assert result.exit_code == 1
+    assert "inconsistent TR; nifti file: 2 sec, scan_key: 2.2 sec, for " + \
+        bold in result.output
+    assert "0 ok, 1 inconsistent, 0 fixed, 0 errors" in result.output
+
+    result = runner.invoke(cli.main, ["audit_tr", "--fix",
+                                      str(tmpdir.join("ds"))])
+    assert result.exit_code == 0
+    assert "0 ok, 0 inconsistent, 1 fixed, 0 errors" in result.output
@@ -0,0 +1,234 @@
+import json
+import os
+
+import pytest
+
+from openfmri2bids import converter, manifest
+from openfmri2bids.converter import (SkeletonSink, convert, convert_sessions,
+                                     run_settings)
+
+
+def test_skeleton(tmpdir, make_dataset, listing):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    out, skeleton = str(tmpdir.join("out")), str(tmpdir.join("skeleton"))
+    convert(source, out, nii_handling="copy",
+            sink=SkeletonSink(out, skeleton))
+
+    assert listing(skeleton) == listing(out)
+    for fname in listing(out):
+        if fname.endswith(".nii.gz"):
+            assert os.path.getsize(os.path.join(out, fname)) > 0
+            assert os.path.getsize(os.path.join(skeleton, fname)) == 0
+        else:
+            assert tmpdir.join("skeleton", fname).read() == \
+                tmpdir.join("out", fname).read()
+
+
+def test_profile(tmpdir, make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3, n_tasks=1)
+    summary = convert(source, str(tmpdir.join("out")), nii_handling="copy",
+                      jobs=2)
+    profile = summary["profile"]
+
+    assert set(profile["stages"]) >= {"scan", "events", "func_images",
+                                      "anat_images", "metadata"}
+    assert sorted(profile["children"]) == ["sub-1", "sub-2", "sub-3"]
+    assert profile["counters"]["events_files"] == 6
+    run = profile["children"]["sub-1"]["children"][
+        "sub-1_task-sometask1_run-01"]
+    assert run["counters"]["events_files"] == 1
+    assert run["counters"]["image_files"] == 1
+    # one listing of the top level folder, the rest is per subject
+    assert profile["counters"]["fs_calls"] == summary["stat_count"]
+    assert profile["children"]["sub-1"]["counters"]["fs_calls"] == \
+        (summary["stat_count"] - 1)//3
+    assert summary["peak_rss_mb"] > 0
+
+
+def test_jobs(tmpdir, make_dataset, assert_same_files):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    out, parallel = str(tmpdir.join("out")), str(tmpdir.join("parallel"))
+    convert(source, out, nii_handling="copy")
+    convert(source, parallel, nii_handling="copy", jobs=2)
+
+    assert_same_files(parallel, out)
+
+
+def test_checksums_and_dedup(tmpdir, make_dataset, listing):
+    # all synthetic BOLD images have the same contents
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=2)
+    out = str(tmpdir.join("out"))
+    summary = convert(source, out, nii_handling="copy", checksums="sha256",
+                      dedup=True)
+
+    assert summary["nii_handling"] == {"copy": 3, "dedup": 9}
+    with open(os.path.join(out, ".openfmri2bids_checksums.sha256")) as f:
+        checksums = dict(line.rstrip("\n").split("  ")[::-1] for line in f)
+    assert set(checksums) == set(fname.replace(os.sep, "/")
+                                 for fname in listing(out)
+                                 if not fname.startswith("."))
+    bolds = sorted(fname for fname in checksums
+                   if fname.endswith("_bold.nii.gz"))
+    assert len(set(checksums[fname] for fname in bolds)) == 1
+    assert os.path.samefile(os.path.join(out, bolds[0]),
+                            os.path.join(out, bolds[-1]))
+
+    # worker processes would only find duplicates within a subject
+    with pytest.raises(ValueError):
+        convert(source, str(tmpdir.join("parallel")), nii_handling="copy",
+                checksums="sha256", dedup=True, jobs=2)
+
+
+def test_io_jobs(tmpdir, make_dataset, assert_same_files):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    out, prefetched = str(tmpdir.join("out")), str(tmpdir.join("prefetched"))
+    convert(source, out, nii_handling="copy")
+    convert(source, prefetched, nii_handling="copy", io_jobs=4)
+
+    assert_same_files(prefetched, out)
+
+
+def test_run_settings():
+    assert run_settings()["jobs"] == 1
+    assert run_settings({"jobs": 2}, io_jobs=4)["io_jobs"] == 4
+    with pytest.raises(TypeError):
+        run_settings(job=2)
+
+
+def test_only(tmpdir, make_dataset, listing):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=2)
+    out = str(tmpdir.join("out"))
+    convert(source, out, nii_handling="link")
+    events = os.path.join(out, "sub-1", "func",
+                          "sub-1_task-sometask1_run-01_events.tsv")
+    with open(events) as f:
+        text = f.read()
+    with open(events, "w") as f:
+        f.write("outdated")
+    os.remove(os.path.join(out, "participants.tsv"))
+
+    # the images are not touched
+    summary = convert(source, out, nii_handling="link", only="events")
+    assert summary["throughput"]["files"] == 0
+    with open(events) as f:
+        assert f.read() == text
+    assert not os.path.exists(os.path.join(out, "participants.tsv"))
+
+    convert(source, out, nii_handling="link", only="metadata")
+    assert os.path.exists(os.path.join(out, "participants.tsv"))
+    assert not [fname for fname in listing(out) if fname.endswith(".tmp")]
+
+
+def test_sessions(tmpdir, make_dataset):
+    pre = make_dataset(str(tmpdir.join("pre")), n_subjects=2, n_events=6)
+    post = make_dataset(str(tmpdir.join("post")), n_subjects=3, n_events=6,
+                        seed=1)
+    tmpdir.join("post", "scan_key.txt").write("TR 2.5\n")
+    out = tmpdir.join("out")
+    summary = convert_sessions([("pre", pre), ("post", post)], str(out),
+                               nii_handling="copy")
+
+    assert summary["throughput"]["files"] == (2 + 3)*(4 + 2)
+    participants = out.join("participants.tsv").read().splitlines()
+    assert [line.split("\t")[0] for line in participants] == [
+        "participant_id", "sub-1", "sub-2", "sub-3"]
+    # the TR differs between sessions, so it moves to session sidecars
+    assert json.loads(out.join("task-sometask1_bold.json").read()) == {
+        "TaskName": "some task 1"}
+    assert json.loads(out.join(
+        "sub-3", "ses-post", "func",
+        "sub-3_ses-post_task-sometask1_bold.json").read()) == {
+            "RepetitionTime": 2.5}
+    assert out.join("sub-1", "ses-pre", "func",
+                    "sub-1_ses-pre_task-sometask1_run-01_events.tsv").check()
+    assert not out.join("sub-3", "ses-pre").check()
+
+
+def test_sessions_pad_subject_labels_per_session(tmpdir, make_dataset):
+    pre = make_dataset(str(tmpdir.join("pre")), n_subjects=2, n_tasks=1,
+                       n_runs=1, n_events=4)
+    post = make_dataset(str(tmpdir.join("post")), n_subjects=10, n_tasks=1,
+                        n_runs=1, n_events=4)
+    out = tmpdir.join("out")
+    convert_sessions([("pre", pre), ("post", post)], str(out),
+                     nii_handling="copy")
+
+    assert out.join("sub-1", "ses-pre").check()
+    assert out.join("sub-01", "ses-post").check()
+    assert out.join("sub-10", "ses-post").check()
+    assert not out.join("sub-1", "ses-post").check()
+    participants = [line.split("\t")[0] for line in
+                    out.join("participants.tsv").read().splitlines()[1:]]
+    assert participants == ["sub-1", "sub-2"] + ["sub-%02d"%i
+                                                 for i in range(1, 11)]
+
+
+def test_incremental_hashes_key_files_once(tmpdir, monkeypatch, make_dataset):
+    hashed = []
+    real_sha1 = manifest._sha1
+    monkeypatch.setattr(manifest, "_sha1",
+                        lambda fpath: hashed.append(fpath) or
+                        real_sha1(fpath))
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    convert(source, str(tmpdir.join("out")), nii_handling="link",
+            incremental=True)
+
+    assert hashed
+    assert not [fpath for fpath in hashed if fpath.endswith(".nii.gz")]
+    assert len(hashed) == len(set(hashed))
+
+
+def test_incremental_skips_current_outputs(tmpdir, make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    out = str(tmpdir.join("out"))
+    convert(source, out, nii_handling="copy", incremental=True)
+    summary = convert(source, out, nii_handling="copy", incremental=True)
+
+    assert summary["throughput"]["files"] == 0
+    assert summary["profile"]["counters"].get("events_files", 0) == 0
+    assert "participants" not in summary["profile"]["stages"]
+
+
+def test_incremental_regenerates_changed_and_missing_outputs(tmpdir,
+                                                             make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3, rt=False,
+                          behav="none")
+    out = tmpdir.join("out")
+    convert(source, str(out), nii_handling="copy", incremental=True)
+    tmpdir.join("ds", "sub001", "model", "model001", "onsets",
+                "task001_run001", "cond001.txt").write("0 1 1\n12 1 1\n")
+    out.join("sub-2", "anat", "sub-2_T1w.nii.gz").remove()
+    summary = convert(source, str(out), nii_handling="copy",
+                      incremental=True)
+
+    assert summary["throughput"]["files"] == 1
+    assert summary["profile"]["counters"]["events_files"] == 1
+    assert out.join("sub-2", "anat", "sub-2_T1w.nii.gz").read() == "x"*100
+    events = out.join("sub-1", "func",
+                      "sub-1_task-sometask1_run-01_events.tsv").read()
+    assert "12\t1.000\tcond 1" in events and "3.000\tcond 1" not in events
+
+
+def test_incremental_resumes_interrupted_run(tmpdir, monkeypatch, make_dataset,
+                                             assert_same_files):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3, n_tasks=1)
+    out, expected = str(tmpdir.join("out")), str(tmpdir.join("expected"))
+    convert(source, expected, nii_handling="copy")
+
+    convert_subject = converter.convert_subject
+
+    def interrupted(subject, *args, **kwargs):
+        if subject["bids"] == "sub-3":
+            raise KeyboardInterrupt
+        return convert_subject(subject, *args, **kwargs)
+
+    monkeypatch.setattr(converter, "convert_subject", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        convert(source, out, nii_handling="copy", incremental=True)
+    monkeypatch.undo()
+    summary = convert(source, out, nii_handling="copy", incremental=True)
+
+    # only the events of the subject that was not done are converted again
+    assert summary["profile"]["counters"]["events_files"] == 2
+    os.remove(os.path.join(out, manifest.MANIFEST_NAME))
+    assert_same_files(out, expected)
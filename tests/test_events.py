@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+from openfmri2bids.events import (align_behav, build_events, events_tsv,
+                                  merge_conditions)
+
+
+def onsets(rows):
+    return pd.DataFrame(rows, columns=["onset", "duration", "weight"])
+
+
+def test_build_events_folds_response_times():
+    events_df = build_events([
+        ("go", onsets([[0, 2, 1], [10, 2, 1], [20, 2, 1]])),
+        ("goRT", onsets([[0, 0.5, 1], [10, 0, 1]])),
+    ])
+    assert events_df.columns.tolist() == ["onset", "duration", "trial_type",
+                                          "RT"]
+    assert events_df["trial_type"].tolist() == ["go", "go", "go"]
+    assert events_df["RT"].iloc[0] == 0.5
+    assert np.isnan(events_df["RT"].iloc[1:]).all()
+
+
+def test_build_events_parametric_columns_and_zero_durations():
+    warnings = []
+    events_df = build_events([
+        ("stim", onsets([[0, 1, 1], [5, 1, 1], [9, 1, 1]])),
+        ("value", onsets([[0, 1, 0.2], [5, 1, 0.7], [9, 0, 0.1]])),
+    ], warning=warnings.append)
+    events_df = events_df.sort_values("onset")
+    # duplicated stim events are dropped in favour of the parametric ones
+    assert events_df["trial_type"].tolist() == ["value", "value", "stim"]
+    assert events_df["value"].tolist()[:2] == [0.2, 0.7]
+    assert (events_df["duration"] != 0).all()
+    assert len(warnings) == 1
+
+
+def test_build_events_without_conditions():
+    assert build_events([]) is None
+
+
+def test_merge_conditions_orders_equal_length_tables():
+    dfs = [pd.DataFrame({"onset": [4, 1], "duration": [1, 1],
+                         "trial_type": ["b", "b"]}),
+           pd.DataFrame({"onset": [1, 2], "duration": [1, 1],
+                         "trial_type": ["a", "a"]})]
+    events_df = merge_conditions(dfs)
+    assert events_df["onset"].tolist() == [1, 1, 2, 4]
+    assert events_df["trial_type"].tolist() == ["a", "b", "a", "b"]
+
+
+def test_align_behav_matches_nearest_onset_within_tolerance():
+    events_df = pd.DataFrame({"onset": [10.0, 20.0, 30.0],
+                              "duration": [1, 1, 1],
+                              "trial_type": ["a", "a", "a"]})
+    beh_df = pd.DataFrame({"Onset": [10.06, 19.94, 45.0],
+                           "accuracy": [1, 0, 1]})
+    all_df, report = align_behav(events_df, beh_df, tolerance=0.1)
+    # 10.06 and 19.94 round to different 0.1 s bins than 10.0 and 20.0
+    assert all_df["onset"].round(3).tolist() == [10.03, 19.97, 30.0, 45.0]
+    assert all_df["accuracy"].tolist()[:2] == [1, 0]
+    assert report == {"unmatched_events": [30.0], "unmatched_behav": [45.0]}
+
+
+def test_align_behav_does_not_multiply_duplicate_onsets():
+    events_df = pd.DataFrame({"onset": [5.0] * 4, "duration": [1] * 4,
+                              "trial_type": list("abcd")})
+    beh_df = pd.DataFrame({"Onset": [5.0] * 4, "accuracy": [1, 2, 3, 4]})
+    all_df, report = align_behav(events_df, beh_df)
+    assert all_df["trial_type"].tolist() == list("abcd")
+    assert all_df["accuracy"].tolist() == [1, 2, 3, 4]
+    assert report == {"unmatched_events": [], "unmatched_behav": []}
+
+
+def test_align_behav_pairs_each_behav_row_once():
+    events_df = pd.DataFrame({"onset": [10.0, 10.05], "duration": [1, 1],
+                              "trial_type": ["a", "b"]})
+    beh_df = pd.DataFrame({"Onset": [10.04], "accuracy": [1]})
+    all_df, report = align_behav(events_df, beh_df)
+    assert all_df["trial_type"].tolist() == ["a", "b"]
+    assert all_df["accuracy"].iloc[0] == 1
+    assert np.isnan(all_df["accuracy"].iloc[1])
+    assert report == {"unmatched_events": [10.05], "unmatched_behav": []}
+
+
+def test_align_behav_pairs_repeated_onsets_within_tolerance():
+    events_df = pd.DataFrame({"onset": [10.0, 10.0], "duration": [1, 1],
+                              "trial_type": ["a", "b"]})
+    beh_df = pd.DataFrame({"Onset": [10.02, 10.03], "accuracy": [1, 0]})
+    all_df, report = align_behav(events_df, beh_df)
+    assert all_df["accuracy"].tolist() == [1, 0]
+    assert all_df["onset"].round(3).tolist() == [10.01, 10.015]
+    assert report == {"unmatched_events": [], "unmatched_behav": []}
+
+
+def test_align_behav_pairs_chained_onsets():
+    # 10.05 is nearest to 10.08, but pairing it with 10.0 pairs every row
+    events_df = pd.DataFrame({"onset": [10.0, 10.08], "duration": [1, 1],
+                              "trial_type": ["a", "b"]})
+    beh_df = pd.DataFrame({"Onset": [10.05, 10.12], "accuracy": [1, 0]})
+    all_df, report = align_behav(events_df, beh_df)
+    assert len(all_df) == 2
+    assert all_df["accuracy"].tolist() == [1, 0]
+    assert report == {"unmatched_events": [], "unmatched_behav": []}
+
+
+def test_align_behav_keeps_integer_columns():
+    events_df = pd.DataFrame({"onset": [10.0, 20.0], "duration": [3, 3],
+                              "trial_type": ["a", "a"]})
+    beh_df = pd.DataFrame({"Onset": [10.0, 20.0], "accuracy": [1, 0]})
+    all_df, report = align_behav(events_df, beh_df)
+    assert all_df["duration"].dtype == np.int64
+    assert events_tsv(all_df).splitlines()[1] == "10.000\t3\ta\t1"
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+from openfmri2bids.synthetic import make_dataset
+
+HEAVY_MODULES = ["pandas", "numpy", "dateutil"]
+
+CHECK = """
+import sys
+%s
+heavy = [name for name in %r if name in sys.modules]
+assert not heavy, "imported " + ", ".join(heavy)
+"""
+
+
+def run_python(code, *args):
+    env = dict(os.environ)
+    paths = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    if env.get("PYTHONPATH"):
+        paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    return subprocess.run([sys.executable, "-c", code] + list(args),
+                          env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+
+
+def test_cli_import_is_light():
+    run_python(CHECK%("import openfmri2bids.cli", HEAVY_MODULES))
+
+
+def test_dry_run_does_not_load_pandas(tmpdir):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=2)
+    code = CHECK%("""
+from openfmri2bids.cli import main
+try:
+    main(["convert", sys.argv[1], sys.argv[2], "--dry-run"])
+except SystemExit as exc:
+    assert not exc.code
+""", HEAVY_MODULES)
+    result = run_python(code, source, str(tmpdir.join("out")))
+    assert '"subjects"' in result.stdout
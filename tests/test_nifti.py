@@ -0,0 +1,66 @@
+import gzip
+
+import pytest
+
+from openfmri2bids.nifti import (audit_tr, check_tr, gzip_compresslevel,
+                                 header_tr, read_header)
+
+
+def read(fpath):
+    with (gzip.open if fpath.endswith(".gz") else open)(fpath, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("fname", ["bold.nii.gz", "bold.nii"])
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_check_and_fix_tr(tmpdir, make_nifti, fname, endian):
+    fpath = str(tmpdir.join(fname))
+    content = make_nifti(fpath, 2.5, xyzt_units=2, endian=endian)
+
+    report = check_tr(fpath, 2.0)
+    assert report["status"] == "inconsistent"
+    assert (report["tr"], report["unit"]) == (2.5, "unknown")
+    assert read(fpath) == content
+
+    assert check_tr(fpath, 2.0, fix=True)["status"] == "fixed"
+    assert header_tr(*read_header(fpath)) == (4, 2.0, "sec")
+    fixed = read(fpath)
+    assert fixed[123] == 2 | 8
+    # only pixdim[4] and xyzt_units changed
+    assert fixed[:92] == content[:92]
+    assert fixed[96:123] == content[96:123]
+    assert fixed[124:] == content[124:]
+    assert check_tr(fpath, 2.0)["status"] == "ok"
+
+
+@pytest.mark.parametrize("compresslevel", [1, 6, 9])
+def test_fix_keeps_compresslevel(tmpdir, make_nifti, compresslevel):
+    content = make_nifti(str(tmpdir.join("bold.nii")), 2.5)
+    fpath = str(tmpdir.join("bold.nii.gz"))
+    with gzip.open(fpath, "wb", compresslevel=compresslevel) as f:
+        f.write(content)
+    assert gzip_compresslevel(fpath) == compresslevel
+
+    assert check_tr(fpath, 2.0, fix=True)["status"] == "fixed"
+    assert gzip_compresslevel(fpath) == compresslevel
+    assert check_tr(fpath, 2.0)["status"] == "ok"
+
+
+def test_check_tr_errors(tmpdir, make_nifti):
+    fpath = str(tmpdir.join("bold.nii.gz"))
+    make_nifti(fpath, 2.0, ndim=3)
+    assert check_tr(fpath, 2.0)["status"] == "error"
+    tmpdir.join("junk.nii").write("not a header")
+    assert check_tr(str(tmpdir.join("junk.nii")), 2.0)["status"] == "error"
+
+
+def test_audit_tr(tmpdir, make_nifti):
+    tmpdir.join("ds", "scan_key.txt").write("TR 2.2\n", ensure=True)
+    make_nifti(str(tmpdir.join("ds", "sub001", "BOLD", "task001_run001",
+                               "bold.nii.gz")), 2.2)
+    make_nifti(str(tmpdir.join("ds", "sub002", "BOLD", "task001_run001",
+                               "bold.nii.gz")), 2.0)
+    reports = audit_tr(str(tmpdir.join("ds")), fix=True, jobs=2)
+    assert sorted(report["status"] for report in reports) == ["fixed", "ok"]
+    assert [report["status"] for report in
+            audit_tr(str(tmpdir.join("ds")))] == ["ok", "ok"]
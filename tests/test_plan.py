@@ -0,0 +1,96 @@
+import io
+import os
+
+from openfmri2bids.converter import convert, execute_plan
+from openfmri2bids.inventory import SourceIndex
+from openfmri2bids.plan import dump_plans, load_plans, make_plan, split_plan
+
+
+def test_make_plan_does_not_touch_dest(tmpdir, make_dataset):
+    source, dest = str(tmpdir.join("ds")), str(tmpdir.join("out"))
+    make_dataset(source, n_subjects=3, n_tasks=1, behav="none")
+    plan = make_plan(source, dest, nii_handling="copy")
+    assert not os.path.exists(dest)
+
+    subject = plan["subjects"][0]
+    assert subject["bids"] == "sub-1"
+    assert [os.path.basename(image["dest"]) for image in subject["images"]] == \
+        ["sub-1_task-sometask1_run-01_bold.nii.gz",
+         "sub-1_task-sometask1_run-02_bold.nii.gz",
+         "sub-1_T1w.nii.gz", "sub-1_inplaneT2.nii.gz"]
+    assert [condition for _, condition in
+            subject["events"][0]["conditions"]] == ["cond 1", "cond 2",
+                                                    "respRT"]
+    assert subject["events"][0]["behav"] is None
+
+    f = io.StringIO()
+    dump_plans(plan, f)
+    f.seek(0)
+    assert load_plans(f) == [plan]
+
+
+def test_missing_anatomy_is_a_warning(tmpdir, make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=2)
+    missing = tmpdir.join("ds", "sub002", "anatomy", "inplane001.nii.gz")
+    missing.remove()
+    warnings = []
+    plan = make_plan(source, str(tmpdir.join("out")),
+                     warning=warnings.append)
+    assert "%s does not exist"%missing in warnings
+    assert len(plan["subjects"][1]["images"]) == \
+        len(plan["subjects"][0]["images"]) - 1
+
+
+def test_source_index_jobs(tmpdir, make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    serial = SourceIndex(source)
+    threaded = SourceIndex(source, jobs=3)
+    assert threaded._dirs == serial._dirs
+    assert threaded.stat_count == serial.stat_count
+    assert make_plan(source, "out", io_jobs=3) == make_plan(source, "out")
+
+
+def test_source_lookups_come_from_the_index(tmpdir, monkeypatch,
+                                            make_dataset):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3, n_tasks=1,
+                          behav="none")
+    lookups = []
+    for name in ["exists", "lexists", "isfile", "isdir", "getsize"]:
+        def lookup(fpath, _func=getattr(os.path, name)):
+            if str(fpath).startswith(source):
+                lookups.append(fpath)
+            return _func(fpath)
+        monkeypatch.setattr(os.path, name, lookup)
+    summary = convert(source, str(tmpdir.join("out")), nii_handling="copy")
+    monkeypatch.undo()
+
+    assert lookups == []
+    # the top level folder, and per subject its folder, BOLD and its 2 run
+    # folders, anatomy, onsets and its 2 run folders (with a stat for each
+    # of their 3 onset files) and behav
+    assert summary["stat_count"] == 1 + 3*(1 + (1 + 2) + 1 + (1 + 2*(1 + 3)) + 1)
+    assert tmpdir.join("out", "README").read() == "readme\n"
+    assert '"Name": "Synthetic"' in \
+        tmpdir.join("out", "dataset_description.json").read()
+
+
+def test_split_plan():
+    plan = {"format": 1, "subjects": list(range(5)), "dataset": {}}
+    shards = split_plan(plan, 2)
+    assert [shard["subjects"] for shard in shards] == [[0, 2, 4], [1, 3]]
+    assert [shard["dataset"] for shard in shards] == [{}, None]
+    assert [shard["shard"] for shard in shards] == [[0, 2], [1, 2]]
+
+
+def test_execute_shards_matches_convert(tmpdir, make_dataset, listing):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=3)
+    convert(source, str(tmpdir.join("out1")), nii_handling="copy")
+    plan = make_plan(source, str(tmpdir.join("out2")), nii_handling="copy")
+    for shard in split_plan(plan, 2):
+        execute_plan(shard)
+    out1, out2 = listing(str(tmpdir.join("out1"))), \
+        listing(str(tmpdir.join("out2")))
+    assert out1 == out2
+    for fname in out1:
+        assert tmpdir.join("out1", fname).read() == \
+            tmpdir.join("out2", fname).read()
@@ -0,0 +1,20 @@
+from openfmri2bids.profiling import Profile
+
+
+def test_profile_totals():
+    profile = Profile()
+    run = profile.child("sub-1").child("run-1")
+    with run.stage("events"):
+        run.count("events_files")
+    worker = Profile()
+    worker.child("run-1").add_stage("events", 2.0, 1.0)
+    worker.child("run-1").count("events_files", 2)
+    profile.merge("sub-2", worker.to_dict())
+
+    report = profile.to_dict()
+    assert report["stages"]["events"]["calls"] == 2
+    assert report["stages"]["events"]["wall"] >= 2.0
+    assert report["counters"] == {"events_files": 3}
+    assert report["children"]["sub-2"]["children"]["run-1"]["stages"][
+        "events"]["cpu"] == 1.0
+    assert Profile.from_dict(report).to_dict() == report
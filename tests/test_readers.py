@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+
+from openfmri2bids.readers import (Prefetcher, read_onsets,
+                                   read_onsets_batch, read_onsets_pandas)
+
+ONSET_FILES = {
+    "tabs": "1\t2\t1\n3\t4\t1\n",
+    "trailing_spaces": "1 2 1 \n3 4 1 \n",
+    "leading_spaces": " 1 2 1\n 3 4 1\n",
+    "blank_lines": "1 2 1\n\n3 4 1\n\n",
+    "crlf": "1 2 1\r\n3 4 1\r\n",
+    "no_final_newline": "1 2 1\n3 4 1",
+    "two_columns": "1 2\n3 4\n",
+    "one_column": "1\n3\n",
+    "ragged": "1 2 1\n3 4\n",
+    "floats": "1.5\t2\t0.3\n3\t4\t1\n",
+    "scientific": "1e1 2 1\n3 4 1\n",
+    "negative": "-1 2 -0.5\n",
+    "not_numeric": "a 2 1\n",
+}
+
+
+@pytest.fixture
+def onset_files(tmpdir):
+    fpaths = []
+    for name, content in sorted(ONSET_FILES.items()):
+        fpath = tmpdir.join(name + ".txt")
+        with open(str(fpath), "w", newline="") as f:
+            f.write(content)
+        fpaths.append(str(fpath))
+    return fpaths
+
+
+def test_read_onsets_matches_pandas(onset_files):
+    for fpath in onset_files:
+        pd.testing.assert_frame_equal(read_onsets(fpath),
+                                      read_onsets_pandas(fpath))
+
+
+def test_read_onsets_batch_matches_pandas(onset_files):
+    dfs = read_onsets_batch(onset_files)
+    assert len(dfs) == len(onset_files)
+    for fpath, df in zip(onset_files, dfs):
+        pd.testing.assert_frame_equal(df, read_onsets_pandas(fpath))
+
+
+def test_read_onsets_batch_single_layout(onset_files):
+    fpaths = [fpath for fpath in onset_files
+              if "columns" not in fpath and "ragged" not in fpath and
+              "numeric" not in fpath]
+    for fpath, df in zip(fpaths, read_onsets_batch(fpaths)):
+        pd.testing.assert_frame_equal(df, read_onsets_pandas(fpath))
+
+
+def test_prefetcher(onset_files, tmpdir):
+    missing = str(tmpdir.join("missing.txt"))
+    reader = Prefetcher(onset_files + onset_files[:1] + [missing], workers=4)
+    try:
+        for fpath, df in zip(onset_files,
+                             read_onsets_batch(onset_files,
+                                               read=reader.read)):
+            pd.testing.assert_frame_equal(df, read_onsets_pandas(fpath))
+        # contents are kept, other files are read when asked for
+        assert reader.read(onset_files[0]) == reader.open(
+            onset_files[0]).read()
+        with pytest.raises(FileNotFoundError):
+            reader.read(missing)
+        tmpdir.join("other.txt").write("1 2 3\n")
+        assert reader.read(str(tmpdir.join("other.txt"))) == b"1 2 3\n"
+    finally:
+        reader.close()
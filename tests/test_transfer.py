@@ -0,0 +1,108 @@
+import errno
+import hashlib
+import os
+import sys
+
+import pytest
+
+from openfmri2bids.transfer import (ContentIndex, TransferQueue, clone_file,
+                                    copy_hashed, hardlink_file, hash_file,
+                                    throughput_report)
+
+
+def make_file(tmpdir, name, size):
+    fpath = str(tmpdir.join(name))
+    with open(fpath, "wb") as f:
+        f.write(os.urandom(size))
+    return fpath
+
+
+def test_clone_file(tmpdir):
+    src = make_file(tmpdir, "bold.nii.gz", 3 * 1024 * 1024 + 7)
+    dest = str(tmpdir.join("copy.nii.gz"))
+    mechanism = clone_file(src, dest)
+    assert mechanism in ["reflink", "copy_file_range", "sendfile", "copy"]
+    with open(src, "rb") as fsrc, open(dest, "rb") as fdest:
+        assert fsrc.read() == fdest.read()
+
+
+def test_clone_file_without_kernel_copy(tmpdir, monkeypatch):
+    monkeypatch.setattr("openfmri2bids.transfer.fcntl", None)
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "sendfile", raising=False)
+    src = make_file(tmpdir, "bold.nii.gz", 1000)
+    dest = str(tmpdir.join("copy.nii.gz"))
+    if sys.platform != "darwin":
+        assert clone_file(src, dest) == "copy"
+        with open(src, "rb") as fsrc, open(dest, "rb") as fdest:
+            assert fsrc.read() == fdest.read()
+
+
+def test_hardlink_file(tmpdir):
+    src = make_file(tmpdir, "bold.nii.gz", 10)
+    dest = str(tmpdir.join("link.nii.gz"))
+    assert hardlink_file(src, dest) == "hardlink"
+    assert os.path.samefile(src, dest)
+
+
+def test_transfer_queue_retries_transient_errors(tmpdir):
+    attempts = []
+
+    def flaky_copy(src, dest):
+        attempts.append(src)
+        if len(attempts) == 1:
+            raise OSError(errno.EIO, "I/O error")
+        return clone_file(src, dest)
+
+    src = make_file(tmpdir, "bold.nii.gz", 100)
+    queue = TransferQueue(flaky_copy, workers=2, retry_delay=0)
+    queue.submit(src, str(tmpdir.join("copy.nii.gz")))
+    results = queue.wait()
+    assert len(results) == 1
+    assert results[0]["attempts"] == 2
+    assert results[0]["bytes"] == 100
+    report = throughput_report(results, 1.0)
+    assert report["files"] == 1
+    assert report["bytes"] == 100
+
+
+def test_transfer_queue_raises_permanent_errors(tmpdir):
+    def broken_copy(src, dest):
+        raise OSError(errno.EACCES, "Permission denied")
+
+    src = make_file(tmpdir, "bold.nii.gz", 100)
+    queue = TransferQueue(broken_copy, retry_delay=0)
+    queue.submit(src, str(tmpdir.join("copy.nii.gz")))
+    with pytest.raises(OSError):
+        queue.wait()
+
+
+def test_copy_hashed(tmpdir):
+    src = make_file(tmpdir, "bold.nii.gz", 2 * 1024 * 1024 + 3)
+    dest = str(tmpdir.join("copy.nii.gz"))
+    with open(src, "rb") as f:
+        data = f.read()
+    assert copy_hashed(src, dest) == hashlib.sha256(data).hexdigest()
+    assert hash_file(dest, "blake2b") == hashlib.blake2b(data).hexdigest()
+    with open(dest, "rb") as f:
+        assert f.read() == data
+
+
+def test_content_index(tmpdir):
+    src = make_file(tmpdir, "bold.nii.gz", 100)
+    other = make_file(tmpdir, "other.nii.gz", 100)
+    index = ContentIndex(dedup=True)
+    assert index.find(src) == (None, None)
+    index.add(src, hash_file(src))
+    assert index.find(src) == (hash_file(src), src)
+    assert index.find(other) == (hash_file(other), None)
+    assert ContentIndex().find(src) == (None, None)
+
+
+def test_transfer_queue_digests(tmpdir):
+    src = make_file(tmpdir, "bold.nii.gz", 100)
+    queue = TransferQueue(lambda src, dest: ("copy", copy_hashed(src, dest)))
+    queue.submit(src, str(tmpdir.join("copy.nii.gz")))
+    result, = queue.wait()
+    assert result["mechanism"] == "copy"
+    assert result["digest"] == hash_file(src)
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from openfmri2bids.events import events_tsv
+from openfmri2bids.tsv import frame_to_tsv
+
+
+def test_frame_to_tsv_matches_to_csv():
+    df = pd.DataFrame({"age": pd.array([31, None, 25], dtype="Int64"),
+                       "participant_id": ["sub-1", "sub-2", "sub-3"],
+                       "note": np.array(['a\tb', None, 'say "hi"'],
+                                        dtype=object),
+                       "score": [1.5, np.nan, 1e-7]})
+    assert frame_to_tsv(df, first=["participant_id"], na_rep="n/a") == \
+        df[["participant_id", "age", "note", "score"]].to_csv(
+            sep="\t", index=False, na_rep="n/a")
+
+
+def test_events_tsv():
+    events_df = pd.DataFrame({"trial_type": ["go", "stop", "go"],
+                              "RT": [0.5, np.nan, 0.25],
+                              "duration": [1, 1, 2],
+                              "onset": [10.0, 2.0, np.nan]})
+    assert events_tsv(events_df) == (
+        "onset\tduration\ttrial_type\tresponse_time\n"
+        "2.000\t1\tstop\tn/a\n"
+        "10.000\t1\tgo\t0.500\n"
+        "n/a\t2\tgo\t0.250\n")
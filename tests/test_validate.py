@@ -0,0 +1,66 @@
+import json
+import os
+
+from openfmri2bids.converter import convert
+from openfmri2bids.plan import make_plan, split_plan
+from openfmri2bids.synthetic import make_dataset
+from openfmri2bids.validate import report_path, validate_plan
+
+
+def converted(tmpdir, **kwargs):
+    source = make_dataset(str(tmpdir.join("ds")), n_subjects=2, n_events=8,
+                          **kwargs)
+    out = str(tmpdir.join("out"))
+    summary = convert(source, out, nii_handling="copy", validate=True,
+                      warning=lambda message: None)
+    return make_plan(source, out, nii_handling="copy"), summary
+
+
+def codes(issues):
+    return sorted(set(issue["code"] for issue in issues))
+
+
+def test_validate_converted_dataset(tmpdir):
+    plan, summary = converted(tmpdir)
+    assert summary["issues"] == []
+    with open(report_path(plan)) as f:
+        assert json.load(f) == []
+    assert report_path(split_plan(plan, 2)[1]).endswith("validation-1.json")
+
+
+def test_validate_finds_discrepancies(tmpdir):
+    plan, _ = converted(tmpdir)
+    subject = plan["subjects"][0]
+    os.remove(subject["images"][0]["dest"])
+    events = subject["events"][1]["dest"]
+    with open(events) as f:
+        lines = f.read().splitlines()
+    lines[1] = "\t".join(["", "nan"] + lines[1].split("\t")[2:])
+    with open(events, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    participants = plan["dataset"]["participants"]["dest"]
+    with open(participants) as f:
+        lines = f.read().splitlines()
+    with open(participants, "w") as f:
+        f.write("\n".join(lines[:-1]) + "\n")
+
+    issues = validate_plan(plan)
+    assert codes(issues) == ["EVENTS_DURATION", "EVENTS_ONSET",
+                             "EVENTS_WITHOUT_BOLD", "MISSING_FILE",
+                             "PARTICIPANT_MISSING", "TSV_MISSING_VALUE"]
+    assert all(issue["severity"] == "error" for issue in issues)
+
+
+def test_validate_sidecars_and_names(tmpdir):
+    plan, _ = converted(tmpdir)
+    plan["dataset"]["sidecars"][0]["content"].pop("RepetitionTime")
+    image = [image for image in plan["subjects"][1]["images"]
+             if image["dest"].endswith("_T1w.nii.gz")][0]
+    renamed = image["dest"].replace("_T1w", "_T2")
+    os.rename(image["dest"], renamed)
+    image["dest"] = renamed
+
+    issues = validate_plan(plan)
+    assert codes(issues) == ["FILENAME", "SIDECAR_FIELD"]
+    assert len([issue for issue in issues
+                if issue["code"] == "SIDECAR_FIELD"]) == 2 * 2
@@ -0,0 +1,82 @@
+import json
+import os
+
+from openfmri2bids.watch import STATE_NAME, STATUS_NAME, Watcher, snapshot
+
+
+def read_json(fpath):
+    with open(fpath) as f:
+        return json.load(f)
+
+
+def test_snapshot(tmpdir, make_dataset):
+    make_dataset(str(tmpdir.join("ds001")), n_subjects=2)
+    before = snapshot(str(tmpdir.join("ds001")))
+    assert snapshot(str(tmpdir.join("ds001"))) == before
+    tmpdir.join("ds001", "README.txt").write("new")
+    after = snapshot(str(tmpdir.join("ds001")))
+    assert after["digest"] != before["digest"]
+    assert after["files"] == before["files"] + 1
+
+
+def test_watcher(tmpdir, make_dataset):
+    incoming = str(tmpdir.join("in"))
+    out = str(tmpdir.join("out"))
+    make_dataset(os.path.join(incoming, "ds001"), n_subjects=2, n_tasks=1)
+
+    watcher = Watcher(incoming, out, quiet_seconds=0, nii_handling="copy")
+    # new datasets are converted once their snapshot is stable
+    watcher.poll()
+    assert watcher.datasets["ds001"]["status"] == "waiting"
+    watcher.poll()
+    assert watcher.datasets["ds001"]["status"] in ["queued", "converting"]
+    watcher.wait()
+    watcher.close()
+    assert os.path.exists(os.path.join(out, "ds001",
+                                       "dataset_description.json"))
+    status = read_json(os.path.join(out, STATUS_NAME))
+    assert status["queue_depth"] == 0
+    assert status["throughput"]["datasets"] == 1
+    assert status["datasets"]["ds001"]["status"] == "ok"
+    assert status["datasets"]["ds001"]["files"] == 8
+    assert status["datasets"]["ds001"]["latency_seconds"] > 0
+
+    # a restarted watcher only converts what changed
+    watcher = Watcher(incoming, out, quiet_seconds=0, nii_handling="copy")
+    watcher.poll(assume_quiet=True)
+    assert not watcher.queue and not watcher.running
+    tmpdir.join("in", "ds001", "README").write("changed")
+    make_dataset(os.path.join(incoming, "ds002"), n_subjects=1)
+    watcher.poll(assume_quiet=True)
+    assert sorted(name for name, _ in watcher.running.values()) == \
+        ["ds001"]
+    assert list(watcher.queue) == ["ds002"]
+    watcher.wait()
+    watcher.close()
+    state = read_json(os.path.join(out, STATE_NAME))
+    assert [state[name]["status"] for name in ["ds001", "ds002"]] == \
+        ["ok", "ok"]
+    assert read_json(os.path.join(out, STATUS_NAME))["throughput"][
+        "datasets"] == 2
+
+
+def test_watcher_reconverts_changed_dataset(tmpdir, make_dataset):
+    incoming = str(tmpdir.join("in"))
+    out = tmpdir.join("out")
+    make_dataset(os.path.join(incoming, "ds001"), n_subjects=2, rt=False,
+                 behav="none")
+    watcher = Watcher(incoming, str(out), quiet_seconds=0,
+                      nii_handling="link")
+    watcher.poll(assume_quiet=True)
+    watcher.wait()
+
+    tmpdir.join("in", "ds001", "sub001", "model", "model001", "onsets",
+                "task001_run001", "cond001.txt").write("0 1 1\n12 1 1\n")
+    watcher.poll(assume_quiet=True)
+    watcher.wait()
+    watcher.close()
+    assert watcher.datasets["ds001"]["status"] == "ok"
+    assert watcher.datasets["ds001"]["error"] == ""
+    assert "12\t1.000\tcond 1" in out.join(
+        "ds001", "sub-1", "func",
+        "sub-1_task-sometask1_run-01_events.tsv").read()